@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import `tflite_tools` from the root of the repository, like `tflite_tools.py` does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,182 @@
+"""
+Small TFLite models for the tests, built with the bundled schema (see `tflite_tools.model_rewriter`), and reference
+implementations to check the optimizer against.
+"""
+import random
+
+import numpy as np
+
+from tflite_tools import TFLiteModel
+from tflite_tools.model_rewriter import Table, encode_model
+from tflite_tools.tflite.BuiltinOperator import BuiltinOperator
+from tflite_tools.tflite.BuiltinOptions import BuiltinOptions
+from tflite_tools.tflite.TensorType import TensorType
+
+
+class GraphBuilder:
+    """
+    A subgraph under construction. Tensors are numbered in the order they're added; operators are written to the model
+    in the order they're added.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        # (shape, type, name, contents or None) tuples
+        self.tensors = []
+        # (opcode, input ids, output ids, builtin options `Table` or None) tuples
+        self.operators = []
+        self.inputs = []
+        self.outputs = []
+
+    def tensor(self, shape, type=TensorType.UINT8, name=None, data=None):
+        self.tensors.append((tuple(shape), type, name or f"t{len(self.tensors)}", data))
+        return len(self.tensors) - 1
+
+    def input(self, shape, type=TensorType.UINT8, name=None):
+        i = self.tensor(shape, type, name)
+        self.inputs.append(i)
+        return i
+
+    def constant(self, data, type=TensorType.UINT8, name=None):
+        data = np.asarray(data)
+        return self.tensor(data.shape, type, name, data)
+
+    def op(self, opcode, inputs, *output_shapes, options=None, type=TensorType.UINT8):
+        """
+        Adds an operator, along with its output tensors.
+        :return: The id of the output, or a list of them if there are several
+        """
+        outputs = [self.tensor(shape, type) for shape in output_shapes]
+        self.operators.append((opcode, list(inputs), outputs, options))
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+def build_model(*graphs):
+    """
+    Serializes subgraphs into a model; the first one is the main subgraph.
+    :param graphs: `GraphBuilder`s
+    :return: The model as a bytearray
+    """
+    buffers = [Table("Buffer")]
+    opcodes = sorted({op[0] for g in graphs for op in g.operators})
+    subgraphs = []
+    for g in graphs:
+        tensors = []
+        for shape, type, name, data in g.tensors:
+            buffer = 0
+            if data is not None:
+                buffer = len(buffers)
+                buffers.append(Table("Buffer", data=np.ascontiguousarray(data).reshape(-1).view(np.uint8)))
+            tensors.append(Table("Tensor", shape=np.array(shape, dtype=np.int32), type=type, buffer=buffer,
+                                 name=name))
+        operators = []
+        for opcode, inputs, outputs, options in g.operators:
+            operators.append(Table("Operator", opcode_index=opcodes.index(opcode),
+                                   inputs=np.array(inputs, dtype=np.int32), outputs=np.array(outputs, dtype=np.int32),
+                                   builtin_options_type=getattr(BuiltinOptions, options.table_type) if options else 0,
+                                   builtin_options=options))
+        subgraphs.append(Table("SubGraph", tensors=tensors, operators=operators,
+                               inputs=np.array(g.inputs, dtype=np.int32), outputs=np.array(g.outputs, dtype=np.int32),
+                               name=g.name))
+    return encode_model(Table("Model", version=3, description="test model", buffers=buffers, subgraphs=subgraphs,
+                              operator_codes=[Table("OperatorCode", builtin_code=c, version=1) for c in opcodes]))
+
+
+def load_model(*graphs, aliasing=False, scratch=False):
+    """
+    Builds a model and analyses its main subgraph. Aliasing and scratch buffers are left out by default, so that
+    memory usage only depends on tensor lifetimes.
+    :return: A `TFLiteModel`
+    """
+    model = TFLiteModel(build_model(*graphs), aliasing, scratch)
+    model._build_graph()
+    return model
+
+
+def random_graph(seed, num_operators, max_outputs=3):
+    """
+    A random DAG of elementwise operators and SPLITs over a single model input, with random tensor sizes. Operators
+    read one or two earlier tensors and a constant; one output of each operator whose outputs nothing reads is a graph
+    output.
+    :return: A `GraphBuilder`
+    """
+    rnd = random.Random(seed)
+    g = GraphBuilder()
+    available = [g.input((1, rnd.randint(1, 64)), name="input")]
+    consumed = set()
+    for k in range(num_operators):
+        inputs = sorted({rnd.choice(available) for _ in range(rnd.randint(1, 2))})
+        weights = g.constant(np.arange(4, dtype=np.uint8), name=f"weights{k}")
+        num_outputs = rnd.randint(1, max_outputs)
+        opcode = BuiltinOperator.SPLIT if num_outputs > 1 else \
+            BuiltinOperator.ADD if len(inputs) > 1 else BuiltinOperator.RELU
+        outputs = g.op(opcode, inputs + [weights], *[(1, rnd.randint(1, 100)) for _ in range(num_outputs)])
+        outputs = outputs if isinstance(outputs, list) else [outputs]
+        consumed.update(inputs)
+        available += outputs
+    for _, _, outputs, _ in g.operators:
+        if not consumed.intersection(outputs):
+            g.outputs.append(rnd.choice(outputs))
+    return g
+
+
+def topological_orders(graph):
+    """
+    Enumerates every valid order of execution of the operators of a `TFLiteGraph`.
+    """
+    def extend(order, done):
+        if len(order) == len(graph.operators):
+            yield list(order)
+            return
+        for op in graph.operators:
+            if op not in done and all(t.producer is None or t.producer in done for t in op.inputs):
+                order.append(op)
+                done.add(op)
+                yield from extend(order, done)
+                done.remove(op)
+                order.pop()
+
+    return extend([], set())
+
+
+def order_peak(graph, op_order):
+    """
+    Peak memory usage of an operator order without aliasing, worked out from tensor lifetimes: a tensor is in memory
+    from the step at which it's computed (the first step for model inputs) to the last step that reads it (the end
+    for graph outputs, the step itself for outputs that nothing reads), and an operator's scratch memory while it runs.
+    """
+    position = {op: k for k, op in enumerate(op_order)}
+    outputs = set(graph.outputs)
+    mem_use = [op.scratch_size for op in op_order]
+    for t in graph.tensors:
+        if t.is_constant or not t.size:
+            continue
+        first = position[t.producer] if t.producer is not None else 0
+        readers = [position[op] for op in t.consumers]
+        last = len(op_order) - 1 if t in outputs else max(readers, default=first)
+        for k in range(first, last + 1):
+            mem_use[k] += t.size
+    return max(mem_use)
+
+
+def brute_force_peak(graph):
+    """
+    The smallest peak memory usage of any operator order of a `TFLiteGraph` (see `order_peak`).
+    """
+    return min(order_peak(graph, order) for order in topological_orders(graph))
+
+
+def recompute_graph():
+    """
+    A model input goes through a cheap operator whose output is read both at the start and at the end, around a large
+    tensor: recomputing it for the end lowers peak memory usage from 1,110 B to 1,011 B.
+    :return: A `GraphBuilder`
+    """
+    g = GraphBuilder()
+    x = g.input((1, 1), name="input")
+    a = g.op(BuiltinOperator.RELU, [x], (1, 100))
+    b = g.op(BuiltinOperator.RELU, [a], (1, 10))
+    c = g.op(BuiltinOperator.RELU, [b], (1, 1000))
+    e = g.op(BuiltinOperator.RELU, [c], (1, 10))
+    g.outputs.append(g.op(BuiltinOperator.ADD, [e, a], (1, 10)))
+    return g
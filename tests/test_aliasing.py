@@ -0,0 +1,133 @@
+import random
+
+import pytest
+
+from graphs import GraphBuilder, load_model, topological_orders
+from tflite_tools.aliasing import concat_inputs, peak_memory_usage
+from tflite_tools.arena_planner import order_buffers
+from tflite_tools.model_rewriter import Table
+from tflite_tools.tflite.ActivationFunctionType import ActivationFunctionType
+from tflite_tools.tflite.BuiltinOperator import BuiltinOperator
+
+
+def random_alias_graph(seed, num_operators):
+    # Like `graphs.random_graph`, with few tensor sizes, so that elementwise operators can often work in place, and
+    # reshapes
+    rnd = random.Random(seed)
+    g = GraphBuilder()
+    available = [g.input((1, 8), name="input")]
+    consumed = set()
+    for _ in range(num_operators):
+        inputs = sorted({rnd.choice(available) for _ in range(rnd.randint(1, 2))})
+        width = rnd.choice([8, 16])
+        if len(inputs) > 1:
+            output = g.op(BuiltinOperator.ADD, inputs, (1, width))
+        elif rnd.random() < 0.3:
+            output = g.op(BuiltinOperator.RESHAPE, inputs, tuple(reversed(g.tensors[inputs[0]][0])))
+        else:
+            output = g.op(BuiltinOperator.RELU, inputs, (1, width))
+        consumed.update(inputs)
+        available.append(output)
+    g.outputs += [t for t in available[1:] if t not in consumed]
+    return g
+
+
+def random_concat_graph(seed, num_operators):
+    # Like `random_alias_graph`, with concatenations instead of reshapes, and activations that keep the shape of
+    # their input more often
+    rnd = random.Random(seed)
+    g = GraphBuilder()
+    available = [g.input((1, 8), name="input")]
+    consumed = set()
+    for _ in range(num_operators):
+        inputs = sorted({rnd.choice(available) for _ in range(rnd.randint(1, 3))})
+        width = rnd.choice([8, 16])
+        r = rnd.random()
+        if len(inputs) > 1 and r < 0.5:
+            output = g.op(BuiltinOperator.CONCATENATION, inputs, (1, sum(g.tensors[t][0][1] for t in inputs)),
+                          options=Table("ConcatenationOptions", axis=1))
+        elif len(inputs) > 1:
+            inputs = inputs[:2]
+            output = g.op(BuiltinOperator.ADD, inputs, g.tensors[inputs[0]][0])
+        else:
+            output = g.op(BuiltinOperator.RELU, inputs, g.tensors[inputs[0]][0] if r < 0.7 else (1, width))
+        consumed.update(inputs)
+        available.append(output)
+    g.outputs += [t for t in available[1:] if t not in consumed]
+    return g
+
+
+def chain():
+    g = GraphBuilder()
+    x = g.input((1, 10))
+    a = g.op(BuiltinOperator.RELU, [x], (1, 100))
+    b = g.op(BuiltinOperator.RESHAPE, [a], (100, 1))
+    c = g.op(BuiltinOperator.RELU, [b], (100, 1))
+    g.outputs.append(g.op(BuiltinOperator.RELU, [c], (100, 1)))
+    return g, (x, a, b, c, g.outputs[0])
+
+
+def test_reshapes_and_in_place_operators_share_buffers():
+    g, (x, a, b, c, d) = chain()
+    model = load_model(g, aliasing=True)
+    buffers, owners = model._buffer_lifetimes()
+    # The reshape and both in-place activations reuse the memory of the first activation; the model input is never
+    # overwritten
+    assert owners[a][0] == owners[b][0] == owners[c][0] == owners[d][0] != owners[x][0]
+    assert peak_memory_usage(buffers) == 110
+    assert peak_memory_usage(load_model(g)._buffer_lifetimes()[0]) == 200
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_search_with_aliasing_matches_brute_force(seed):
+    model = load_model(random_alias_graph(seed, 3 + seed % 5), aliasing=True)
+    graph = model.model_graph
+    optimum = min(peak_memory_usage(order_buffers(graph, o, aliasing=True)[0]) for o in topological_orders(graph))
+    peak, op_order = model.peak_mem_usage()
+    assert sorted(op.id for op in op_order) == list(range(len(graph.operators)))
+    assert peak == optimum == peak_memory_usage(order_buffers(graph, op_order, aliasing=True)[0])
+
+
+def concat_graph(activation=ActivationFunctionType.NONE, concat_input=False):
+    # Three branches off the input, joined by a concatenation (which reads the input too with `concat_input`)
+    g = GraphBuilder()
+    x = g.input((1, 4))
+    branches = [g.op(BuiltinOperator.RELU, [x], (1, width)) for width in (10, 20, 30)]
+    options = Table("ConcatenationOptions", axis=-1, fused_activation_function=activation)
+    inputs = branches + [x] if concat_input else branches
+    g.outputs.append(g.op(BuiltinOperator.CONCATENATION, inputs, (1, sum(g.tensors[t][0][1] for t in inputs)),
+                          options=options))
+    return g, branches
+
+
+def test_concatenation_inputs_are_computed_into_the_output():
+    g, branches = concat_graph()
+    model = load_model(g, aliasing=True)
+    concat = model.model_graph.operators[-1]
+    assert concat_inputs(concat) == [model.model_graph.tensors[t] for t in branches]
+
+    plan = model.plan_arena()
+    output = concat.output.id
+    assert [plan.offsets[t] - plan.offsets[output] for t in branches] == [0, 10, 30]
+    assert peak_memory_usage(model._buffer_lifetimes()[0]) == 4 + 60
+    assert peak_memory_usage(model._buffer_lifetimes(concat=False)[0]) == 60 + 60
+
+
+@pytest.mark.parametrize("options", [dict(activation=ActivationFunctionType.RELU), dict(concat_input=True)])
+def test_ineligible_concatenations_copy(options):
+    g, branches = concat_graph(**options)
+    model = load_model(g, aliasing=True)
+    assert concat_inputs(model.model_graph.operators[-1]) is None
+    _, owners = model._buffer_lifetimes()
+    assert len({owners[t][0] for t in branches + g.outputs}) == 4
+
+
+@pytest.mark.parametrize("seed", [99, 214, 273, 292] + list(range(40)))
+def test_concatenations_never_raise_the_peak(seed):
+    # Placing a concatenation's inputs can rule out in-place writes later on, which mustn't make the result worse
+    # than what the search expects
+    model = load_model(random_concat_graph(seed, 3 + seed % 6), aliasing=True)
+    peak, op_order = model.peak_mem_usage()
+    model._apply_order(op_order)
+    assert peak_memory_usage(model._buffer_lifetimes(concat=False)[0]) == peak
+    assert peak_memory_usage(model._buffer_lifetimes()[0]) <= peak
@@ -0,0 +1,98 @@
+import random
+
+import pytest
+
+from graphs import load_model, random_graph
+from tflite_tools.aliasing import peak_memory_usage
+from tflite_tools.arena_planner import STRATEGIES, ArenaOrderSearch, order_buffers, plan_arena
+
+
+def random_buffers(seed, count=30, num_steps=12):
+    rnd = random.Random(seed)
+    buffers = {}
+    for key in range(count):
+        first = rnd.randrange(num_steps)
+        buffers[key] = (rnd.randint(1, 1000), first, rnd.randrange(first, num_steps))
+    return buffers
+
+
+def assert_no_overlaps(buffers, offsets):
+    for a, (size_a, first_a, last_a) in buffers.items():
+        for b, (size_b, first_b, last_b) in buffers.items():
+            if a < b and first_a <= last_b and first_b <= last_a:
+                assert offsets[a] + size_a <= offsets[b] or offsets[b] + size_b <= offsets[a], (a, b)
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+@pytest.mark.parametrize("seed", range(10))
+def test_plan_arena(strategy, seed):
+    buffers = random_buffers(seed)
+    plan = plan_arena(buffers, strategy, alignment=16)
+    assert plan.strategy == strategy
+    assert set(plan.offsets) == set(buffers)
+    assert all(offset % 16 == 0 for offset in plan.offsets.values())
+    assert_no_overlaps(buffers, plan.offsets)
+    assert plan.arena_size == max(plan.offsets[k] + size for k, (size, _, _) in buffers.items())
+    assert plan.arena_size >= peak_memory_usage(buffers)
+
+
+def test_best_strategy_picks_the_smallest_arena():
+    buffers = random_buffers(0)
+    best = plan_arena(buffers, "best")
+    assert best.arena_size == min(plan_arena(buffers, s).arena_size for s in STRATEGIES)
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        plan_arena(random_buffers(0), "first_fit")
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_model_arena_plan(seed):
+    model = load_model(random_graph(seed, 10))
+    buffers, _ = model._buffer_lifetimes()
+    plan = model.plan_arena()
+    in_ram = [t for t in model.model_graph.tensors if not t.is_constant]
+    assert set(plan.offsets) == {t.id for t in in_ram}
+    assert_no_overlaps(buffers, plan.offsets)
+    assert plan.arena_size >= peak_memory_usage(buffers)
+
+
+@pytest.mark.parametrize("aliasing", [False, True])
+@pytest.mark.parametrize("seed", range(10))
+def test_order_buffers_match_the_analysis(seed, aliasing):
+    model = load_model(random_graph(seed, 10), aliasing=aliasing)
+    graph = model.model_graph
+    last_step = len(graph.operators) - 1
+    buffers, owners = model._buffer_lifetimes()
+    assert order_buffers(graph, graph.operators, aliasing) == (
+        {b: (size, first, min(last, last_step)) for b, (size, first, last) in buffers.items()}, owners)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_arena_order_search(seed):
+    model = load_model(random_graph(seed, 10))
+    graph = model.model_graph
+    _, optimal_order = model.peak_mem_usage()
+    initial_size = min(plan_arena(order_buffers(graph, o)[0], "best").arena_size
+                       for o in [optimal_order, graph.operators])
+    search = ArenaOrderSearch(graph, [optimal_order, graph.operators])
+    plan, op_order = search.solve()
+    assert search.complete
+    assert sorted(op.id for op in op_order) == list(range(len(graph.operators)))
+    assert plan.arena_size <= initial_size
+    assert plan == plan_arena(order_buffers(graph, op_order)[0], "best")
+
+
+@pytest.mark.parametrize("max_steps", [None, 30])
+def test_arena_order_search_budget(max_steps):
+    graph = load_model(random_graph(0, 30)).model_graph
+    initial_size = plan_arena(order_buffers(graph, graph.operators)[0], "best").arena_size
+    search = ArenaOrderSearch(graph, [graph.operators], max_steps=max_steps)
+    assert search.max_steps == (max_steps or ArenaOrderSearch.STEPS_PER_OPERATOR * len(graph.operators))
+    plan, op_order = search.solve()
+    assert search.steps <= search.max_steps
+    assert search.complete or search.steps == search.max_steps
+    assert sorted(op.id for op in op_order) == list(range(len(graph.operators)))
+    assert plan.arena_size <= initial_size
+    assert plan == plan_arena(order_buffers(graph, op_order)[0], "best")
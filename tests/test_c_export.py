@@ -0,0 +1,40 @@
+import re
+
+import pytest
+
+from graphs import build_model, random_graph, recompute_graph
+from tflite_tools import TFLiteModel
+
+
+def read_header(path):
+    # Returns the macros and the arrays defined in a header written by `write_c_plan`
+    text = path.read_text()
+    macros = dict(re.findall(r"^#define (\w+) (\S+)$", text, re.M))
+    arrays = {}
+    for name, body in re.findall(r"^static const \w+ (\w+)\[\w+\] = \{\n(.*?)\n\};", text, re.M | re.S):
+        values = re.findall(r"^    (\S+),", body, re.M)
+        arrays[name] = [int(v) if re.fullmatch(r"-?\d+", v) else v for v in values]
+    return macros, arrays
+
+
+@pytest.mark.parametrize("graph, recompute", [(random_graph(0, 10), False), (random_graph(4, 10), False),
+                                              (recompute_graph(), True)])
+def test_header_matches_the_written_model(tmp_path, graph, recompute):
+    model = TFLiteModel(build_model(graph), aliasing=False, scratch=False)
+    if recompute:
+        assert model.recompute_operators()
+    model.optimize_memory()
+    model.write_c_plan(tmp_path / "plan.h")
+    model.write_to_file(tmp_path / "model.tflite")
+
+    written = TFLiteModel.load_from_file(tmp_path / "model.tflite", aliasing=False, scratch=False)
+    plan = written.plan_arena()
+    g = written.model_graph
+    macros, arrays = read_header(tmp_path / "plan.h")
+    assert int(macros["TFLITE_PLAN_ARENA_SIZE"]) == plan.arena_size
+    assert int(macros["TFLITE_PLAN_NUM_OPERATORS"]) == len(g.operators)
+    assert int(macros["TFLITE_PLAN_NUM_TENSORS"]) == len(g.tensors)
+    assert arrays["tflite_plan_operator_order"] == list(range(len(g.operators)))
+    assert arrays["tflite_plan_tensor_offsets"] == [plan.offsets.get(t.id, "TFLITE_PLAN_NOT_IN_ARENA")
+                                                    for t in g.tensors]
+    assert arrays["tflite_plan_tensor_sizes"] == [t.size if t.id in plan.offsets else 0 for t in g.tensors]
@@ -0,0 +1,50 @@
+import pytest
+
+from graphs import load_model, order_peak, random_graph
+from tflite_tools.memo_table import MemoTable
+from tflite_tools.schedule_search import BitmaskScheduleSearch, BranchAndBoundScheduleSearch
+
+
+def chain_table(max_bytes, spill_bytes=0):
+    # Bit i depends on all bits below it
+    return MemoTable([(1 << i) - 1 for i in range(64)], max_bytes, spill_bytes)
+
+
+def test_eviction_keeps_the_table_under_its_limit():
+    table = chain_table(max_bytes=4000)
+    for i in range(64):
+        table[1 << i] = (i, i)
+    assert table.evictions > 0
+    assert table.resident_bytes <= 4000
+    assert table.get(1 << 63) == (63, 63)
+    # Entries with the fewest tensors left to compute go first
+    assert table.get(1) is None
+
+
+def test_lower_bounds_are_evicted_first():
+    table = chain_table(max_bytes=4000)
+    table[1 << 63] = (1, -1)
+    for i in range(40):
+        table[1 << i] = (i, i)
+    assert table.evictions > 0
+    assert table.get(1 << 63) is None
+    assert table.get(1 << 39) == (39, 39)
+
+
+def test_evicted_entries_spill_to_disk():
+    table = chain_table(max_bytes=4000, spill_bytes=1 << 16)
+    for i in range(64):
+        table[1 << i] = (i, i)
+    assert table.spilled == table.evictions > 0
+    assert all(table.get(1 << i) == (i, i) for i in range(64))
+
+
+@pytest.mark.parametrize("spill_limit", [0, 1 << 16])
+def test_search_with_a_bounded_memo_table(spill_limit):
+    graph = load_model(random_graph(5, 14)).model_graph
+    optimum = BitmaskScheduleSearch(graph).solve()[0]
+    search = BranchAndBoundScheduleSearch(graph, initial_orders=[graph.operators], memo_limit=2000,
+                                          spill_limit=spill_limit)
+    peak, op_order = search.solve()
+    assert search.memo.evictions > 0
+    assert (peak, order_peak(graph, op_order)) == (optimum, optimum)
@@ -0,0 +1,147 @@
+import flatbuffers
+import numpy as np
+import pytest
+
+from graphs import GraphBuilder, build_model, load_model, random_graph, recompute_graph
+from tflite_tools import TFLiteModel
+from tflite_tools.model_rewriter import Table, _fields, decode_model, encode_model
+from tflite_tools.tflite import Buffer, Model, Operator, OperatorCode, QuantizationParameters, SubGraph, Tensor
+from tflite_tools.tflite.BuiltinOperator import BuiltinOperator
+from tflite_tools.tflite.Padding import Padding
+from tflite_tools.tflite.TensorType import TensorType
+
+
+def assert_equal(a, b, path="model"):
+    assert type(a) is type(b), path
+    if isinstance(a, Table):
+        assert a.table_type == b.table_type, path
+        for field in _fields(a.table_type):
+            assert_equal(getattr(a, field), getattr(b, field), f"{path}.{field}")
+    elif isinstance(a, list):
+        assert len(a) == len(b), path
+        for k, (x, y) in enumerate(zip(a, b)):
+            assert_equal(x, y, f"{path}[{k}]")
+    elif isinstance(a, np.ndarray):
+        assert a.dtype == b.dtype and np.array_equal(a, b), path
+    else:
+        assert a == b, path
+
+
+def conv_graph():
+    g = GraphBuilder("conv")
+    x = g.input((1, 8, 8, 2), name="input")
+    weights = g.constant(np.arange(4 * 3 * 3 * 2, dtype=np.uint8).reshape(4, 3, 3, 2), name="weights")
+    options = Table("Conv2DOptions", padding=Padding.SAME, stride_w=1, stride_h=1)
+    g.outputs.append(g.op(BuiltinOperator.CONV_2D, [x, weights, -1], (1, 8, 8, 4), options=options))
+    return g
+
+
+def called_graph():
+    g = GraphBuilder("main")
+    x = g.input((1, 1), name="input")
+    g.outputs.append(g.op(BuiltinOperator.CALL, [x], (1, 10), options=Table("CallOptions", subgraph=1)))
+    return g
+
+
+@pytest.mark.parametrize("graphs", [(random_graph(0, 10),), (recompute_graph(),), (conv_graph(),),
+                                    (called_graph(), recompute_graph())])
+def test_round_trip(graphs):
+    model_bytes = build_model(*graphs)
+    decoded = decode_model(model_bytes)
+    encoded = encode_model(decoded)
+    assert_equal(decode_model(encoded), decoded)
+
+    original, rewritten = (TFLiteModel(b, aliasing=True, scratch=True) for b in (model_bytes, encoded))
+    assert rewritten.peak_mem_usage()[0] == original.peak_mem_usage()[0]
+    assert rewritten._buffer_lifetimes() == original._buffer_lifetimes()
+
+
+def test_rewrite():
+    model = load_model(random_graph(1, 6))
+    peak = model.peak_mem_usage()[0]
+    tree = model.decode()
+    tree.description = "rewritten"
+    model.rewrite(tree)
+    assert model.model_graph is None
+    assert decode_model(model.model_bytes).description == b"rewritten"
+    assert model.peak_mem_usage()[0] == peak
+
+
+def test_copy_shares_unchanged_fields():
+    tensor = decode_model(build_model(conv_graph())).subgraphs[0].tensors[0]
+    copy = tensor.copy(name="copy")
+    assert copy.name == "copy" and tensor.name == b"input"
+    assert copy.shape is tensor.shape and copy.type == tensor.type
+
+
+def per_channel_model(quantized_dimension):
+    # A RELU of a tensor with per-channel quantization, written with a newer schema whose QuantizationParameters have
+    # `details_type`, `details` and `quantized_dimension` fields after the bundled ones
+    builder = flatbuffers.Builder(0)
+
+    def vector(values, prepend=builder.PrependInt32):
+        builder.StartVector(4, len(values), 4)
+        for v in reversed(values):
+            prepend(v)
+        return builder.EndVector()
+
+    scale = vector([0.5, 0.25], builder.PrependFloat32)
+    builder.StartObject(7)
+    QuantizationParameters.QuantizationParametersAddScale(builder, scale)
+    builder.PrependInt32Slot(6, quantized_dimension, 0)
+    quantization = builder.EndObject()
+
+    tensors = []
+    for name in [b"input", b"output"]:
+        name, shape = builder.CreateString(name), vector([1, 2])
+        Tensor.TensorStart(builder)
+        Tensor.TensorAddShape(builder, shape)
+        Tensor.TensorAddType(builder, TensorType.UINT8)
+        Tensor.TensorAddName(builder, name)
+        Tensor.TensorAddQuantization(builder, quantization)
+        tensors.append(Tensor.TensorEnd(builder))
+    inputs, outputs = vector([0]), vector([1])
+    Operator.OperatorStart(builder)
+    Operator.OperatorAddInputs(builder, inputs)
+    Operator.OperatorAddOutputs(builder, outputs)
+    operator = Operator.OperatorEnd(builder)
+
+    tensors = vector(tensors, builder.PrependUOffsetTRelative)
+    operators = vector([operator], builder.PrependUOffsetTRelative)
+    inputs, outputs = vector([0]), vector([1])
+    SubGraph.SubGraphStart(builder)
+    SubGraph.SubGraphAddTensors(builder, tensors)
+    SubGraph.SubGraphAddInputs(builder, inputs)
+    SubGraph.SubGraphAddOutputs(builder, outputs)
+    SubGraph.SubGraphAddOperators(builder, operators)
+    subgraph = SubGraph.SubGraphEnd(builder)
+
+    OperatorCode.OperatorCodeStart(builder)
+    OperatorCode.OperatorCodeAddBuiltinCode(builder, BuiltinOperator.RELU)
+    OperatorCode.OperatorCodeAddVersion(builder, 1)
+    operator_code = OperatorCode.OperatorCodeEnd(builder)
+    Buffer.BufferStart(builder)
+    buffer = Buffer.BufferEnd(builder)
+
+    subgraphs, operator_codes, buffers = (vector([t], builder.PrependUOffsetTRelative)
+                                          for t in (subgraph, operator_code, buffer))
+    Model.ModelStart(builder)
+    Model.ModelAddVersion(builder, 3)
+    Model.ModelAddOperatorCodes(builder, operator_codes)
+    Model.ModelAddSubgraphs(builder, subgraphs)
+    Model.ModelAddBuffers(builder, buffers)
+    builder.Finish(Model.ModelEnd(builder), file_identifier=b"TFL3")
+    return builder.Output()
+
+
+def test_newer_fields_are_not_dropped():
+    # A quantized dimension of 0 is the default, which isn't stored
+    decoded = decode_model(per_channel_model(0))
+    assert_equal(decode_model(encode_model(decoded)), decoded)
+    assert decoded.subgraphs[0].tensors[0].quantization.scale.tolist() == [0.5, 0.25]
+
+    # The model can still be analysed, but not rewritten (e.g. to recompute or tile operators)
+    model = TFLiteModel(per_channel_model(1))
+    assert model.peak_mem_usage()[0] == 4
+    with pytest.raises(NotImplementedError, match="QuantizationParameters"):
+        model.decode()
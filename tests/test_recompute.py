@@ -0,0 +1,76 @@
+import pytest
+
+from graphs import GraphBuilder, load_model, order_peak, random_graph, recompute_graph
+from tflite_tools import TFLiteModel
+from tflite_tools.model_rewriter import Table
+from tflite_tools.recompute import Recomputation, operator_macs, recompute, recompute_candidates
+from tflite_tools.tflite import Model
+from tflite_tools.tflite.BuiltinOperator import BuiltinOperator
+
+
+def test_recompute_candidates():
+    graph = load_model(recompute_graph()).model_graph
+    a = graph.operators[0].output
+    assert recompute_candidates(graph, graph.operators) == [Recomputation(a.id, [4])]
+    assert recompute_candidates(graph, graph.operators, max_operator_macs=operator_macs(graph.operators[0]) - 1) == []
+
+
+def test_recompute():
+    model = load_model(recompute_graph())
+    graph = model.model_graph
+    candidate, = recompute_candidates(graph, graph.operators)
+    rewritten = load_model(recompute_graph())
+    rewritten.model_bytes = recompute(model.model_bytes, graph, candidate)
+    rewritten._build_graph()
+    g = rewritten.model_graph
+    assert [op.opcode for op in g.operators] == [BuiltinOperator.RELU] * 5 + [BuiltinOperator.ADD]
+    # The copy is computed from the model input right before the last reader
+    duplicate, last = g.operators[4:]
+    assert duplicate.inputs == [g.inputs[0]]
+    assert duplicate.output.name == f"{graph.tensors[candidate.tensor].name}/recomputed"
+    assert last.inputs == [g.operators[3].output, duplicate.output]
+    assert order_peak(graph, graph.operators) == 1110
+    assert order_peak(g, g.operators) == 1011
+
+
+def test_recompute_operators():
+    model = load_model(recompute_graph())
+    applied = model.recompute_operators()
+    assert applied == [("t1", 1, 100, 99)]
+    assert model.peak_mem_usage()[0] == 1011
+    assert len(model.model_graph.operators) == 6
+
+
+def test_recompute_operators_with_a_macs_budget():
+    model = load_model(recompute_graph())
+    assert model.recompute_operators(max_extra_macs=99) == []
+    assert model.peak_mem_usage()[0] == 1110
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_recomputation_never_raises_the_peak(seed):
+    model = load_model(random_graph(seed, 8))
+    peak = model.peak_mem_usage()[0]
+    applied = model.recompute_operators()
+    assert model.peak_mem_usage()[0] == peak - sum(saved for _, _, _, saved in applied)
+
+
+def called_graph_model():
+    # The main subgraph runs `recompute_graph` as subgraph 1
+    g = GraphBuilder()
+    x = g.input((1, 1), name="input")
+    g.outputs.append(g.op(BuiltinOperator.CALL, [x], (1, 10), options=Table("CallOptions", subgraph=1)))
+    return load_model(g, recompute_graph())
+
+
+def test_recompute_operators_in_another_subgraph():
+    model = called_graph_model()
+    callee = model.subgraph_model(1)
+    assert callee.recompute_operators() == [("t1", 1, 100, 99)]
+    assert callee.peak_mem_usage()[0] == 1011
+
+    rewritten = Model.Model.GetRootAsModel(callee.model_bytes, 0)
+    assert [rewritten.Subgraphs(k).OperatorsLength() for k in range(2)] == [1, 6]
+    main = TFLiteModel(callee.model_bytes, aliasing=False, scratch=False)
+    main._build_graph()
+    assert [op.opcode for op in main.model_graph.operators] == [BuiltinOperator.CALL]
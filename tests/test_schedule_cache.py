@@ -0,0 +1,83 @@
+import json
+import os
+
+from graphs import load_model, random_graph
+from tflite_tools.schedule_cache import ScheduleCache, graph_hash
+from tflite_tools.schedule_search import BitmaskScheduleSearch
+
+
+def test_graph_hash_ignores_names_and_weights():
+    g = random_graph(0, 6)
+    graph = load_model(g).model_graph
+    g.tensors = [(shape, type, "retrained/" + name, data + 1 if data is not None else None)
+                 for shape, type, name, data in g.tensors]
+    assert graph_hash(load_model(g).model_graph) == graph_hash(graph)
+    assert graph_hash(graph, {"aliasing": True}) != graph_hash(graph)
+
+    g.tensors[-1] = ((1, 1000),) + g.tensors[-1][1:]
+    assert graph_hash(load_model(g).model_graph) != graph_hash(graph)
+
+
+def test_store_and_load(tmp_path):
+    graph = load_model(random_graph(1, 6)).model_graph
+    cache = ScheduleCache(tmp_path)
+    assert cache.load(graph) is None
+
+    peak, op_order = BitmaskScheduleSearch(graph).solve()
+    cache.store(graph, peak, op_order, {"aliasing": False})
+    assert cache.load(graph) is None
+    assert cache.load(graph, {"aliasing": False}) == (peak, op_order)
+
+
+def test_invalid_entries_are_ignored(tmp_path):
+    graph = load_model(random_graph(2, 6)).model_graph
+    cache = ScheduleCache(tmp_path)
+    cache.store(graph, 1, list(reversed(graph.operators)))
+    assert cache.load(graph) is None
+
+    path = next(tmp_path.glob("*.json"))
+    path.write_text("{")
+    assert cache.load(graph) is None
+    path.write_text(json.dumps({"peak": 1}))
+    assert cache.load(graph) is None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    graphs = [load_model(random_graph(seed, 6)).model_graph for seed in range(3)]
+    cache = ScheduleCache(tmp_path, max_entries=2)
+    for k, graph in enumerate(graphs):
+        cache.store(graph, 1, graph.operators)
+        # File times can be too coarse to tell entries written in a row apart
+        os.utime(tmp_path / f"{graph_hash(graph)}.json", (k, k))
+    assert len(list(tmp_path.glob("*.json"))) == 2
+    assert cache.load(graphs[0]) is None
+    assert cache.load(graphs[2]) is not None
+
+
+def test_peak_mem_usage_uses_the_cache(tmp_path):
+    g = random_graph(3, 8)
+    cache = ScheduleCache(tmp_path)
+    model = load_model(g)
+    result = model.peak_mem_usage(cache=cache)
+    assert model.search_stats is not None
+
+    cached = load_model(g)
+    peak, op_order = cached.peak_mem_usage(cache=cache)
+    assert cached.search_stats is None
+    assert (peak, [op.id for op in op_order]) == (result[0], [op.id for op in result[1]])
+
+
+def test_ram_budget_keeps_the_model_order_over_the_cached_one(tmp_path):
+    # The order in the model file needs 503 B and the optimal one 431 B
+    g = random_graph(3, 8)
+    cache = ScheduleCache(tmp_path)
+    assert load_model(g).peak_mem_usage(cache=cache)[0] == 431
+
+    model = load_model(g)
+    peak, op_order = model.peak_mem_usage(cache=cache, ram_budget=503)
+    assert (peak, op_order) == (503, model.model_graph.operators)
+    assert model.peak_mem_usage(cache=cache, ram_budget=502) == model.peak_mem_usage(cache=cache)
+
+    model_bytes = bytes(model.model_bytes)
+    model.optimize_memory(cache=cache, ram_budget=503)
+    assert bytes(model.model_bytes) == model_bytes
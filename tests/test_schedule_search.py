@@ -0,0 +1,208 @@
+import random
+
+import pytest
+
+from graphs import GraphBuilder, brute_force_peak, load_model, order_peak, random_graph
+from tflite_tools.schedule_search import BitmaskScheduleSearch, BranchAndBoundScheduleSearch, ParallelScheduleSearch, \
+    SearchPool, SegmentedScheduleSearch, find_cut_points, transitive_closure
+from tflite_tools.tflite.BuiltinOperator import BuiltinOperator
+
+
+def assert_valid_order(graph, op_order):
+    assert sorted(op.id for op in op_order) == list(range(len(graph.operators)))
+    done = set()
+    for op in op_order:
+        assert all(t.producer is None or t.producer in done for t in op.inputs)
+        done.add(op)
+
+
+def branches_graph():
+    # Two branches off the input: computing the large one first frees it before the small one is computed
+    g = GraphBuilder()
+    x = g.input((1, 10))
+    small = g.op(BuiltinOperator.RELU, [x], (1, 10))
+    large = g.op(BuiltinOperator.RELU, [x], (1, 100))
+    reduced = g.op(BuiltinOperator.RELU, [large], (1, 5))
+    g.outputs.append(g.op(BuiltinOperator.ADD, [small, reduced], (1, 5)))
+    return g
+
+
+def test_bitmask_search_reorders_branches():
+    graph = load_model(branches_graph()).model_graph
+    assert BitmaskScheduleSearch(graph).evaluate_order(graph.operators)[0] == 10 + 10 + 100
+    peak, op_order = BitmaskScheduleSearch(graph).solve()
+    assert peak == 10 + 100 + 5
+    assert [op.id for op in op_order] == [1, 2, 0, 3]
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_bitmask_search_matches_brute_force(seed):
+    graph = load_model(random_graph(seed, 3 + seed % 5)).model_graph
+    peak, op_order = BitmaskScheduleSearch(graph).solve()
+    assert peak == brute_force_peak(graph)
+    assert_valid_order(graph, op_order)
+    assert order_peak(graph, op_order) == peak
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_evaluate_order_matches_tensor_lifetimes(seed):
+    graph = load_model(random_graph(seed, 8)).model_graph
+    assert BitmaskScheduleSearch(graph).evaluate_order(graph.operators)[0] == order_peak(graph, graph.operators)
+
+
+def shared_input_graph():
+    # A model input that's read at the start and at the end of the graph: it's counted once, until its last reader
+    g = GraphBuilder()
+    x = g.input((1, 50))
+    a = g.op(BuiltinOperator.RELU, [x], (1, 10))
+    b = g.op(BuiltinOperator.RELU, [x], (1, 80))
+    c = g.op(BuiltinOperator.ADD, [a, b], (1, 20))
+    d = g.op(BuiltinOperator.RELU, [c], (1, 30))
+    g.outputs.append(g.op(BuiltinOperator.ADD, [d, x], (1, 5)))
+    return g
+
+
+@pytest.mark.parametrize("search", [BitmaskScheduleSearch, SegmentedScheduleSearch])
+def test_model_inputs_with_several_readers(search):
+    model = load_model(shared_input_graph())
+    graph = model.model_graph
+    peak, op_order = search(graph).solve()
+    assert peak == brute_force_peak(graph) == order_peak(graph, op_order) == 50 + 10 + 80 + 20
+    model.optimize_memory()
+    assert max(mem_use for _, _, mem_use in model._execution_schedule_info()) == peak
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_branch_and_bound_matches_brute_force(seed):
+    graph = load_model(random_graph(seed, 3 + seed % 5)).model_graph
+    search = BranchAndBoundScheduleSearch(graph, initial_orders=[graph.operators])
+    peak, op_order = search.solve()
+    assert peak == brute_force_peak(graph)
+    assert search.complete and search.lower_bound == peak
+    assert_valid_order(graph, op_order)
+    assert order_peak(graph, op_order) == peak
+
+
+def test_branch_and_bound_prunes():
+    graph = load_model(random_graph(0, 12)).model_graph
+    exhaustive = BitmaskScheduleSearch(graph)
+    search = BranchAndBoundScheduleSearch(graph, initial_orders=[graph.operators])
+    assert search.solve()[0] == exhaustive.solve()[0]
+    assert search.pruned > 0
+    assert search.explored < len(exhaustive.memo)
+
+
+@pytest.mark.parametrize("max_states", [0, 5])
+def test_search_budget_returns_best_order_so_far(max_states):
+    graph = load_model(random_graph(3, 14)).model_graph
+    optimum = BitmaskScheduleSearch(graph).solve()[0]
+    search = BranchAndBoundScheduleSearch(graph, initial_orders=[graph.operators], max_states=max_states)
+    peak, op_order = search.solve()
+    assert not search.complete
+    assert_valid_order(graph, op_order)
+    assert order_peak(graph, op_order) == peak
+    assert search.lower_bound <= optimum <= peak <= order_peak(graph, graph.operators)
+
+
+def blocks_graph(seed, num_blocks):
+    # A chain of inception-like blocks: parallel branches off the previous block's output, joined by a concatenation
+    rnd = random.Random(seed)
+    g = GraphBuilder()
+    x = g.input((1, rnd.randint(1, 64)))
+    joins = []
+    for _ in range(num_blocks):
+        ends = []
+        for _ in range(rnd.randint(2, 3)):
+            t = x
+            for _ in range(rnd.randint(1, 2)):
+                t = g.op(BuiltinOperator.RELU, [t], (1, rnd.randint(1, 100)))
+            ends.append(t)
+        x = g.op(BuiltinOperator.CONCATENATION, ends, (1, rnd.randint(1, 100)))
+        joins.append(x)
+    g.outputs.append(x)
+    return g, joins
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_cut_points_are_block_outputs(seed):
+    g, joins = blocks_graph(seed, 4)
+    graph = load_model(g).model_graph
+    assert [t.id for t in find_cut_points(graph, graph.operators)] == joins[:-1]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_segmented_search_matches_whole_graph_search(seed):
+    graph = load_model(blocks_graph(seed, 4)[0]).model_graph
+    search = SegmentedScheduleSearch(graph, initial_orders=[graph.operators])
+    assert len(search.segments) == 4
+    peak, op_order = search.solve()
+    assert peak == BitmaskScheduleSearch(graph).solve()[0]
+    assert search.complete and search.lower_bound == peak
+    assert_valid_order(graph, op_order)
+    assert order_peak(graph, op_order) == peak
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_initial_orders_are_split_by_segment(seed):
+    graph = load_model(blocks_graph(seed, 4)[0]).model_graph
+    orders = [graph.operators, BitmaskScheduleSearch(graph).solve()[1]]
+    search = SegmentedScheduleSearch(graph, initial_orders=orders)
+    for _, segment, initial_orders in search.segments:
+        assert initial_orders == [[op for op in order if op in segment.operators] for order in orders]
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_segmented_search_matches_brute_force(seed):
+    graph = load_model(random_graph(seed, 3 + seed % 5)).model_graph
+    peak, op_order = SegmentedScheduleSearch(graph, initial_orders=[graph.operators]).solve()
+    assert peak == brute_force_peak(graph)
+    assert order_peak(graph, op_order) == peak
+
+
+def test_parallel_search_matches_serial_search():
+    graphs = [load_model(random_graph(seed, 12)).model_graph for seed in range(4)]
+    with SearchPool(2) as pool:
+        for graph in graphs:
+            search = ParallelScheduleSearch(graph, pool, initial_orders=[graph.operators])
+            peak, op_order = search.solve()
+            assert peak == BranchAndBoundScheduleSearch(graph, initial_orders=[graph.operators]).solve()[0]
+            assert search.complete
+            assert_valid_order(graph, op_order)
+            assert order_peak(graph, op_order) == peak
+
+
+def test_segmented_search_hands_large_segments_to_workers(monkeypatch):
+    parallel_searches = []
+    solve = ParallelScheduleSearch.solve
+    monkeypatch.setattr(ParallelScheduleSearch, "solve", lambda self: parallel_searches.append(self) or solve(self))
+    monkeypatch.setattr(SegmentedScheduleSearch, "PARALLEL_SEARCH_THRESHOLD", 2)
+    graph = load_model(random_graph(0, 12)).model_graph
+    search = SegmentedScheduleSearch(graph, initial_orders=[graph.operators], jobs=2)
+    peak, op_order = search.solve()
+    assert parallel_searches
+    assert peak == BitmaskScheduleSearch(graph).solve()[0]
+    assert search.complete
+    assert order_peak(graph, op_order) == peak
+
+
+def test_transitive_closure():
+    # 0 <- 1 <- 3, 0 <- 2 <- 3, 4 on its own
+    assert transitive_closure([0, 1 << 0, 1 << 0, (1 << 1) | (1 << 2), 0]) == [0, 0b1, 0b1, 0b111, 0]
+
+
+def test_transitive_closure_of_deep_graphs():
+    depth = 20000
+    closure = transitive_closure([0] + [1 << (i - 1) for i in range(1, depth)])
+    assert closure[-1] == (1 << (depth - 1)) - 1
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_predecessor_masks(seed):
+    graph = load_model(random_graph(seed, 10)).model_graph
+
+    def predecessors(t):
+        direct = set(t.producer.inputs) if t.producer is not None else set()
+        return direct.union(*(predecessors(i) for i in direct))
+
+    for t in graph.tensors:
+        assert t.predecessor_mask == sum(1 << i.id for i in predecessors(t))
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from graphs import GraphBuilder, brute_force_peak, load_model, order_peak, random_graph
+from tflite_tools.model_rewriter import Table
+from tflite_tools import scratch
+from tflite_tools.scratch import ScratchBuffer, register_scratch_size
+from tflite_tools.tflite.BuiltinOperator import BuiltinOperator
+from tflite_tools.tflite.Padding import Padding
+from tflite_tools.tflite.TensorType import TensorType
+
+
+def conv_model(kernel, stride=1, padding=Padding.VALID, type=TensorType.UINT8):
+    g = GraphBuilder()
+    x = g.input((1, 8, 8, 4), type)
+    weights = g.constant(np.zeros((6, kernel, kernel, 4), dtype=np.uint8), type)
+    options = Table("Conv2DOptions", padding=padding, stride_w=stride, stride_h=stride)
+    size = (8 - kernel) // stride + 1
+    g.outputs.append(g.op(BuiltinOperator.CONV_2D, [x, weights], (1, size, size, 6), options=options, type=type))
+    return load_model(g, scratch=True)
+
+
+@pytest.mark.parametrize("kernel, stride, type, expected", [
+    (3, 1, TensorType.UINT8, 2 * 2 * 4 * 3 * 3),
+    (1, 1, TensorType.UINT8, 0),
+    (1, 2, TensorType.UINT8, 2 * 2 * 4),
+    (3, 1, TensorType.FLOAT32, 0),
+])
+def test_conv_scratch_size(kernel, stride, type, expected):
+    model = conv_model(kernel, stride, type=type)
+    op = model.model_graph.operators[0]
+    assert op.scratch_size == expected
+    assert model._execution_schedule_info()[0][2] == sum(t.size for t in model.model_graph.tensors) + expected
+    plan = model.plan_arena()
+    assert (ScratchBuffer(op.id) in plan.offsets) == (expected > 0)
+
+
+@pytest.fixture
+def elementwise_scratch(monkeypatch):
+    # Gives the operators of `graphs.random_graph` scratch buffers half as large as their outputs
+    monkeypatch.setattr(scratch, "SCRATCH_SIZE_MODELS", dict(scratch.SCRATCH_SIZE_MODELS))
+    for opcode in (BuiltinOperator.ADD, BuiltinOperator.RELU, BuiltinOperator.SPLIT):
+        register_scratch_size(opcode)(lambda op: sum(t.size for t in op.outputs) // 2)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_search_accounts_for_scratch_buffers(elementwise_scratch, seed):
+    model = load_model(random_graph(seed, 3 + seed % 5), scratch=True)
+    graph = model.model_graph
+    assert all(op.scratch_size for op in graph.operators)
+    peak, op_order = model.peak_mem_usage()
+    assert peak == brute_force_peak(graph) == order_peak(graph, op_order)
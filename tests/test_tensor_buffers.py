@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from graphs import GraphBuilder, load_model
+from tflite_tools.tflite import Model
+from tflite_tools.tflite.BuiltinOperator import BuiltinOperator
+from tflite_tools.tflite.TensorType import TensorType
+from tflite_tools.tflite_model import INT8, TENSOR_DTYPES, get_buffer_as_numpy, get_buffer_element_size
+
+
+TYPES = [TensorType.FLOAT32, TensorType.FLOAT16, TensorType.INT32, TensorType.UINT8, TensorType.INT64,
+         TensorType.BOOL, TensorType.INT16, TensorType.COMPLEX64, INT8]
+
+
+def constant_model(type, data):
+    g = GraphBuilder()
+    x = g.input(data.shape, type)
+    g.outputs.append(g.op(BuiltinOperator.ADD, [x, g.constant(data, type, name="weights")], data.shape, type=type))
+    return load_model(g)
+
+
+@pytest.mark.parametrize("type", TYPES)
+def test_buffer_views(type):
+    dtype = TENSOR_DTYPES[type]
+    data = (np.arange(12) % 2).astype(dtype).reshape(3, 4)
+    model = constant_model(type, data)
+    assert get_buffer_element_size(type) == dtype.itemsize
+
+    m = Model.Model.GetRootAsModel(model.model_bytes, 0)
+    tensor = m.Subgraphs(0).Tensors(1)
+    view = get_buffer_as_numpy(tensor, m.Buffers(tensor.Buffer()))
+    assert view.dtype == dtype and view.shape == (3, 4)
+    np.testing.assert_array_equal(view, data)
+    # A view of the model, not a copy
+    assert np.shares_memory(view, np.frombuffer(model.model_bytes, dtype=np.uint8))
+    view[0, 0] = 1
+    view = get_buffer_as_numpy(tensor, m.Buffers(tensor.Buffer()))
+    assert view[0, 0] == 1
+
+
+def test_constant_buffers_write_to_the_model():
+    model = constant_model(TensorType.FLOAT32, np.full((2, 2), 0.5, dtype=np.float32))
+    (_, name, weights), = model.constant_buffers()
+    assert name == "weights" and weights.dtype == np.float32
+    weights *= 2
+    (_, _, weights), = model.constant_buffers()
+    np.testing.assert_array_equal(weights, np.ones((2, 2)))
+
+
+def test_cluster_weights():
+    pytest.importorskip("sklearn")
+    g = GraphBuilder()
+    x = g.input((1, 4, 4, 2))
+    weights = g.constant(np.arange(3 * 3 * 3 * 2, dtype=np.uint8).reshape(3, 3, 3, 2))
+    g.outputs.append(g.op(BuiltinOperator.CONV_2D, [x, weights], (1, 2, 2, 3)))
+    model = load_model(g)
+    model.cluster_weights(4)
+    (_, _, clustered), = model.constant_buffers()
+    assert len(np.unique(clustered)) <= 4
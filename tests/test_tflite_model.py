@@ -0,0 +1,102 @@
+import mmap
+
+import numpy as np
+import pytest
+
+from graphs import GraphBuilder, load_model, order_peak, random_graph
+from tflite_tools import TFLiteModel
+from tflite_tools.tflite.BuiltinOperator import BuiltinOperator
+
+
+def working_sets(graph):
+    # Tensors in memory at each step of the current operator order, see `graphs.order_peak`
+    steps = [set() for _ in graph.operators]
+    for t in graph.tensors:
+        if t.is_constant or not t.size:
+            continue
+        first = t.producer.id if t.producer is not None else 0
+        last = len(steps) - 1 if t in graph.outputs else max((op.id for op in t.consumers), default=first)
+        for k in range(first, last + 1):
+            steps[k].add(t)
+    return steps
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_execution_schedule(seed):
+    model = load_model(random_graph(seed, 10))
+    graph = model.model_graph
+    schedule = model._execution_schedule_info()
+    assert [op for op, _, _ in schedule] == graph.operators
+    for (_, tensors, mem_use), expected in zip(schedule, working_sets(graph)):
+        assert {t for t in tensors if t.size} == expected
+        assert mem_use == sum(t.size for t in expected)
+    assert max(mem_use for _, _, mem_use in schedule) == order_peak(graph, graph.operators)
+
+
+def assert_columns_match_views(graph):
+    columns = graph.columns
+    assert columns.sizes.tolist() == [t.size for t in graph.tensors]
+    assert columns.types.tolist() == [t.type for t in graph.tensors]
+    assert columns.producers.tolist() == [t.producer.id if t.producer is not None else -1 for t in graph.tensors]
+    for t in graph.tensors:
+        consumers = columns.consumers[columns.consumer_offsets[t.id]:columns.consumer_offsets[t.id + 1]]
+        assert sorted(consumers.tolist()) == sorted(op.id for op in t.consumers)
+    for op in graph.operators:
+        outputs = columns.outputs[columns.output_offsets[op.id]:columns.output_offsets[op.id + 1]]
+        assert outputs.tolist() == [t.id for t in op.outputs]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_columns_match_views(seed):
+    model = load_model(random_graph(seed, 10))
+    assert_columns_match_views(model.model_graph)
+    assert all(model.model_graph.columns.sizes[t.id] == 0 for t in model.model_graph.tensors if t.is_constant)
+
+    # Reordering operators renumbers them in the columns too
+    model.optimize_memory()
+    assert_columns_match_views(model.model_graph)
+    reloaded = TFLiteModel(model.model_bytes, aliasing=False, scratch=False)
+    reloaded._build_graph()
+    assert_columns_match_views(reloaded.model_graph)
+    assert model._buffer_lifetimes() == reloaded._buffer_lifetimes()
+
+
+@pytest.mark.parametrize("aliasing, scratch", [(False, False), (True, True)])
+def test_omitted_optional_inputs(aliasing, scratch):
+    # A fully-connected layer without bias, which is an optional input left out with id -1
+    g = GraphBuilder()
+    x = g.input((1, 16))
+    weights = g.constant(np.ones((8, 16), dtype=np.uint8))
+    y = g.op(BuiltinOperator.FULLY_CONNECTED, [x, weights, -1], (1, 8))
+    g.outputs.append(g.op(BuiltinOperator.RELU, [y], (1, 8)))
+    model = load_model(g, aliasing=aliasing, scratch=scratch)
+    graph = model.model_graph
+    assert [t.id for t in graph.operators[0].inputs] == [x, weights]
+    assert_columns_match_views(graph)
+    assert model.peak_mem_usage()[0] == max(mem_use for _, _, mem_use in model._execution_schedule_info())
+    assert model.plan_arena().arena_size >= 16 + 8
+
+
+def test_overwrite_the_mapped_model_file(tmp_path):
+    path = tmp_path / "model.tflite"
+    path.write_bytes(load_model(random_graph(0, 10)).model_bytes)
+    model = TFLiteModel.load_from_file(path, aliasing=False, scratch=False)
+    model.optimize_memory()
+    optimized = bytes(model.model_bytes)
+    # Through a link, too
+    (tmp_path / "link.tflite").symlink_to(path)
+    model.write_to_file(tmp_path / "link.tflite")
+    assert not isinstance(model.model_bytes, mmap.mmap)
+    assert path.read_bytes() == optimized
+
+
+def test_write_the_mapped_model_to_another_file(tmp_path):
+    path = tmp_path / "model.tflite"
+    path.write_bytes(load_model(random_graph(0, 10)).model_bytes)
+    model = TFLiteModel.load_from_file(path, aliasing=False, scratch=False)
+    model.optimize_memory()
+    output_path = tmp_path / "output.tflite"
+    output_path.write_bytes(b"old model")
+    model.write_to_file(output_path)
+    assert isinstance(model.model_bytes, mmap.mmap)
+    assert output_path.read_bytes() == bytes(model.model_bytes) != path.read_bytes()
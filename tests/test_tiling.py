@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from graphs import GraphBuilder, load_model
+from tflite_tools.aliasing import peak_memory_usage
+from tflite_tools.model_rewriter import Table
+from tflite_tools.tflite import Model
+from tflite_tools.tflite.BuiltinOperator import BuiltinOperator
+from tflite_tools.tflite.Padding import Padding
+from tflite_tools.tiling import Window, chain_parts, tile, tile_chains, tile_rows, window
+
+
+def conv_chain_graph():
+    # Two 3x3 SAME convolutions and a 2x2 max pool over a 16x16 image: the intermediate tensors are the largest
+    g = GraphBuilder()
+    x = g.input((1, 16, 16, 2), name="input")
+    conv = Table("Conv2DOptions", padding=Padding.SAME, stride_w=1, stride_h=1, dilation_w_factor=1,
+                 dilation_h_factor=1)
+    a = g.op(BuiltinOperator.CONV_2D, [x, g.constant(np.zeros((8, 3, 3, 2), dtype=np.uint8))], (1, 16, 16, 8),
+             options=conv)
+    b = g.op(BuiltinOperator.CONV_2D, [a, g.constant(np.zeros((8, 3, 3, 8), dtype=np.uint8))], (1, 16, 16, 8),
+             options=conv)
+    pool = Table("Pool2DOptions", padding=Padding.VALID, stride_w=2, stride_h=2, filter_width=2, filter_height=2)
+    g.outputs.append(g.op(BuiltinOperator.MAX_POOL_2D, [b], (1, 8, 8, 8), options=pool))
+    return g
+
+
+def test_windows():
+    graph = load_model(conv_chain_graph()).model_graph
+    conv, _, pool = graph.operators
+    assert window(conv, 1) == window(conv, 2) == Window(3, 1, 1, 1)
+    assert window(pool, 1) == Window(2, 2, 0, 0)
+
+
+def test_tile_chains():
+    graph = load_model(conv_chain_graph()).model_graph
+    chain = graph.operators
+    assert tile_chains(graph) == [chain]
+    assert chain_parts([chain]) == [chain[:2], chain, chain[1:]]
+    assert tile_chains(graph, exclude={chain[1].output.id}) == []
+
+
+def test_tile_rows():
+    chain = load_model(conv_chain_graph()).model_graph.operators
+    # Output rows 0-3 of the pool read rows 0-7 of the second convolution's output, which reads rows 0-8 of the first
+    # one's (padded above), which reads rows 0-9 of the input (padded above)
+    assert tile_rows(chain, (0, 4)) == [(0, 10, 1, 0), (0, 9, 1, 0), (0, 8, 0, 0)]
+    assert tile_rows(chain, (4, 8)) == [(6, 16, 0, 1), (7, 16, 0, 1), (8, 16, 0, 0)]
+
+
+@pytest.mark.parametrize("num_tiles", [2, 3, 8])
+def test_tile(num_tiles):
+    model = load_model(conv_chain_graph())
+    graph = model.model_graph
+    tiled = load_model(conv_chain_graph())
+    tiled.model_bytes = tile(model.model_bytes, graph, graph.operators, num_tiles)
+    tiled._build_graph()
+    g = tiled.model_graph
+    assert [t.id for t in g.inputs] == [t.id for t in graph.inputs]
+    assert [t.id for t in g.outputs] == [t.id for t in graph.outputs]
+    concat = g.outputs[0].producer
+    assert concat.opcode == BuiltinOperator.CONCATENATION and len(concat.inputs) == num_tiles
+    assert sum(t.shape[1] for t in concat.inputs) == 8
+    assert all(tuple(t.shape[2:]) == (8, 8) for t in concat.inputs)
+    assert sum(op.opcode == BuiltinOperator.STRIDED_SLICE for op in g.operators) == num_tiles
+    assert sum(op.opcode == BuiltinOperator.CONV_2D for op in g.operators) == 2 * num_tiles
+    assert peak_memory_usage(tiled._buffer_lifetimes()[0]) < peak_memory_usage(model._buffer_lifetimes()[0])
+
+
+def test_tile_operators():
+    model = load_model(conv_chain_graph())
+    peak = model.peak_mem_usage()[0]
+    applied = model.tile_operators(max_tiles=4)
+    assert len(applied) == 1
+    first, last, num_tiles, extra_macs, saved = applied[0]
+    assert extra_macs > 0 and saved > 0
+    assert peak_memory_usage(model._buffer_lifetimes()[0]) == peak - saved
+
+
+def test_tile_operators_meets_the_budget_with_the_fewest_macs():
+    model = load_model(conv_chain_graph())
+    peak = model.peak_mem_usage()[0]
+    # Tiling the whole chain in two meets the budget too, but computes more halo rows
+    applied = model.tile_operators(ram_budget=peak - 1, max_tiles=4)
+    assert [(first, last, num_tiles) for first, last, num_tiles, _, _ in applied] == [("t4", "t5", 4)]
+    assert peak_memory_usage(model._buffer_lifetimes()[0]) <= peak - 1
+
+
+def test_tile_operators_in_another_subgraph():
+    g = GraphBuilder()
+    x = g.input((1, 16, 16, 2), name="input")
+    g.outputs.append(g.op(BuiltinOperator.CALL, [x], (1, 8, 8, 8), options=Table("CallOptions", subgraph=1)))
+    callee = load_model(g, conv_chain_graph()).subgraph_model(1)
+    peak = callee.peak_mem_usage()[0]
+    applied = callee.tile_operators(max_tiles=4)
+    assert peak_memory_usage(callee._buffer_lifetimes()[0]) == peak - applied[0][-1]
+    rewritten = Model.Model.GetRootAsModel(callee.model_bytes, 0)
+    assert rewritten.Subgraphs(0).OperatorsLength() == 1
+    assert rewritten.Subgraphs(1).OperatorsLength() > 3
@@ -0,0 +1,61 @@
+import csv
+import random
+
+import pytest
+
+from graphs import load_model, recompute_graph
+from tflite_tools.tradeoffs import TradeOff, pareto_front, write_tradeoffs_csv
+
+
+def point(name, arena_size, extra_macs, model_size):
+    return TradeOff((name,) if name else (), arena_size, arena_size, extra_macs, model_size)
+
+
+def costs(p):
+    return p.arena_size, p.extra_macs, p.model_size
+
+
+def test_pareto_front():
+    base = point(None, 100, 0, 1000)
+    smaller = point("a", 80, 10, 1000)
+    dominated = point("b", 90, 20, 1000)
+    larger_model = point("c", 80, 10, 1100)
+    same_costs = point("d", 80, 10, 1000)
+    assert pareto_front([dominated, base, larger_model, smaller, same_costs]) == [smaller, base]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_pareto_front_matches_definition(seed):
+    rnd = random.Random(seed)
+    points = list({point(str(k), rnd.randint(1, 10), rnd.randint(0, 10), rnd.randint(1, 10)) for k in range(30)})
+    front = pareto_front(points)
+    assert [p.arena_size for p in front] == sorted(p.arena_size for p in front)
+    assert len({costs(p) for p in front}) == len(front)
+    for p in points:
+        dominated = any(all(a <= b for a, b in zip(costs(q), costs(p))) and costs(q) != costs(p) for q in points)
+        assert dominated != any(costs(q) == costs(p) for q in front)
+
+
+def test_write_tradeoffs_csv(tmp_path):
+    points = [point(None, 100, 0, 1000), TradeOff(("reorder", "recompute t1"), 90, 96, 5, 1040)]
+    write_tradeoffs_csv(tmp_path / "tradeoffs.csv", points)
+    with open(tmp_path / "tradeoffs.csv", newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows == [["Transformations", "Peak memory use", "Arena size", "Extra MACs", "Model size"],
+                    ["none", "100", "100", "0", "1000"],
+                    ["reorder; recompute t1", "90", "96", "5", "1040"]]
+
+
+def test_explore_tradeoffs(tmp_path):
+    model = load_model(recompute_graph())
+    model_bytes = bytes(model.model_bytes)
+    front, points = model.explore_tradeoffs(rounds=1, jobs=1)
+    assert bytes(model.model_bytes) == model_bytes
+    assert front == pareto_front(points)
+    assert points[0].transformations == () and points[0].extra_macs == 0
+    recomputed = [p for p in front if any(t.startswith("recompute") for t in p.transformations)]
+    assert recomputed and all(p.peak == 1011 and p.extra_macs == 100 for p in recomputed)
+
+    pytest.importorskip("matplotlib")
+    model.write_tradeoffs(tmp_path / "tradeoffs.png", front, points)
+    assert (tmp_path / "tradeoffs.png").exists() and (tmp_path / "tradeoffs.csv").exists()
@@ -1,7 +1,10 @@
 import argparse
 import os
+import sys
 
-from tflite_tools import TFLiteModel
+from tflite_tools import RamBudgetInfeasible, TFLiteModel
+from tflite_tools.arena_planner import STRATEGIES
+from tflite_tools.schedule_cache import ScheduleCache
 
 
 def main():
@@ -12,8 +15,57 @@ def main():
     parser.add_argument("--clusters", type=int, default=0,
                         help="cluster weights into n-many values (simulate code-book quantization)")
     parser.add_argument("--optimize", action="store_true", default=False, help="optimize peak working set size")
+    parser.add_argument("--optimize-arena", action="store_true", default=False, dest="optimize_arena",
+                        help="optimize the size of the planned memory arena instead of the peak working set size "
+                             "(implies --optimize); the arena search evaluates at most 20 operator orders per "
+                             "operator, and stops sooner with --optimize-timeout")
+    parser.add_argument("--recompute", action="store_true", default=False,
+                        help="run cheap operators (pooling, activations, convolutions) again for later readers of "
+                             "their output where that lowers peak memory usage (implies --optimize)")
+    parser.add_argument("--recompute-max-macs", type=int, dest="recompute_max_macs", default=None, metavar="N",
+                        help="only recompute operators with at most N multiply-accumulate operations")
+    parser.add_argument("--tile", action="store_true", default=False,
+                        help="run chains of convolutions and pooling operators in horizontal tiles, using as few "
+                             "tiles as meet --ram-budget (or as lower peak memory usage the most without one)")
+    parser.add_argument("--max-tiles", type=int, dest="max_tiles", default=8, metavar="N",
+                        help="split a chain into at most N tiles (default: 8)")
+    parser.add_argument("--ram-budget", type=int, dest="ram_budget", default=None, metavar="BYTES",
+                        help="peak memory usage that the model needs to fit in; --optimize stops at the first "
+                             "operator order that does, or fails if none can")
+    parser.add_argument("--explore", type=str, dest="explore_plot_file", default=None, metavar="PLOT_FILE",
+                        help="explore combinations of reordering, recomputation and tiling, plot the arena size "
+                             "against the extra MACs of each and write the Pareto optimal ones to a CSV file next to "
+                             "the plot")
+    parser.add_argument("--explore-rounds", type=int, dest="explore_rounds", default=2, metavar="N",
+                        help="apply up to N transformations in a row when exploring (default: 2)")
+    parser.add_argument("--optimize-timeout", type=float, dest="optimize_timeout", default=None, metavar="SECONDS",
+                        help="stop optimizing after this many seconds and use the best operator order found so far")
+    parser.add_argument("--optimize-max-states", type=int, dest="optimize_max_states", default=None, metavar="N",
+                        help="stop optimizing after exploring N search states and use the best operator order found "
+                             "so far")
+    parser.add_argument("--jobs", type=int, default=None, metavar="N",
+                        help="number of worker processes to use when optimizing (default: 1) or exploring "
+                             "(default: one per CPU core)")
+    parser.add_argument("--memo-limit", type=float, dest="memo_limit", default=None, metavar="MB",
+                        help="limit the memory used by the optimizer's memo table (per process), evicting entries "
+                             "when it's exceeded")
+    parser.add_argument("--memo-spill", type=float, dest="memo_spill", default=0, metavar="MB",
+                        help="keep up to this much of the entries evicted from the memo table in a file on disk")
+    parser.add_argument("--no-cache", action="store_false", dest="use_cache", default=True,
+                        help="do not look up or store optimal operator orders in the schedule cache")
+    parser.add_argument("--no-aliasing", action="store_false", dest="aliasing", default=True,
+                        help="do not let reshapes, in-place operators and concatenations share memory between their "
+                             "inputs and outputs (for runtimes that allocate every tensor separately)")
+    parser.add_argument("--no-scratch", action="store_false", dest="scratch", default=True,
+                        help="do not account for the scratch buffers that kernels allocate while they run")
+    parser.add_argument("--arena-strategy", type=str, dest="arena_strategy", default="best",
+                        choices=STRATEGIES + ["best"],
+                        help="strategy for assigning tensors to offsets in the memory arena (default: try all and "
+                             "use the best)")
     parser.add_argument("--csv", type=str, dest="csv_output_folder", default=None,
                         help="output model analysis in CSV format into the specified folder")
+    parser.add_argument("--emit-c-plan", type=str, dest="c_plan_file", default=None, metavar="FILE",
+                        help="write the operator execution order and the arena plan as a C header")
     parser.add_argument("--plot", type=str, dest="plot_file", default=None,
                         help="plot memory usage for each operator during the execution")
     args = parser.parse_args()
@@ -21,18 +73,57 @@ def main():
     # Example API usage:
     # Can also use `TFLiteModel.create_from_protobuf`, which will invoke TOCO.
 
-    model = TFLiteModel.load_from_file(args.input_path)
+    model = TFLiteModel.load_from_file(args.input_path, aliasing=args.aliasing, scratch=args.scratch)
 
-    if args.optimize:
-        print("Optimizing peak memory usage...")
-        model.optimize_memory()
+    memo_limit = int(args.memo_limit * 2 ** 20) if args.memo_limit is not None else None
+    jobs = args.jobs if args.jobs is not None else 1
+
+    if args.explore_plot_file:
+        print("Exploring memory-reducing transformations...")
+        front, points = model.explore_tradeoffs(rounds=args.explore_rounds, max_tiles=args.max_tiles,
+                                                max_operator_macs=args.recompute_max_macs,
+                                                arena_strategy=args.arena_strategy, timeout=args.optimize_timeout,
+                                                max_states=args.optimize_max_states, jobs=args.jobs,
+                                                memo_limit=memo_limit, spill_limit=int(args.memo_spill * 2 ** 20))
+        print(f"Plotting the explored models to {args.explore_plot_file}")
+        model.write_tradeoffs(args.explore_plot_file, front, points)
+
+    if args.tile:
+        print("Tiling operators to lower peak memory usage...")
+        model.tile_operators(ram_budget=args.ram_budget, max_tiles=args.max_tiles, timeout=args.optimize_timeout,
+                             max_states=args.optimize_max_states, jobs=jobs, memo_limit=memo_limit,
+                             spill_limit=int(args.memo_spill * 2 ** 20))
+
+    if args.recompute:
+        print("Recomputing operators to lower peak memory usage...")
+        model.recompute_operators(timeout=args.optimize_timeout, max_states=args.optimize_max_states, jobs=jobs,
+                                  memo_limit=memo_limit, spill_limit=int(args.memo_spill * 2 ** 20),
+                                  max_operator_macs=args.recompute_max_macs)
+
+    if args.optimize or args.optimize_arena or args.recompute:
+        print("Optimizing the memory arena size..." if args.optimize_arena else "Optimizing peak memory usage...")
+        cache = ScheduleCache() if args.use_cache else None
+        try:
+            model.optimize_memory(timeout=args.optimize_timeout, max_states=args.optimize_max_states, jobs=jobs,
+                                  cache=cache, memo_limit=memo_limit, spill_limit=int(args.memo_spill * 2 ** 20),
+                                  objective="arena" if args.optimize_arena else "peak",
+                                  arena_strategy=args.arena_strategy, ram_budget=args.ram_budget)
+        except RamBudgetInfeasible as e:
+            sys.exit(f"Error: {e}")
 
     if args.csv_output_folder:
         print(f"Writing model analysis to {args.csv_output_folder} in CSV format")
         os.makedirs(args.csv_output_folder, exist_ok=True)
-        model.output_model_analysis_to_csv(args.csv_output_folder)
+        model.output_model_analysis_to_csv(args.csv_output_folder, arena_strategy=args.arena_strategy)
     else:
-        model.print_model_analysis()
+        model.print_model_analysis(arena_strategy=args.arena_strategy)
+
+    if args.c_plan_file:
+        print(f"Writing the memory plan to {args.c_plan_file}")
+        if not args.output_path and (args.optimize or args.optimize_arena or args.recompute or args.tile):
+            print("Warning: the memory plan indexes the operators and tensors of the changed model, which is only "
+                  "saved with -o.")
+        model.write_c_plan(args.c_plan_file, arena_strategy=args.arena_strategy)
 
     if args.clusters > 0:
         model.cluster_weights(args.clusters)
@@ -1 +1 @@
-from .tflite_model import TFLiteModel
+from .tflite_model import RamBudgetInfeasible, TFLiteModel
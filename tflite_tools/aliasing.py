@@ -0,0 +1,277 @@
+import copy
+
+import numpy as np
+
+from .tflite.ActivationFunctionType import ActivationFunctionType
+from .tflite.BuiltinOperator import BuiltinOperator
+from .schedule_search import transitive_closure
+
+
+# Builtin codes of operators that are newer than the bundled schema (codes below 127 are read the same way)
+LEAKY_RELU = 98
+ABS = 101
+QUANTIZE = 114
+HARD_SWISH = 117
+
+# Operators whose output is their first input, reinterpreted with a different shape
+ALIAS_OPERATORS = {BuiltinOperator.RESHAPE, BuiltinOperator.SQUEEZE, BuiltinOperator.EXPAND_DIMS}
+
+# Elementwise operators that can write their output over an input of the same shape and size
+IN_PLACE_OPERATORS = {
+    BuiltinOperator.ADD, BuiltinOperator.SUB, BuiltinOperator.MUL, BuiltinOperator.RELU, BuiltinOperator.RELU6,
+    BuiltinOperator.RELU_N1_TO_1, BuiltinOperator.LOGISTIC, BuiltinOperator.TANH, BuiltinOperator.NEG,
+    BuiltinOperator.FLOOR, LEAKY_RELU, ABS, QUANTIZE, HARD_SWISH,
+}
+
+
+def alias_source(op):
+    """
+    Returns the tensor whose memory the output of an aliasing operator (e.g. RESHAPE) reuses, or None. Weights are
+    never aliased, as they're not in RAM.
+    """
+    if op.opcode not in ALIAS_OPERATORS or op.output is None:
+        return None
+    source = op.inputs[0]
+    if source.is_constant or source.size != op.output.size:
+        return None
+    return source
+
+
+def in_place_inputs(op):
+    """
+    Returns the inputs that an operator can overwrite with its output, if they're not needed afterwards. Broadcast
+    inputs (with a different shape than the output), model inputs and weights are left out.
+    """
+    if op.opcode not in IN_PLACE_OPERATORS or op.output is None:
+        return []
+    shape = tuple(op.output.shape)
+    candidates = [t for t in op.inputs
+                  if t.producer is not None and t.size == op.output.size and tuple(t.shape) == shape]
+    return list(dict.fromkeys(candidates))
+
+
+def _search_aliases(graph):
+    # Aliasing operators that the schedule search leaves out (see `alias_graph`)
+    return [op for op in graph.operators if alias_source(op) is not None]
+
+
+def concat_inputs(op):
+    """
+    Returns the inputs of a CONCATENATION that can be computed directly into consecutive slices of its output, so
+    that the operator doesn't need to copy anything, or None. That's the case if the slices are contiguous (all
+    dimensions before the axis are 1), there's no fused activation or requantization, and each input is computed by
+    an operator and read only once by the concatenation.
+    """
+    if op.opcode != BuiltinOperator.CONCATENATION or op.output is None:
+        return None
+    shape = [int(d) for d in op.output.shape]
+    axis = op.options.Axis() if op.options is not None else 0
+    axis = axis + len(shape) if axis < 0 else axis
+    if op.options is not None and op.options.FusedActivationFunction() != ActivationFunctionType.NONE:
+        return None
+    if int(np.prod(shape[:axis], dtype=np.int64)) != 1 or len(set(op.inputs)) != len(op.inputs):
+        return None
+    for t in op.inputs:
+        if t.producer is None or t.type != op.output.type or t.quantization != op.output.quantization:
+            return None
+    if sum(t.size for t in op.inputs) != op.output.size:
+        return None
+    return list(op.inputs)
+
+
+def peak_memory_usage(buffers):
+    """
+    Returns the largest sum of sizes of buffers that are alive at the same step.
+    :param buffers: A dict mapping keys to (size, first step, last step) tuples
+    """
+    num_steps = max((last for _, _, last in buffers.values()), default=-1) + 2
+    mem_diff = [0] * num_steps
+    for size, first, last in buffers.values():
+        mem_diff[first] += size
+        mem_diff[last + 1] -= size
+    peak = mem_use = 0
+    for d in mem_diff:
+        mem_use += d
+        peak = max(peak, mem_use)
+    return peak
+
+
+def alias_graph(graph):
+    """
+    Builds the graph seen by the schedule search under the aliasing memory model. Aliasing operators are left out
+    and their consumers read the aliased tensor directly, as it's the same memory; the remaining operators list the
+    inputs they can overwrite in `in_place_inputs`. Tensors keep their ids, so the outputs of aliasing operators stay
+    in the tensor list, disconnected.
+    :param graph: A `TFLiteGraph`
+    :return: A `TFLiteGraph` with copies of the tensors and operators (without columns)
+    """
+    sources = {op.output.id: op.inputs[0].id for op in _search_aliases(graph)}
+
+    def resolve(i):
+        while i in sources:
+            i = sources[i]
+        return i
+
+    tensors = [copy.copy(t) for t in graph.tensors]
+    for t in tensors:
+        t.producer, t.consumers = None, []
+        if t.id in sources:
+            t.is_constant, t.size = True, 0
+
+    operators = []
+    for op in graph.operators:
+        if op.output is not None and op.output.id in sources:
+            continue
+        in_place = in_place_inputs(op)
+        op = copy.copy(op)
+        op.inputs = [tensors[resolve(t.id)] for t in op.inputs]
+        # Model inputs are never overwritten, including through an alias
+        in_place = [resolve(t.id) for t in in_place if graph.tensors[resolve(t.id)].producer is not None]
+        op.in_place_inputs = [tensors[i] for i in dict.fromkeys(in_place)]
+        op.outputs = [tensors[t.id] for t in op.outputs]
+        for t in op.outputs:
+            t.producer = op
+        for t in dict.fromkeys(op.inputs):
+            t.consumers.append(op)
+        operators.append(op)
+
+    direct_masks = [sum(1 << i.id for i in set(t.producer.inputs)) if t.producer is not None else 0
+                    for t in tensors]
+    for t, mask in zip(tensors, transitive_closure(direct_masks)):
+        t.predecessor_mask = mask
+
+    inputs = [tensors[resolve(t.id)] for t in graph.inputs]
+    outputs = list(dict.fromkeys(tensors[resolve(t.id)] for t in graph.outputs))
+    return graph._replace(tensors=tensors, operators=operators, inputs=inputs, outputs=outputs, columns=None)
+
+
+def expand_order(graph, op_order):
+    """
+    Turns an order of the operators of `alias_graph(graph)` into an order of the operators of `graph`, running
+    each aliasing operator straight after the operator that produces its input (or first, for model inputs).
+    :param graph: A `TFLiteGraph` with operators in id order
+    :param op_order: Operators of the alias graph, in the order of execution
+    :return: Operators of `graph`, in the order of execution
+    """
+    followers = {}
+    for op in _search_aliases(graph):
+        followers.setdefault(op.inputs[0], []).append(op)
+
+    expanded = []
+
+    def append(op):
+        stack = [op]
+        while stack:
+            op = stack.pop()
+            expanded.append(op)
+            stack += [f for t in reversed(op.outputs) for f in reversed(followers.get(t, []))]
+
+    for op in _search_aliases(graph):
+        if op.inputs[0].producer is None:
+            append(op)
+    for op in op_order:
+        append(graph.operators[op.id])
+    return expanded
+
+
+def share_buffers(graph, op_order, lifetimes, concat=True):
+    """
+    Works out which tensors share memory when operators are executed in a given order:
+    * outputs of aliasing operators share the buffer of their input;
+    * with `concat`, the inputs of a CONCATENATION (see `concat_inputs`) are placed one after the other in the buffer
+      of its output (so they're only aligned to their element size), unless reserving the whole buffer from when the
+      first input is computed raises the peak memory usage of the result;
+    * an in-place capable operator writes its output over the first eligible input whose buffer isn't needed
+      afterwards.
+    Buffers holding model inputs or outputs are never overwritten or placed in another buffer.
+    :param graph: A `TFLiteGraph`
+    :param op_order: Operators in the order of execution
+    :param lifetimes: A dict mapping ids of tensors in RAM to (size, first step, last step) tuples
+    :param concat: Place inputs of concatenations in their output
+    :return: A tuple of a dict mapping buffer ids (the id of one of the tensors in it) to (size, first step, last
+    step) tuples, as taken by `arena_planner.plan_arena`, and a dict mapping tensor ids to (buffer id, offset in
+    the buffer) tuples
+    """
+    result = _merge_buffers(graph, op_order, lifetimes, set())
+    if not concat:
+        return result
+
+    # Placing a concatenation's inputs changes which in-place writes are possible later on, so each one is judged by
+    # the peak memory usage once all buffers are merged
+    peak = peak_memory_usage(result[0])
+    placed = set()
+    for op in op_order:
+        if concat_inputs(op) is None:
+            continue
+        candidate = _merge_buffers(graph, op_order, lifetimes, placed | {op.id})
+        candidate_peak = peak_memory_usage(candidate[0])
+        if candidate_peak <= peak:
+            placed.add(op.id)
+            result, peak = candidate, candidate_peak
+    return result
+
+
+def _merge_buffers(graph, op_order, lifetimes, concats):
+    # Does the work of `share_buffers`, placing the inputs of the concatenations whose ids are in `concats` (where
+    # they're eligible)
+    parent = {i: i for i in lifetimes}
+    shift = {i: 0 for i in lifetimes}  # Offset of a tensor in the buffer of its parent
+    buffers = dict(lifetimes)
+    pinned = {t.id for t in graph.outputs} | {i for i in lifetimes if graph.tensors[i].producer is None}
+
+    def find(i):
+        # Returns the buffer of a tensor and the offset of the tensor in it
+        path = []
+        while parent[i] != i:
+            path.append(i)
+            i = parent[i]
+        for j in reversed(path):
+            if parent[j] != i:
+                shift[j] += shift[parent[j]]
+                parent[j] = i
+        return i, shift[path[0]] if path else 0
+
+    def place(i, j, delta=0):
+        # Merges the buffers of tensors `i` and `j`, so that `i` starts `delta` bytes after `j`
+        buffer_i, offset_i = find(i)
+        buffer_j, offset_j = find(j)
+        d = offset_j + delta - offset_i
+        into, other = (buffer_j, buffer_i) if d >= 0 else (buffer_i, buffer_j)
+        size, first, last = buffers.pop(other)
+        into_size, into_first, into_last = buffers[into]
+        buffers[into] = (max(into_size, size + abs(d)), min(first, into_first), max(last, into_last))
+        parent[other], shift[other] = into, abs(d)
+        if other in pinned:
+            pinned.add(into)
+
+    for op in op_order:
+        source = alias_source(op)
+        if source is not None and source.id in parent and op.output.id in parent:
+            place(op.output.id, source.id)
+
+    for step, op in enumerate(op_order):
+        if op.output is None or op.output.id not in parent:
+            continue
+        output = find(op.output.id)[0]
+
+        slices = concat_inputs(op) if op.id in concats else None
+        if slices is not None:
+            roots = [find(t.id) for t in slices]
+            # Each input needs a buffer of its own, which it doesn't share with anything bigger
+            if all(t.id in parent for t in slices) and len({r for r, _ in roots} | {output}) == len(slices) + 1 \
+                    and all(r not in pinned and o == 0 and buffers[r][0] == t.size for t, (r, o) in zip(slices, roots)):
+                offset = 0
+                for t in slices:
+                    place(t.id, op.output.id, offset)
+                    offset += t.size
+            continue
+
+        for t in in_place_inputs(op):
+            if t.id not in parent:
+                continue
+            buffer = find(t.id)[0]
+            if buffer != output and buffer not in pinned and buffers[buffer][2] == step:
+                place(op.output.id, t.id)
+                break
+
+    return buffers, {i: find(i) for i in parent}
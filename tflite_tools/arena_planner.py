@@ -0,0 +1,225 @@
+import bisect
+import time
+from collections import namedtuple
+
+from .aliasing import peak_memory_usage, share_buffers
+from .scratch import scratch_buffers
+
+
+ArenaPlan = namedtuple("ArenaPlan", ["strategy", "arena_size", "offsets"])
+
+STRATEGIES = ["greedy_by_size", "greedy_by_breadth", "best_fit"]
+
+
+def _align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+def _find_offset(size, first, last, placed, best_fit, alignment):
+    # Finds an offset for a buffer live from step `first` to step `last` (inclusive), given already placed buffers
+    # as (offset, size, first, last) tuples sorted by offset. Takes the lowest gap between buffers with overlapping
+    # lifetimes that is large enough, or the smallest one with `best_fit`; otherwise goes above all of them.
+    conflicts = [(o, s) for o, s, f, l in placed if f <= last and first <= l]
+    best = None
+    offset = 0
+    for o, s in conflicts:
+        gap = o - offset
+        if gap >= size and (best is None or gap < best[1]):
+            best = (offset, gap)
+            if not best_fit:
+                break
+        offset = max(offset, _align(o + s, alignment))
+    return best[0] if best is not None else offset
+
+
+def _place_all(order, buffers, best_fit, alignment):
+    placed = []
+    offsets = {}
+    for key in order:
+        size, first, last = buffers[key]
+        offset = _find_offset(size, first, last, placed, best_fit, alignment)
+        offsets[key] = offset
+        bisect.insort(placed, (offset, size, first, last))
+    arena_size = max((o + s for o, s, _, _ in placed), default=0)
+    return offsets, arena_size
+
+
+def plan_arena(buffers, strategy="greedy_by_breadth", alignment=16):
+    """
+    Assigns offsets in a single memory arena to buffers with known lifetimes, so that buffers that are alive at the
+    same time don't overlap.
+
+    Strategies:
+    * `greedy_by_size`: places buffers from the largest to the smallest, each at the lowest offset where it fits.
+    * `greedy_by_breadth`: goes through the execution steps from the one with the most memory in use to the one with
+      the least, placing the buffers that are alive at each step from the largest to the smallest, each in the
+      smallest gap that fits it.
+    * `best_fit`: places buffers in the order they're created, each in the smallest gap that fits it, like a
+      best-fit dynamic allocator.
+    * `best`: tries all of the above and keeps the smallest arena.
+
+    :param buffers: A dict mapping keys (e.g. tensor ids) to (size, first step, last step) tuples
+    :param strategy: One of `STRATEGIES` or "best"
+    :param alignment: Offsets are aligned to this many bytes
+    :return: An `ArenaPlan` with offsets keyed like `buffers`
+    """
+    if strategy == "best":
+        plans = [plan_arena(buffers, s, alignment) for s in STRATEGIES]
+        return min(plans, key=lambda p: p.arena_size)
+
+    if strategy == "greedy_by_size":
+        order = sorted(buffers, key=lambda k: (-buffers[k][0], buffers[k][1]))
+        offsets, arena_size = _place_all(order, buffers, False, alignment)
+    elif strategy == "greedy_by_breadth":
+        num_steps = max((last for _, _, last in buffers.values()), default=-1) + 1
+        breadth = [0] * num_steps
+        alive = [[] for _ in range(num_steps)]
+        for key, (size, first, last) in buffers.items():
+            for step in range(first, last + 1):
+                breadth[step] += size
+                alive[step].append(key)
+        order = []
+        seen = set()
+        for step in sorted(range(num_steps), key=lambda s: -breadth[s]):
+            for key in sorted(alive[step], key=lambda k: -buffers[k][0]):
+                if key not in seen:
+                    seen.add(key)
+                    order.append(key)
+        order += [key for key in buffers if key not in seen]
+        offsets, arena_size = _place_all(order, buffers, True, alignment)
+    elif strategy == "best_fit":
+        order = sorted(buffers, key=lambda k: (buffers[k][1], -buffers[k][0]))
+        offsets, arena_size = _place_all(order, buffers, True, alignment)
+    else:
+        raise ValueError(f"Unknown arena planning strategy: {strategy}")
+
+    return ArenaPlan(strategy, arena_size, offsets)
+
+
+def order_buffers(graph, op_order, aliasing=False):
+    """
+    Works out the lifetimes of the tensors (and scratch buffers, see `scratch.scratch_buffers`) that need to be in
+    RAM when operators are executed in a given order.
+    :param graph: A `TFLiteGraph`
+    :param op_order: All operators of the graph, in the order of execution
+    :param aliasing: Let tensors share buffers, see `aliasing.share_buffers`
+    :return: A tuple of a dict mapping buffer ids to (size, first step, last step) tuples, as taken by `plan_arena`,
+    and a dict mapping tensor ids and scratch buffer keys to (buffer id, offset in the buffer) tuples
+    """
+    position = {op: k for k, op in enumerate(op_order)}
+    last_step = len(op_order) - 1
+    outputs = set(graph.outputs)
+    buffers = {}
+    for t in graph.tensors:
+        if t.is_constant:
+            continue
+        first = position[t.producer] if t.producer is not None else 0
+        # Like `TFLiteModel._tensor_lifetimes`: tensors that nothing reads stay in memory until the end if they're
+        # graph outputs or model inputs, and only while their producer runs otherwise (e.g. unused outputs of a SPLIT)
+        if t.consumers:
+            last = max(position[c] for c in t.consumers)
+        else:
+            last = last_step if t in outputs or t.producer is None else first
+        if first <= last:
+            buffers[t.id] = (t.size, first, last)
+    owners = {i: (i, 0) for i in buffers}
+    if aliasing:
+        buffers, owners = share_buffers(graph, op_order, buffers)
+    scratch = scratch_buffers(op_order)
+    buffers.update(scratch)
+    owners.update((key, (key, 0)) for key in scratch)
+    return buffers, owners
+
+
+class ArenaOrderSearch:
+    """
+    Looks for an operator order with the smallest planned arena (see `plan_arena`), rather than the smallest sum of
+    sizes of tensors in memory. Starting from the best of the given operator orders (e.g. the one with the smallest
+    peak memory usage), each operator in turn is moved to the best of the positions up to `MAX_MOVE_DISTANCE` away
+    that keep its dependencies, if that shrinks the arena (or, for the same arena size, the peak memory usage),
+    until a whole pass over the operators moves none of them. Orders whose peak memory usage alone rules them out
+    aren't planned.
+
+    The search stops early when the arena size reaches `lower_bound` (e.g. the smallest possible peak memory usage),
+    when `timeout` seconds have passed or after evaluating `max_steps` orders (by default, `STEPS_PER_OPERATOR` per
+    operator of the graph). With `aliasing`, tensors share buffers as described in `aliasing.share_buffers`.
+    """
+
+    MAX_MOVE_DISTANCE = 8
+    STEPS_PER_OPERATOR = 20
+
+    def __init__(self, graph, initial_orders, strategy="best", alignment=16, lower_bound=0, timeout=None,
+                 max_steps=None, aliasing=False):
+        self.graph = graph
+        self.aliasing = aliasing
+        self.initial_orders = [list(o) for o in initial_orders]
+        self.strategy = strategy
+        self.alignment = alignment
+        self.lower_bound = lower_bound
+        self.timeout = timeout
+        self.max_steps = max_steps if max_steps is not None else self.STEPS_PER_OPERATOR * len(graph.operators)
+        self.steps = 0
+        self.complete = False
+        self._deadline = None
+
+    def _evaluate(self, op_order, bound=None):
+        # Returns the cost and the plan of an order, or (None, None) if its peak memory usage is at least `bound`: the
+        # arena can't be smaller than the peak, so such an order can't beat an arena of `bound` bytes
+        self.steps += 1
+        buffers, owners = order_buffers(self.graph, op_order, self.aliasing)
+        peak = peak_memory_usage(buffers)
+        if bound is not None and peak >= bound:
+            return None, None
+        plan = plan_arena(buffers, self.strategy, self.alignment)
+        plan = plan._replace(offsets={i: plan.offsets[b] + offset for i, (b, offset) in owners.items()})
+        return (plan.arena_size, peak), plan
+
+    def _out_of_budget(self):
+        if self.steps >= self.max_steps:
+            return True
+        return self._deadline is not None and time.monotonic() > self._deadline
+
+    def _moves(self, op_order, k):
+        # Yields orders with the operator at position `k` moved to another nearby position that keeps the order valid
+        op = op_order[k]
+        rest = op_order[:k] + op_order[k + 1:]
+        producers = {t.producer for t in op.inputs if t.producer is not None}
+        consumers = {c for t in op.outputs for c in t.consumers}
+        lo = max((j for j, other in enumerate(rest) if other in producers), default=-1) + 1
+        hi = min((j for j, other in enumerate(rest) if other in consumers), default=len(rest))
+        for j in range(max(lo, k - self.MAX_MOVE_DISTANCE), min(hi, k + self.MAX_MOVE_DISTANCE) + 1):
+            if j != k:
+                yield rest[:j] + [op] + rest[j:]
+
+    def solve(self):
+        """
+        Runs the search until it reaches a local optimum or runs out of budget.
+        :return: A tuple of the best `ArenaPlan` found (offsets keyed by tensor id) and the list of operators in the
+        order of execution
+        """
+        self._deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        best = min((self._evaluate(o) + (o, ) for o in self.initial_orders), key=lambda c: c[0])
+        cost, plan, op_order = best
+
+        k = unchanged = 0
+        while unchanged < len(op_order) and cost[0] > self.lower_bound:
+            # The best move of this operator that improves on the current order, if any
+            moved, move_cost, exhausted = None, cost, False
+            for candidate in self._moves(op_order, k):
+                if self._out_of_budget():
+                    exhausted = True
+                    break
+                candidate_cost, candidate_plan = self._evaluate(candidate, move_cost[0])
+                if candidate_plan is not None and candidate_cost < move_cost:
+                    moved, move_cost = (candidate_plan, candidate), candidate_cost
+            if moved is not None:
+                cost, (plan, op_order) = move_cost, moved
+                unchanged = 0
+            else:
+                unchanged += 1
+            if exhausted:
+                return plan, op_order
+            k = (k + 1) % len(op_order)
+
+        self.complete = True
+        return plan, op_order
@@ -0,0 +1,70 @@
+import re
+from pathlib import Path
+
+from .scratch import ScratchBuffer
+
+
+def _comment(text):
+    # Keeps arbitrary tensor names from ending the C comment early
+    return text.replace("*/", "* /")
+
+
+def _array(c_type, name, length, rows):
+    lines = [f"static const {c_type} {name}[{length}] = {{"]
+    lines += [f"    {value},  /* {_comment(comment)} */" for value, comment in rows]
+    lines.append("};")
+    return lines
+
+
+def write_c_plan(output_path, graph, arena_plan, prefix="tflite_plan"):
+    """
+    Writes a C header with the operator execution order and the arena plan, for runtimes that allocate tensors
+    statically instead of planning memory on the device.
+    :param output_path: Output file (.h)
+    :param graph: A `TFLiteGraph` of the model as it's written out, with operators in the order of execution
+    :param arena_plan: An `ArenaPlan` with offsets keyed by tensor id (and `ScratchBuffer` keys for scratch buffers)
+    :param prefix: Prefix for the names of the generated macros and arrays
+    """
+    output_path = Path(output_path)
+    guard = re.sub(r"[^A-Za-z0-9]", "_", output_path.name).upper()
+    macro = prefix.upper()
+
+    lines = [
+        "/* Memory plan generated by tflite-tools: operator execution order and tensor placement in a single",
+        f" * arena of {arena_plan.arena_size:,} bytes (planned with {arena_plan.strategy}). */",
+        f"#ifndef {guard}",
+        f"#define {guard}",
+        "",
+        "#include <stdint.h>",
+        "",
+        f"#define {macro}_ARENA_SIZE {arena_plan.arena_size}",
+        f"#define {macro}_NUM_OPERATORS {len(graph.operators)}",
+        f"#define {macro}_NUM_TENSORS {len(graph.tensors)}",
+        "/* Offset of tensors that are not placed in the arena (e.g. weights, which stay in the model) */",
+        f"#define {macro}_NOT_IN_ARENA (-1)",
+        "",
+        "/* Indices of the subgraph's operators in the order of execution. They index the model as saved by",
+        " * tflite-tools along with this header, which has its operators in this order already. */",
+    ]
+    lines += _array("uint32_t", f"{prefix}_operator_order", f"{macro}_NUM_OPERATORS",
+                    [(op.id, op.name) for op in graph.operators])
+    lines += ["", "/* Arena offset of each tensor in bytes, indexed by tensor id */"]
+    lines += _array("int32_t", f"{prefix}_tensor_offsets", f"{macro}_NUM_TENSORS",
+                    [(arena_plan.offsets.get(t.id, f"{macro}_NOT_IN_ARENA"), f"{t.id}: {t.name}")
+                     for t in graph.tensors])
+    lines += ["", "/* Size of each tensor in the arena in bytes, indexed by tensor id */"]
+    lines += _array("uint32_t", f"{prefix}_tensor_sizes", f"{macro}_NUM_TENSORS",
+                    [(t.size if t.id in arena_plan.offsets else 0, f"{t.id}: {t.name}") for t in graph.tensors])
+    scratch = [ScratchBuffer(op.id) for op in graph.operators]
+    names = [op.name for op in graph.operators]
+    lines += ["", "/* Arena offset of the scratch buffer of each operator in bytes, in the order of execution */"]
+    lines += _array("int32_t", f"{prefix}_scratch_offsets", f"{macro}_NUM_OPERATORS",
+                    [(arena_plan.offsets.get(key, f"{macro}_NOT_IN_ARENA"), name) for key, name in zip(scratch, names)])
+    lines += ["", "/* Size of the scratch buffer of each operator in bytes, in the order of execution */"]
+    lines += _array("uint32_t", f"{prefix}_scratch_sizes", f"{macro}_NUM_OPERATORS",
+                    [(op.scratch_size if key in arena_plan.offsets else 0, name)
+                     for op, key, name in zip(graph.operators, scratch, names)])
+    lines += ["", f"#endif  /* {guard} */", ""]
+
+    with open(output_path, "w") as f:
+        f.write("\n".join(lines))
@@ -0,0 +1,154 @@
+import sys
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+
+
+def _iter_bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+MemoStats = namedtuple("MemoStats", ["hits", "misses", "evictions", "spilled", "resident_bytes"])
+
+# Rough size of a dict slot, the (value, choice) tuple and its value, on top of the bitmask itself
+_ENTRY_OVERHEAD = 128
+
+
+def add_memo_stats(a, b):
+    """
+    Combines statistics of two memo tables: counts are added up and the larger resident size is kept.
+    """
+    return MemoStats(a.hits + b.hits, a.misses + b.misses, a.evictions + b.evictions, a.spilled + b.spilled,
+                     max(a.resident_bytes, b.resident_bytes))
+
+
+class _SpillTable:
+    # Open-addressing hash table of (bitmask, value, choice) records in a memory-mapped temporary file
+
+    MAX_LOAD = 0.7
+
+    def __init__(self, key_bytes, max_bytes, spill_dir=None):
+        self.key_bytes = key_bytes
+        self.dtype = np.dtype([("used", "u1"), ("key", "u1", (key_bytes, )), ("value", "<i8"), ("choice", "<i4")])
+        self.capacity = max(int(max_bytes // self.dtype.itemsize), 1)
+        self.size = 0
+        self.file = tempfile.NamedTemporaryFile(prefix="tflite-tools-memo-", dir=spill_dir)
+        self.records = np.memmap(self.file, dtype=self.dtype, mode="w+", shape=(self.capacity, ))
+
+    def _find(self, mask, key):
+        # Returns the slot holding `key`, or the empty slot where it would go
+        slot = hash(mask) % self.capacity
+        while self.records["used"][slot] and self.records["key"][slot].tobytes() != key:
+            slot = (slot + 1) % self.capacity
+        return slot
+
+    def get(self, mask):
+        key = mask.to_bytes(self.key_bytes, "little")
+        slot = self._find(mask, key)
+        if not self.records["used"][slot]:
+            return None
+        record = self.records[slot]
+        return int(record["value"]), int(record["choice"])
+
+    def put(self, mask, entry):
+        # Returns whether the entry was stored; a full table doesn't take any new entries
+        key = mask.to_bytes(self.key_bytes, "little")
+        slot = self._find(mask, key)
+        if not self.records["used"][slot]:
+            if self.size + 1 > self.MAX_LOAD * self.capacity:
+                return False
+            self.size += 1
+        self.records[slot] = (1, np.frombuffer(key, dtype=np.uint8), entry[0], entry[1])
+        return True
+
+
+class MemoTable:
+    """
+    Memo table of the schedule search, mapping working set bitmasks to (memory usage, choice) tuples.
+
+    With `max_bytes`, the estimated size of the table in memory is kept under that limit: once it's exceeded, a
+    quarter of the entries is evicted. Lower bounds (negative choice) go first, followed by exact results of the
+    working sets with the fewest tensors left to compute (according to `predecessor_mask`, indexed by bit), which
+    are the cheapest to recompute. With `spill_bytes`, evicted entries are moved to a memory-mapped table on disk of
+    up to that size instead of being dropped, as long as it has room for them. A search using a bounded table has to
+    cope with entries going missing, at the cost of redoing some work.
+    """
+
+    def __init__(self, predecessor_mask, max_bytes=None, spill_bytes=0, spill_dir=None):
+        self.predecessor_mask = predecessor_mask
+        self.max_bytes = max_bytes
+        self.spill_bytes = spill_bytes
+        self.spill_dir = spill_dir
+        self._entries = {}
+        self._spill = None
+        self.resident_bytes = 0
+        self.peak_resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spilled = 0
+
+    @property
+    def stats(self):
+        return MemoStats(self.hits, self.misses, self.evictions, self.spilled, self.peak_resident_bytes)
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = self.spilled = 0
+        self.peak_resident_bytes = self.resident_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        # Copies (e.g. sent to worker processes) start out empty
+        state = dict(self.__dict__)
+        state.update(_entries={}, _spill=None, resident_bytes=0, peak_resident_bytes=0, hits=0, misses=0,
+                     evictions=0, spilled=0)
+        return state
+
+    def get(self, mask):
+        entry = self._entries.get(mask)
+        if entry is None and self._spill is not None:
+            entry = self._spill.get(mask)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def __setitem__(self, mask, entry):
+        if mask not in self._entries:
+            entry_bytes = sys.getsizeof(mask) + _ENTRY_OVERHEAD
+            # Evict before inserting, so the new entry can always be read back straight away
+            if self.max_bytes is not None and self.resident_bytes + entry_bytes > self.max_bytes:
+                self._evict()
+            self.resident_bytes += entry_bytes
+            self.peak_resident_bytes = max(self.peak_resident_bytes, self.resident_bytes)
+        self._entries[mask] = entry
+
+    def _remaining(self, mask):
+        # Number of tensors that still have to be computed to get to the working set
+        upstream = mask
+        for i in _iter_bits(mask):
+            upstream |= self.predecessor_mask[i]
+        return bin(upstream).count("1")
+
+    def _evict(self):
+        victims = sorted(self._entries, key=lambda mask: (self._entries[mask][1] >= 0, self._remaining(mask)))
+        target = self.max_bytes * 3 // 4
+        for mask in victims:
+            if self.resident_bytes <= target:
+                break
+            entry = self._entries.pop(mask)
+            self.resident_bytes -= sys.getsizeof(mask) + _ENTRY_OVERHEAD
+            self.evictions += 1
+            if self.spill_bytes:
+                if self._spill is None:
+                    key_bytes = (len(self.predecessor_mask) + 7) // 8 or 1
+                    self._spill = _SpillTable(key_bytes, self.spill_bytes, self.spill_dir)
+                if self._spill.put(mask, entry):
+                    self.spilled += 1
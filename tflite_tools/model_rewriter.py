@@ -0,0 +1,294 @@
+import importlib
+import re
+from functools import lru_cache
+
+import flatbuffers
+import numpy as np
+
+from .tflite import Model
+from .tflite.BuiltinOptions import BuiltinOptions
+from .tflite.TensorType import TensorType
+
+# Operator code that newer schemas store in place of builtin codes that don't fit in a byte (the actual code is in a
+# field that the bundled schema doesn't have)
+PLACEHOLDER_FOR_GREATER_OP_CODES = 127
+
+# Alignment of the contents of buffers, which kernels read in place
+BUFFER_ALIGNMENT = 16
+
+
+class Table:
+    """
+    A decoded flatbuffer table of a TFLite model, whose `table_type` is the name of a table of the bundled schema
+    (e.g. "Tensor" or "Operator"). Every field of the table is an attribute with the field's name in snake case
+    (`tensor.is_variable`, `op.builtin_options_type`, ...):
+    * scalars are Python numbers or bools;
+    * strings are `bytes` (a `str` can be assigned too);
+    * vectors of scalars are NumPy arrays with the element type of the schema (e.g. `np.int32` for tensor shapes);
+      buffer contents are views of the original model rather than copies;
+    * tables, including unions such as builtin options, are `Table`s and vectors of tables are lists of `Table`s;
+    * fields that aren't set are None.
+    """
+
+    def __init__(self, table_type, **fields):
+        self.table_type = table_type
+        for field in _fields(table_type):
+            setattr(self, field, None)
+        for field, value in fields.items():
+            setattr(self, field, value)
+
+    def __repr__(self):
+        fields = ", ".join(f"{f}={getattr(self, f)!r}" for f in _fields(self.table_type))
+        return f"{self.table_type}({fields})"
+
+    def copy(self, **fields):
+        """
+        Returns a shallow copy of the table (fields that are tables, vectors or strings are shared with this one),
+        with some fields changed.
+        """
+        table = Table(self.table_type, **{f: getattr(self, f) for f in _fields(self.table_type)})
+        for field, value in fields.items():
+            setattr(table, field, value)
+        return table
+
+
+def _module(name):
+    return importlib.import_module(f".tflite.{name}", __package__)
+
+
+@lru_cache(maxsize=None)
+def _fields(name):
+    # Fields of a table of the bundled schema as (snake case name, camel case name) pairs, found from the builder
+    # functions generated for it (e.g. `TensorAddIsVariable`)
+    prefix = f"{name}Add"
+    camel = [f[len(prefix):] for f in vars(_module(name)) if f.startswith(prefix)]
+    return {re.sub(r"(?<!^)(?=[A-Z])", "_", c).lower(): c for c in camel}
+
+
+class _SlotCounter:
+    # Stands in for a flatbuffers builder to find how many fields a table has from its generated `...Start` function,
+    # which counts deprecated fields too (unlike `_fields`)
+    def StartObject(self, num_fields):
+        self.num_fields = num_fields
+
+
+@lru_cache(maxsize=None)
+def _num_slots(name):
+    counter = _SlotCounter()
+    getattr(_module(name), f"{name}Start")(counter)
+    return counter.num_fields
+
+
+def _has_newer_fields(obj, name):
+    # Whether a table sets fields past the last one of the bundled schema. Fields holding their default value aren't
+    # stored, so those that are present matter.
+    tab = obj._tab
+    vtable = tab.Pos - tab.Get(flatbuffers.number_types.SOffsetTFlags, tab.Pos)
+    vtable_size = tab.Get(flatbuffers.number_types.VOffsetTFlags, vtable)
+    return any(tab.Offset(4 + 2 * slot) for slot in range(_num_slots(name), (vtable_size - 4) // 2))
+
+
+def _decode_value(value):
+    if isinstance(value, flatbuffers.table.Table) or value is None or isinstance(value, (bool, int, float, bytes)):
+        return value
+    return decode_table(value)
+
+
+def decode_table(obj):
+    """
+    Decodes a flatbuffer table and everything it refers to.
+    :param obj: An instance of a table class of the bundled schema (e.g. `tflite.Tensor.Tensor`)
+    :return: A `Table`
+    """
+    name = type(obj).__name__
+    if _has_newer_fields(obj, name):
+        raise NotImplementedError(f"{name} has fields that are newer than the bundled schema, which would be lost")
+    table = Table(name)
+    for field, camel in _fields(name).items():
+        if hasattr(obj, camel + "Length"):
+            if hasattr(obj, camel + "AsNumpy"):
+                value = getattr(obj, camel + "AsNumpy")()
+                value = value if isinstance(value, np.ndarray) else None
+            else:
+                length = getattr(obj, camel + "Length")()
+                value = [_decode_value(getattr(obj, camel)(j)) for j in range(length)] if length else None
+        else:
+            value = getattr(obj, camel)()
+            if isinstance(value, flatbuffers.table.Table):
+                # A union (builtin options), whose table type is in the `...Type` field
+                options_type = getattr(obj, camel + "Type")()
+                options_name = next((k for k, v in vars(BuiltinOptions).items() if v == options_type), None)
+                if options_name is None:
+                    raise NotImplementedError(f"{camel} of type {options_type} are newer than the bundled schema")
+                options = getattr(_module(options_name), options_name)()
+                options.Init(value.Bytes, value.Pos)
+                value = options
+            value = _decode_value(value)
+        setattr(table, field, value)
+
+    if name == "OperatorCode" and table.builtin_code == PLACEHOLDER_FOR_GREATER_OP_CODES:
+        raise NotImplementedError("Operator codes that are newer than the bundled schema can't be re-serialized")
+    return table
+
+
+def decode_model(model_bytes):
+    """
+    Decodes a whole TFLite model into a tree of `Table`s, which can be edited freely (adding or removing operators,
+    tensors and buffers, changing shapes and buffer contents, ...) and written back with `encode_model`.
+    Models that use fields, operator codes or builtin options that are newer than the bundled schema (e.g. per-channel
+    quantization's `quantized_dimension`) can't be decoded, as they'd be lost when writing the model back.
+    :param model_bytes: The model
+    :return: The `Model` table
+    """
+    return decode_table(Model.Model.GetRootAsModel(model_bytes, 0))
+
+
+def add_tensor(subgraph, source, name, shape=None):
+    """
+    Adds a copy of a tensor (with the same type, buffer and quantization parameters) to a decoded subgraph.
+    :param subgraph: The `SubGraph` table
+    :param source: Id of the tensor to copy
+    :param name: Name of the new tensor
+    :param shape: Shape of the new tensor, or None to keep the original one
+    :return: Id of the new tensor
+    """
+    t = subgraph.tensors[source]
+    subgraph.tensors.append(t.copy(name=name, shape=t.shape if shape is None else np.array(shape, dtype=np.int32)))
+    return len(subgraph.tensors) - 1
+
+
+def add_constant(model, subgraph, name, values):
+    """
+    Adds a constant INT32 tensor, with a buffer of its own, to a decoded subgraph.
+    :param model: The `Model` table
+    :param subgraph: The `SubGraph` table
+    :param name: Name of the new tensor
+    :param values: Contents of the tensor (anything `np.asarray` takes)
+    :return: Id of the new tensor
+    """
+    values = np.asarray(values, dtype=np.dtype(np.int32).newbyteorder("<"))
+    if model.buffers is None:
+        model.buffers = []
+    model.buffers.append(Table("Buffer", data=values.reshape(-1).view(np.uint8)))
+    subgraph.tensors.append(Table("Tensor", shape=np.array(values.shape, dtype=np.int32), type=TensorType.INT32,
+                                  buffer=len(model.buffers) - 1, name=name))
+    return len(subgraph.tensors) - 1
+
+
+def opcode_index(model, opcode):
+    """
+    Returns the index of the operator code of a builtin operator in a decoded model, adding it if the model doesn't
+    have it yet.
+    :param model: The `Model` table
+    :param opcode: `BuiltinOperator` code
+    """
+    if model.operator_codes is None:
+        model.operator_codes = []
+    for i, code in enumerate(model.operator_codes):
+        if code.builtin_code == opcode and code.custom_code is None:
+            return i
+    model.operator_codes.append(Table("OperatorCode", builtin_code=opcode, version=1))
+    return len(model.operator_codes) - 1
+
+
+def add_operator(model, subgraph, opcode, inputs, outputs, options_type=BuiltinOptions.NONE, options=None):
+    """
+    Adds a builtin operator to a decoded subgraph, after its other operators.
+    :param model: The `Model` table
+    :param subgraph: The `SubGraph` table
+    :param opcode: `BuiltinOperator` code
+    :param inputs: Ids of the input tensors
+    :param outputs: Ids of the output tensors
+    :param options_type: `BuiltinOptions` type of the options
+    :param options: The builtin options `Table`, or None
+    :return: Index of the new operator in the subgraph
+    """
+    subgraph.operators.append(Table("Operator", opcode_index=opcode_index(model, opcode),
+                                    inputs=np.array(inputs, dtype=np.int32), outputs=np.array(outputs, dtype=np.int32),
+                                    builtin_options_type=options_type, builtin_options=options))
+    return len(subgraph.operators) - 1
+
+
+def _vector_size(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes + BUFFER_ALIGNMENT
+    if isinstance(value, list):
+        return sum(_table_size(v) if isinstance(v, Table) else 8 + len(v) if isinstance(v, (bytes, str)) else 8
+                   for v in value) + 4 * len(value)
+    return 0
+
+
+def _table_size(table):
+    # Rough size of a table once serialized, to allocate the builder once rather than growing (and copying) it
+    size = 8 + 8 * len(_fields(table.table_type))
+    for field in _fields(table.table_type):
+        value = getattr(table, field)
+        if isinstance(value, Table):
+            size += _table_size(value)
+        elif isinstance(value, (bytes, str)):
+            size += len(value) + 8
+        else:
+            size += _vector_size(value)
+    return size
+
+
+def _encode_array(builder, values, alignment):
+    # Writes a vector of scalars with a single copy, straight from `values` into the builder (unlike
+    # `Builder.CreateNumpyVector`, which copies it into a `bytes` object first)
+    if values.dtype.byteorder == ">":
+        values = values.astype(values.dtype.newbyteorder("<"))
+    values = np.ascontiguousarray(values).reshape(-1)
+    builder.StartVector(values.itemsize, len(values), max(values.itemsize, alignment))
+    builder.head = builder.head - values.nbytes
+    memoryview(builder.Bytes)[builder.head:builder.head + values.nbytes] = values.view(np.uint8)
+    return builder.EndVector()
+
+
+def encode_table(builder, table):
+    """
+    Serializes a `Table` and everything it refers to with the builder functions of the bundled schema.
+    :param builder: A `flatbuffers.Builder`
+    :param table: The `Table`
+    :return: Builder offset of the table
+    """
+    module = _module(table.table_type)
+    offsets = {}
+    for field in _fields(table.table_type):
+        value = getattr(table, field)
+        if isinstance(value, Table):
+            offsets[field] = encode_table(builder, value)
+        elif isinstance(value, (bytes, str)):
+            offsets[field] = builder.CreateString(value)
+        elif isinstance(value, np.ndarray):
+            offsets[field] = _encode_array(builder, value, BUFFER_ALIGNMENT if table.table_type == "Buffer" else 1)
+        elif isinstance(value, list) and all(isinstance(v, (Table, bytes, str)) for v in value):
+            items = [encode_table(builder, v) if isinstance(v, Table) else builder.CreateString(v) for v in value]
+            builder.StartVector(4, len(items), 4)
+            for item in reversed(items):
+                builder.PrependUOffsetTRelative(item)
+            offsets[field] = builder.EndVector()
+        elif value is not None and not isinstance(value, (bool, int, float, np.generic)):
+            raise TypeError(f"Field {field} of {table.table_type} can't be a {type(value).__name__} (vectors of "
+                            f"scalars have to be NumPy arrays)")
+
+    getattr(module, f"{table.table_type}Start")(builder)
+    for field, camel in _fields(table.table_type).items():
+        value = offsets.get(field, getattr(table, field))
+        if value is not None:
+            getattr(module, f"{table.table_type}Add{camel}")(builder, value)
+    return getattr(module, f"{table.table_type}End")(builder)
+
+
+def encode_model(model):
+    """
+    Serializes a tree of `Table`s decoded by `decode_model` (and possibly edited) into a TFLite model. The contents of
+    buffers are copied into the model once, without intermediate copies.
+    :param model: The `Model` table
+    :return: The model as a bytearray
+    """
+    builder = flatbuffers.Builder(_table_size(model))
+    builder.Finish(encode_table(builder, model), file_identifier=b"TFL3")
+    # The model is built at the end of the builder's buffer; dropping the space in front of it doesn't copy it
+    model_bytes = builder.Bytes
+    del model_bytes[:builder.Head()]
+    return model_bytes
@@ -0,0 +1,96 @@
+from collections import namedtuple
+
+import numpy as np
+
+from .aliasing import ABS, HARD_SWISH, LEAKY_RELU, QUANTIZE
+from .model_rewriter import add_tensor, decode_model, encode_model
+from .tflite.BuiltinOperator import BuiltinOperator
+
+
+# Operators that are cheap enough to run a second time instead of keeping their output in memory
+RECOMPUTE_OPERATORS = {
+    BuiltinOperator.AVERAGE_POOL_2D, BuiltinOperator.MAX_POOL_2D, BuiltinOperator.L2_POOL_2D,
+    BuiltinOperator.CONV_2D, BuiltinOperator.DEPTHWISE_CONV_2D, BuiltinOperator.ADD, BuiltinOperator.SUB,
+    BuiltinOperator.MUL, BuiltinOperator.RELU, BuiltinOperator.RELU6, BuiltinOperator.RELU_N1_TO_1,
+    BuiltinOperator.LOGISTIC, BuiltinOperator.TANH, BuiltinOperator.NEG, BuiltinOperator.FLOOR, BuiltinOperator.PAD,
+    BuiltinOperator.DEQUANTIZE, LEAKY_RELU, ABS, QUANTIZE, HARD_SWISH,
+}
+
+_POOL_OPERATORS = {BuiltinOperator.AVERAGE_POOL_2D, BuiltinOperator.MAX_POOL_2D, BuiltinOperator.L2_POOL_2D}
+
+# Consumers (operator ids) that read a recomputed copy of a tensor (by id) instead of the original
+Recomputation = namedtuple("Recomputation", ["tensor", "consumers"])
+
+
+def operator_macs(op):
+    """
+    Estimates the number of multiply-accumulate operations of an operator. Operators other than convolutions,
+    fully-connected layers and pooling count one operation per output element.
+    """
+    if op.output is None:
+        return 0
+    output_size = int(np.prod(op.output.shape, dtype=np.int64))
+    if op.opcode == BuiltinOperator.CONV_2D:
+        # Weights are (output channels, height, width, input channels)
+        return output_size * int(np.prod(op.inputs[1].shape[1:], dtype=np.int64))
+    if op.opcode == BuiltinOperator.DEPTHWISE_CONV_2D:
+        return output_size * int(np.prod(op.inputs[1].shape[1:3], dtype=np.int64))
+    if op.opcode == BuiltinOperator.FULLY_CONNECTED:
+        return output_size * int(op.inputs[1].shape[-1])
+    if op.opcode in _POOL_OPERATORS and op.options is not None:
+        return output_size * op.options.FilterHeight() * op.options.FilterWidth()
+    return output_size
+
+
+def recompute_candidates(graph, op_order, max_operator_macs=None):
+    """
+    Lists the ways of recomputing a tensor for its later readers, so that it can be freed after the earlier ones:
+    for a tensor read by k operators, the last 1, ..., k - 1 of them (in the order of execution) can read a copy.
+    :param graph: A `TFLiteGraph`
+    :param op_order: Operators in the order of execution
+    :param max_operator_macs: Only recompute operators with at most this many multiply-accumulates (see
+    `operator_macs`)
+    :return: A list of `Recomputation`s
+    """
+    position = {op: k for k, op in enumerate(op_order)}
+    outputs = set(graph.outputs)
+    candidates = []
+    for t in graph.tensors:
+        op = t.producer
+        if op is None or t in outputs or op.opcode not in RECOMPUTE_OPERATORS:
+            continue
+        if max_operator_macs is not None and operator_macs(op) > max_operator_macs:
+            continue
+        consumers = sorted(set(t.consumers), key=position.get)
+        candidates += [Recomputation(t.id, [c.id for c in consumers[k:]]) for k in range(1, len(consumers))]
+    return candidates
+
+
+def recompute(model_bytes, graph, recomputation, subgraph=0):
+    """
+    Rewrites a model so that the producer of a tensor runs a second time, right before the first of the given
+    consumers, which read the new copy of the tensor.
+    :param model_bytes: The model
+    :param graph: The `TFLiteGraph` of the model, with operator ids matching the model's operator order
+    :param recomputation: A `Recomputation`
+    :param subgraph: Index of the subgraph that `graph` describes
+    :return: The rewritten model as a bytearray
+    """
+    model = decode_model(model_bytes)
+    s = model.subgraphs[subgraph]
+    t = graph.tensors[recomputation.tensor]
+    copy = add_tensor(s, t.id, f"{t.name}/recomputed")
+    duplicate = s.operators[t.producer.id].copy(outputs=np.array([copy], dtype=np.int32))
+
+    rewired = {}
+    for i in recomputation.consumers:
+        inputs = s.operators[i].inputs
+        rewired[i] = s.operators[i].copy(inputs=np.where(inputs == t.id, copy, inputs).astype(np.int32))
+
+    operators = []
+    for op in graph.operators:
+        if op.id == min(recomputation.consumers):
+            operators.append(duplicate)
+        operators.append(rewired.get(op.id, s.operators[op.id]))
+    s.operators = operators
+    return encode_model(model)
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+
+# Bump whenever the cost model or the hashed graph description changes, so that stale entries are not reused
+CACHE_FORMAT_VERSION = 4
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return Path(base) / "tflite-tools" / "schedules"
+
+
+def graph_hash(graph, options=None):
+    """
+    Computes a hash of the structure of a `TFLiteGraph`: tensor shapes and types, operator codes and connectivity
+    and graph inputs and outputs. Tensor names and buffer contents are left out, so retraining a model keeps its hash.
+    :param graph: A `TFLiteGraph`
+    :param options: A JSON-serialisable dict of memory model settings that the optimal order depends on
+    :return: A hex digest
+    """
+    description = {
+        "version": CACHE_FORMAT_VERSION,
+        "tensors": [[[int(d) for d in t.shape], int(t.type), bool(t.is_constant)] for t in graph.tensors],
+        "operators": [[op.opcode, [t.id for t in op.inputs], [t.id for t in op.outputs]] for op in graph.operators],
+        "inputs": [t.id for t in graph.inputs],
+        "outputs": [t.id for t in graph.outputs],
+        "options": options or {},
+    }
+    return hashlib.sha256(json.dumps(description, separators=(",", ":")).encode("ascii")).hexdigest()
+
+
+def _is_valid_order(graph, op_ids):
+    if sorted(op_ids) != list(range(len(graph.operators))):
+        return False
+    position = {op_id: i for i, op_id in enumerate(op_ids)}
+    for op in graph.operators:
+        for t in op.inputs:
+            if t.producer is not None and position[t.producer.id] >= position[op.id]:
+                return False
+    return True
+
+
+class ScheduleCache:
+    """
+    On-disk cache of optimal operator orders, keyed by `graph_hash`. Each entry is a small JSON file; the least
+    recently used entries are evicted once there are more than `max_entries` of them.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=256):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else default_cache_dir()
+        self.max_entries = max_entries
+
+    def _entry_path(self, key):
+        return self.cache_dir / f"{key}.json"
+
+    def load(self, graph, options=None):
+        """
+        Looks up the optimal operator order of a graph.
+        :param graph: A `TFLiteGraph`
+        :param options: Memory model settings, see `graph_hash`
+        :return: A tuple of peak memory usage and the list of operators in the order of execution, or None
+        """
+        path = self._entry_path(graph_hash(graph, options))
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            peak, op_ids = int(entry["peak"]), [int(i) for i in entry["op_order"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if not _is_valid_order(graph, op_ids):
+            return None
+
+        try:
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            pass
+        return peak, [graph.operators[i] for i in op_ids]
+
+    def store(self, graph, peak, op_order, options=None):
+        """
+        Saves the optimal operator order of a graph. Failing to write the cache is not an error.
+        :param graph: A `TFLiteGraph`
+        :param peak: Peak memory usage of the operator order
+        :param op_order: The list of operators in the order of execution
+        :param options: Memory model settings, see `graph_hash`
+        """
+        entry = {"peak": int(peak), "op_order": [op.id for op in op_order]}
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first, so that concurrent readers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._entry_path(graph_hash(graph, options)))
+            self._evict()
+        except OSError:
+            pass
+
+    def _evict(self):
+        entries = []
+        for path in self.cache_dir.glob("*.json"):
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except OSError:
+                pass
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.max_entries, 0)]:
+            try:
+                path.unlink()
+            except OSError:
+                pass
@@ -0,0 +1,923 @@
+import itertools
+import multiprocessing
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .memo_table import MemoStats, MemoTable, add_memo_stats, _iter_bits
+
+
+SearchStats = namedtuple("SearchStats", ["explored", "pruned", "complete", "lower_bound", "memo"])
+
+
+def transitive_closure(direct_masks):
+    """
+    Computes reachability in a DAG given as integer bitsets: bit `j` of `direct_masks[i]` is set if node `j` is a
+    direct predecessor of node `i`. Uses an explicit stack, so arbitrarily deep graphs don't hit the recursion limit.
+    :param direct_masks: A list of bitsets of direct predecessors, one per node
+    :return: A list of bitsets of all (direct and indirect) predecessors, one per node
+    """
+    closure = [None] * len(direct_masks)
+    for root in range(len(direct_masks)):
+        stack = [root]
+        while stack:
+            i = stack[-1]
+            if closure[i] is not None:
+                stack.pop()
+                continue
+            pending = [j for j in _iter_bits(direct_masks[i]) if closure[j] is None]
+            if pending:
+                stack += pending
+                continue
+            mask = direct_masks[i]
+            for j in _iter_bits(direct_masks[i]):
+                mask |= closure[j]
+            closure[i] = mask
+            stack.pop()
+    return closure
+
+
+class BitmaskScheduleSearch:
+    """
+    Finds an operator order that minimises peak memory usage of a `TFLiteGraph`.
+
+    Starting from the graph outputs, we repeatedly "unapply" the operator that produced one of the tensors in the
+    working set. Working sets are encoded as integer bitmasks over a dense index of the tensors that need memory. An
+    operator with several outputs (e.g. SPLIT) is unapplied through the bit of its first output that's needed to
+    compute the graph outputs, once none of the others is needed anymore: all of those leave the working set together,
+    and outputs that nothing needs only take memory while the operator runs.
+
+    Model inputs are in memory from the start until their last reader runs, and are counted once however many
+    operators read them: they enter the working set when the last operator that reads them is unapplied and are never
+    unapplied themselves. Those that are also outputs are in memory all along. Weights don't take any memory.
+
+    `terminals` maps tensors to the peak memory usage of computing them, for when the search is limited to a part of
+    the graph: such tensors are treated as if their producer had no inputs but needed that much memory.
+
+    An operator's output takes no extra memory while it's being computed if the operator can write it over one of
+    its `in_place_inputs` that isn't needed afterwards (see `aliasing.alias_graph`). Its `scratch_size` is added to
+    the memory in use while it runs.
+
+    `memo_limit` and `spill_limit` bound the size of the memo table in memory and on disk (see `MemoTable`).
+    """
+
+    def __init__(self, graph, terminals=None, memo_limit=None, spill_limit=0):
+        self.graph = graph
+        terminals = terminals or {}
+
+        outputs = set(graph.outputs)
+        produced = [t for t in graph.tensors if t.producer is not None]
+        sources = [i for op in graph.operators for i in op.inputs
+                   if i.producer is None and i.size and i not in outputs]
+        self.tensors = produced + list(dict.fromkeys(sources))
+        self.index = {t: i for i, t in enumerate(self.tensors)}
+        self.sizes = np.array([t.size for t in self.tensors], dtype=np.int64)
+        self._size_list = self.sizes.tolist()  # Python ints are much faster to add up than NumPy scalars
+        self.source_mask = sum(1 << i for i in range(len(produced), len(self.tensors)))
+
+        # Per tensor: its producer's inputs that need memory (as a bitmask and a list of indices), the memory that
+        # the producer needs on top of its inputs and outputs, and a bitmask of the inputs that it can be written over
+        self.input_mask = []
+        self.input_bits = []
+        self.hidden_size = []
+        self.in_place_mask = []
+        for t in self.tensors:
+            is_computed = t.producer is not None and t not in terminals
+            hidden_size = int(terminals[t] - t.size) if t in terminals else 0
+            op_inputs = set(t.producer.inputs) if is_computed else set()
+            bits = sorted(self.index[i] for i in op_inputs if i in self.index)
+            self.input_bits.append(bits)
+            self.input_mask.append(sum(1 << b for b in bits))
+            self.hidden_size.append(t.producer.scratch_size if is_computed else hidden_size)
+            in_place = [i for i in t.producer.in_place_inputs if i in self.index] if is_computed else []
+            self.in_place_mask.append(self._mask_of(in_place))
+
+        # Model inputs that are also outputs stay in memory throughout
+        self.free_output_size = int(sum(t.size for t in outputs if t.producer is None))
+        self.root = self._mask_of(t for t in outputs if t.producer is not None)
+        self.root_size = self._mask_size(self.root)
+
+        # Per tensor: the outputs of its producer that leave the working set when it's unapplied, and their size.
+        # Other outputs of multi-output operators are never unapplied on their own.
+        self.output_mask = [1 << i for i in range(len(self.tensors))]
+        self.output_size = list(self._size_list)
+        self.secondary_mask = 0
+        # Bit through which each operator is unapplied
+        self.operator_index = {}
+        dependencies = transitive_closure(self.input_mask)
+        needed = self.root
+        for i in _iter_bits(self.root):
+            needed |= dependencies[i]
+        for t in self.tensors:
+            op = t.producer
+            if op is None or op in self.operator_index:
+                continue
+            if t in terminals:
+                self.operator_index[op] = self.index[t]
+                continue
+            bits = [self.index[o] for o in dict.fromkeys(op.outputs) if o in self.index]
+            used = [i for i in bits if (needed >> i) & 1] or bits
+            i = used[0]
+            self.operator_index[op] = i
+            self.output_mask[i] = sum(1 << j for j in used)
+            self.output_size[i] = sum(self._size_list[j] for j in used)
+            self.hidden_size[i] += sum(self._size_list[j] for j in bits if j not in used)
+            self.secondary_mask |= self.output_mask[i] & ~(1 << i)
+
+        # A tensor depends on all outputs of the operators that compute its inputs
+        groups = [(self.output_mask[self.operator_index[t.producer]] if t.producer is not None else 0) | (1 << i)
+                  for i, t in enumerate(self.tensors)]
+        direct_masks = []
+        for bits in self.input_bits:
+            mask = 0
+            for j in bits:
+                mask |= groups[j]
+            direct_masks.append(mask)
+        self.predecessor_mask = transitive_closure(direct_masks)
+
+        self.memo = MemoTable(self.predecessor_mask, memo_limit, spill_limit)
+
+    def _mask_of(self, tensors):
+        return sum(1 << self.index[t] for t in set(tensors))
+
+    def _mask_size(self, mask):
+        return sum(self._size_list[i] for i in _iter_bits(mask))
+
+    def _blocked(self, mask):
+        # A tensor can only be unapplied if no other tensor in the working set depends on it; model inputs can't be
+        # unapplied at all, and other outputs of multi-output operators only along with the first one
+        blocked = self.source_mask | self.secondary_mask
+        for i in _iter_bits(mask):
+            blocked |= self.predecessor_mask[i]
+        return blocked
+
+    def _unapply(self, mask, mask_size, i):
+        # Returns the working set (and its size) from before tensor `i` was computed, as well as the size of
+        # all tensors in memory while it's being computed.
+        added_size = sum(self._size_list[j] for j in self.input_bits[i] if not (mask >> j) & 1)
+        new_mask = (mask & ~self.output_mask[i]) | self.input_mask[i]
+        in_memory = mask_size + added_size + self.hidden_size[i]
+        if self.in_place_mask[i] & ~mask:
+            # One of the inputs dies here, so the output can take its place
+            in_memory -= self._size_list[i]
+        if not new_mask & ~self.source_mask:
+            # Only model inputs are left, which are already in memory when the first operator runs
+            return 0, 0, in_memory
+        return new_mask, mask_size - self.output_size[i] + added_size, in_memory
+
+    @staticmethod
+    def _raise_recursion_limit(depth):
+        # Recursion depth is bounded by the number of operators on the longest path
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 2 * depth + 1000))
+
+    def solve(self):
+        """
+        Runs the search.
+        :return: A tuple of peak memory usage and the list of operators in the order of execution
+        """
+        self._raise_recursion_limit(len(self.tensors))
+        peak = self.free_output_size + self._mem(self.root, self.root_size)
+        return peak, self._reconstruct_order(self.root)
+
+    def _mem(self, mask, mask_size):
+        # Computes the peak memory usage of a runtime system that computes all tensors in `mask`;
+        # `mask_size` is the total size of those tensors.
+        if mask == 0:
+            return 0
+        return self._mem_entry(mask, mask_size)[0]
+
+    def _mem_entry(self, mask, mask_size):
+        # Returns the memo table entry of `mask`, computing it if it's missing or only a lower bound
+        entry = self.memo.get(mask)
+        if entry is not None and entry[1] >= 0:
+            return entry
+
+        min_use = sys.maxsize
+        choice = -1
+        for i in _iter_bits(mask & ~self._blocked(mask)):
+            new_mask, new_size, in_memory = self._unapply(mask, mask_size, i)
+            mem_use = max(self._mem(new_mask, new_size), in_memory)
+            if mem_use < min_use:
+                min_use = mem_use
+                choice = i
+
+        entry = (min_use, choice)
+        self.memo[mask] = entry
+        return entry
+
+    def __getstate__(self):
+        # Worker processes only need the bitmask encoding of the graph (the memo table is copied empty)
+        state = dict(self.__dict__)
+        for key in ("graph", "tensors", "index", "operator_index", "initial_orders", "best_order"):
+            state.pop(key, None)
+        return state
+
+    def _reconstruct_bits(self, mask):
+        # Returns indices of the tensors computed by the best order for `mask`, in the order of execution. Entries
+        # evicted from a bounded memo table are recomputed.
+        bits = []
+        mask_size = self._mask_size(mask)
+        while mask:
+            i = self._mem_entry(mask, mask_size)[1]
+            bits.append(i)
+            mask, mask_size, _ = self._unapply(mask, mask_size, i)
+        bits.reverse()
+        return bits
+
+    def _reconstruct_order(self, mask):
+        return [self.tensors[i].producer for i in self._reconstruct_bits(mask)]
+
+    def evaluate_order(self, op_order):
+        """
+        Computes peak memory usage of a given operator order under the cost model of the search.
+        :param op_order: Operators in the order of execution; operators that don't contribute to the outputs are ignored
+        :return: A tuple of peak memory usage and the operators that contribute to the outputs, in order
+        """
+        mask, mask_size = self.root, self.root_size
+        peak = 0
+        used_ops = []
+        for op in reversed(op_order):
+            i = self.operator_index.get(op)
+            if i is None or not (mask >> i) & 1:
+                continue
+            mask, mask_size, in_memory = self._unapply(mask, mask_size, i)
+            peak = max(peak, in_memory)
+            used_ops.append(op)
+        assert mask == 0, "Operator order does not compute all outputs"
+        used_ops.reverse()
+        return self.free_output_size + peak, used_ops
+
+    def greedy_order(self):
+        """
+        Builds an operator order by always unapplying the operator that leaves the smallest working set behind.
+        :return: Operators in the order of execution
+        """
+        mask, mask_size = self.root, self.root_size
+        op_order = []
+        while mask:
+            best = None
+            for i in _iter_bits(mask & ~self._blocked(mask)):
+                new_mask, new_size, _ = self._unapply(mask, mask_size, i)
+                if best is None or new_size < best[0]:
+                    best = (new_size, new_mask, i)
+            mask_size, mask, i = best
+            op_order.append(self.tensors[i].producer)
+        op_order.reverse()
+        return op_order
+
+
+class SearchBudgetExhausted(Exception):
+    pass
+
+
+class SearchStopped(SearchBudgetExhausted):
+    # Raised when there's no need to search any further, e.g. once the target is met
+    pass
+
+
+class BranchAndBoundScheduleSearch(BitmaskScheduleSearch):
+    """
+    A variant of `BitmaskScheduleSearch` that discards branches which can't beat the best known operator order.
+
+    The upper bound is seeded from the given operator orders (e.g. the one in the model file) and a greedy
+    heuristic. A branch is cut when its lower bound --- the size of the current working set, or the largest
+    footprint (inputs and output) of an operator that still needs to be unapplied --- reaches the bound.
+    The memo table stores both exact results and lower bounds of states that were cut.
+
+    The search always holds a valid best-so-far operator order, so it can be stopped early by giving it a time
+    limit (`timeout`, in seconds) or a limit on the number of explored states (`max_states`).
+
+    With a `target` peak memory usage, the search stops at the first order that meets it (preferring the given
+    orders, in turn, over anything else) and only looks for orders that do, so it also stops early if the lower
+    bound shows that none can; `lower_bound` is then above the target. `bottleneck` is the tensor whose producer
+    needs more memory than the target on its own, if that's why.
+    """
+
+    def __init__(self, graph, initial_orders=(), timeout=None, max_states=None, terminals=None, memo_limit=None,
+                 spill_limit=0, target=None):
+        super().__init__(graph, terminals, memo_limit, spill_limit)
+        self.initial_orders = list(initial_orders)
+        self.timeout = timeout
+        self.max_states = max_states
+        self.target = target
+
+        self.footprint = [sum(self._size_list[j] for j in self.input_bits[i]) + self.hidden_size[i]
+                          + (self.output_size[i] if not self.in_place_mask[i] else 0) for i in range(len(self.tensors))]
+        # Largest footprint of any operator needed to compute a tensor (including its producer)
+        self.upstream_footprint = [max([self.footprint[i]] + [self.footprint[j]
+                                                              for j in _iter_bits(self.predecessor_mask[i])])
+                                   for i in range(len(self.tensors))]
+
+        self.explored = 0
+        self.pruned = 0
+        self.complete = False
+        self.lower_bound = 0
+        self.best_peak = sys.maxsize
+        self.best_bits = None
+        self.best_order = None
+        self.bottleneck = None
+        self._path = []
+        self._deadline = None
+        self._recomputing = False
+
+    @property
+    def stats(self):
+        return SearchStats(self.explored, self.pruned, self.complete, self.lower_bound, self.memo_stats)
+
+    @property
+    def memo_stats(self):
+        return self.memo.stats
+
+    def solve(self):
+        """
+        Runs the search until it completes or runs out of budget.
+        :return: A tuple of the best found peak memory usage and the list of operators in the order of execution
+        """
+        self._raise_recursion_limit(len(self.tensors))
+
+        self._seed()
+        self._path = []
+        self._deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        try:
+            if self._target_reached() or self._target_infeasible():
+                raise SearchStopped()
+            mem_use, exact = self._search(self.root, self.root_size, self._peak_bound() - self.free_output_size,
+                                          self.free_output_size, 0)
+            if self.target is not None and self.best_peak > self.target:
+                # Nothing meets the target, which is all the search looked for
+                self.lower_bound = self.free_output_size + mem_use
+            else:
+                self.complete = True
+                self.lower_bound = self.best_peak
+                if exact:
+                    # Report the order chosen by the memo table rather than the first one that was found
+                    self.best_bits = self._reconstruct_bits(self.root)
+        except SearchBudgetExhausted:
+            self.lower_bound = max(self.lower_bound, self._proven_lower_bound())
+
+        self.best_order = [self.tensors[i].producer for i in self.best_bits]
+        return self.best_peak, self.best_order
+
+    def _seed(self):
+        candidates = [self.evaluate_order(o) for o in self.initial_orders + [self.greedy_order()]]
+        self.best_peak, op_order = min(candidates, key=lambda c: c[0])
+        if self.target is not None and self.best_peak <= self.target:
+            self.best_peak, op_order = next(c for c in candidates if c[0] <= self.target)
+        self.best_bits = [self.operator_index[op] for op in op_order]
+
+    def _peak_bound(self):
+        # Peak memory usage that an order has to stay below to be of any use
+        return min(self.best_peak, self.target + 1) if self.target is not None else self.best_peak
+
+    def _target_reached(self):
+        return self.target is not None and self.best_peak <= self.target
+
+    def _target_infeasible(self):
+        # Checks whether the outputs or the footprint of a single operator prove that no order meets the target
+        lower_bound = self.free_output_size + self._lower_bound(self.root, self.root_size)
+        if self.target is None or lower_bound <= self.target:
+            return False
+        self.lower_bound = lower_bound
+        needed = self.root
+        for i in _iter_bits(self.root):
+            needed |= self.predecessor_mask[i]
+        i = max(_iter_bits(needed & ~self.source_mask), key=self.footprint.__getitem__, default=None)
+        if i is not None and self.free_output_size + self.footprint[i] > self.target:
+            self.bottleneck = self.tensors[i]
+        return True
+
+    def _check_budget(self):
+        if self.max_states is not None and self.explored > self.max_states:
+            raise SearchBudgetExhausted()
+        if self._deadline is not None and self.explored % 256 == 0 and time.monotonic() > self._deadline:
+            raise SearchBudgetExhausted()
+
+    def _lower_bound(self, mask, mask_size):
+        return max([mask_size] + [self.upstream_footprint[i] for i in _iter_bits(mask)])
+
+    def _proven_lower_bound(self):
+        lower_bound = self._state_lower_bound(self.root, self.root_size)
+        return min(self.free_output_size + lower_bound, self.best_peak)
+
+    def _state_lower_bound(self, mask, mask_size):
+        # Looks one step ahead, using whatever the memo table has learned about each branch
+        if mask == 0:
+            return 0
+        entry = self.memo.get(mask)
+        if entry is not None and entry[1] >= 0:
+            return entry[0]
+        branches = []
+        for i in _iter_bits(mask & ~self._blocked(mask)):
+            new_mask, new_size, in_memory = self._unapply(mask, mask_size, i)
+            upstream_mem_use = self._lower_bound(new_mask, new_size) if new_mask else 0
+            entry = self.memo.get(new_mask)
+            if entry is not None:
+                upstream_mem_use = max(upstream_mem_use, entry[0])
+            branches.append(max(in_memory, upstream_mem_use))
+        return max(self._lower_bound(mask, mask_size), min(branches), entry[0] if entry is not None else 0)
+
+    def _mem_entry(self, mask, mask_size):
+        entry = self.memo.get(mask)
+        if entry is not None and entry[1] >= 0:
+            return entry
+        # The entry was evicted from a bounded memo table, so search the state again. It's on the path of an order
+        # that was already found, so there's no budget to stay under, and the best-so-far order is left alone (an
+        # offset of -1 lets results tied with the best peak memory usage through).
+        self._recomputing = True
+        try:
+            self._search(mask, mask_size, sys.maxsize, -1, 0)
+        finally:
+            self._recomputing = False
+        return self.memo.get(mask)
+
+    def _update_best(self, mask, mem_use, offset, path_peak):
+        # Called with the exact memory usage of computing `mask`, reached by unapplying the tensors in `self._path`
+        if self._recomputing:
+            return
+        peak = max(path_peak, offset + mem_use)
+        if peak < self.best_peak:
+            self.best_peak = peak
+            self.best_bits = self._reconstruct_bits(mask) + self._path[::-1]
+            if self._target_reached():
+                raise SearchStopped()
+
+    def _search(self, mask, mask_size, budget, offset, path_peak):
+        # Like `_mem`, but only looks for results below `budget`. Returns a tuple of memory usage and whether it's
+        # exact; if it isn't, the returned value is a lower bound. `offset` is the memory in use throughout (model
+        # inputs that are outputs) and `path_peak` the largest memory usage on the path from the outputs to this
+        # state.
+        if mask == 0:
+            self._update_best(mask, 0, offset, path_peak)
+            return 0, True
+        entry = self.memo.get(mask)
+        lower_bound = 0
+        if entry is not None:
+            if entry[1] >= 0:
+                self._update_best(mask, entry[0], offset, path_peak)
+                return entry[0], True
+            lower_bound = entry[0]
+
+        lower_bound = max(lower_bound, self._lower_bound(mask, mask_size))
+        if lower_bound >= budget:
+            self.pruned += 1
+            return lower_bound, False
+        self.explored += 1
+        self._check_budget()
+
+        min_use = sys.maxsize
+        min_pruned_use = sys.maxsize
+        choice = -1
+        for i in _iter_bits(mask & ~self._blocked(mask)):
+            new_mask, new_size, in_memory = self._unapply(mask, mask_size, i)
+            # The best-so-far order may have improved in another branch
+            budget = min(budget, self._peak_bound() - offset)
+            bound = min(min_use, budget)
+            if in_memory >= bound:
+                self.pruned += 1
+                min_pruned_use = min(min_pruned_use, in_memory)
+                continue
+
+            self._path.append(i)
+            upstream_mem_use, exact = self._search(new_mask, new_size, bound, offset,
+                                                   max(path_peak, offset + in_memory))
+            self._path.pop()
+            mem_use = max(upstream_mem_use, in_memory)
+            if exact and mem_use < min_use:
+                min_use = mem_use
+                choice = i
+            else:
+                min_pruned_use = min(min_pruned_use, mem_use)
+
+        # Branches cut against a tighter budget than `min_use` could still be better than it
+        if choice >= 0 and min_use <= min(budget, self._peak_bound() - offset):
+            self.memo[mask] = (min_use, choice)
+            return min_use, True
+
+        lower_bound = max(lower_bound, min(min_use, min_pruned_use))
+        self.memo[mask] = (lower_bound, -1)
+        return lower_bound, False
+
+
+# Worker process state for `ParallelScheduleSearch`: values shared with the other workers, and the last search object
+# that was received, so its memo table carries over between subtrees of the same search
+_worker_shared = None
+_worker_search = None
+_search_keys = itertools.count()
+
+
+def _init_worker(shared_best_peak, shared_explored):
+    global _worker_shared
+    _worker_shared = (shared_best_peak, shared_explored)
+
+
+def _search_subtree(key, search, subtree, deadline):
+    global _worker_search
+    if _worker_search is None or _worker_search[0] != key:
+        _worker_search = (key, search)
+    return _worker_search[1].search_subtree(subtree, deadline, _worker_shared)
+
+
+class SearchPool:
+    """
+    A process pool for `ParallelScheduleSearch`, along with the best peak memory usage found so far and the number
+    of explored states, which are shared by its workers.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.best_peak = multiprocessing.Value("q", 0)
+        self.explored = multiprocessing.Value("q", 0)
+        self.executor = ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(self.best_peak, self.explored))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.executor.shutdown()
+
+
+class ParallelScheduleSearch(BranchAndBoundScheduleSearch):
+    """
+    Runs `BranchAndBoundScheduleSearch` on a `SearchPool`. States closest to the outputs are enumerated breadth-first
+    until there are enough of them to keep all workers busy, then each of them is searched by a worker. Workers
+    publish improvements to the best peak memory usage, so all of them prune against the best order found anywhere.
+    Results are combined with the same recurrence as the serial search, so the peak memory usage is the same.
+    """
+
+    def __init__(self, graph, pool, initial_orders=(), timeout=None, max_states=None, terminals=None, memo_limit=None,
+                 spill_limit=0, target=None):
+        super().__init__(graph, initial_orders, timeout, max_states, terminals, memo_limit, spill_limit, target)
+        self.pool = pool
+        self._key = next(_search_keys)
+        self._shared = None
+        self._synced = 0
+        self.worker_memo_stats = MemoStats(0, 0, 0, 0, 0)
+
+    @property
+    def memo_stats(self):
+        return add_memo_stats(self.memo.stats, self.worker_memo_stats)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        del state["pool"]
+        return state
+
+    def solve(self):
+        self._raise_recursion_limit(len(self.tensors))
+        self._seed()
+        if self._target_reached() or self._target_infeasible():
+            self.lower_bound = max(self.lower_bound, self._proven_lower_bound())
+            self.best_order = [self.tensors[i].producer for i in self.best_bits]
+            return self.best_peak, self.best_order
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+
+        expanded, frontier = self._expand()
+        self.explored += len(expanded)
+        self.pool.best_peak.value = self.best_peak
+        self.pool.explored.value = self.explored
+        futures = {mask: self.pool.executor.submit(_search_subtree, self._key, self, (mask, ) + subtree, deadline)
+                   for mask, subtree in frontier.items()}
+
+        values = {}
+        leaf_bits = {}
+        self.complete = True
+        for mask, future in futures.items():
+            mem_use, exact, bits, complete, explored, pruned, memo_stats, best_peak, best_bits = future.result()
+            values[mask] = (mem_use, exact)
+            leaf_bits[mask] = bits
+            self.complete = self.complete and complete
+            self.explored += explored
+            self.pruned += pruned
+            self.worker_memo_stats = add_memo_stats(self.worker_memo_stats, memo_stats)
+            if best_bits is not None and best_peak < self.best_peak:
+                self.best_peak, self.best_bits = best_peak, best_bits
+
+        choices = {}
+        for mask, branches in reversed(expanded):
+            values[mask], choice = self._combine(branches, values)
+            if choice is not None:
+                choices[mask] = choice
+
+        mem_use, exact = values[self.root]
+        if self.complete and self.target is not None and self.best_peak > self.target:
+            # Nothing meets the target, which is all the search looked for
+            self.complete = False
+            self.lower_bound = self.free_output_size + mem_use
+        else:
+            if exact:
+                branches = dict(expanded)
+                path = []
+                mask = self.root
+                while mask in choices:
+                    i = choices[mask]
+                    path.append(i)
+                    mask = next(new_mask for j, _, new_mask in branches[mask] if j == i)
+                self.best_peak = self.free_output_size + mem_use
+                self.best_bits = leaf_bits[mask] + path[::-1]
+            self.lower_bound = self.best_peak if self.complete else min(self.free_output_size + mem_use, self.best_peak)
+
+        self.best_order = [self.tensors[i].producer for i in self.best_bits]
+        return self.best_peak, self.best_order
+
+    def _expand(self):
+        # Returns a list of expanded states, each with a list of its branches (index of the unapplied tensor, memory
+        # usage while computing it, resulting state or None if cut), and a frontier mapping unexpanded states to (mask
+        # size, budget, offset, path peak, path).
+        expanded = []
+        frontier = {self.root: (self.root_size, self.free_output_size, 0, [])}
+        while frontier and len(frontier) < 4 * self.pool.jobs and 0 not in frontier:
+            next_frontier = {}
+            for mask, (mask_size, offset, path_peak, path) in frontier.items():
+                budget = self._peak_bound() - offset
+                branches = []
+                for i in _iter_bits(mask & ~self._blocked(mask)):
+                    new_mask, new_size, in_memory = self._unapply(mask, mask_size, i)
+                    if in_memory >= budget:
+                        branches.append((i, in_memory, None))
+                        continue
+                    branches.append((i, in_memory, new_mask))
+                    new_path = (new_size, offset, max(path_peak, offset + in_memory), path + [i])
+                    if new_mask not in next_frontier or new_path[1:3] < next_frontier[new_mask][1:3]:
+                        next_frontier[new_mask] = new_path
+                expanded.append((mask, branches))
+            frontier = next_frontier
+        return expanded, {mask: (mask_size, self._peak_bound() - offset, offset, path_peak, path)
+                          for mask, (mask_size, offset, path_peak, path) in frontier.items()}
+
+    @staticmethod
+    def _combine(branches, values):
+        # Same as the end of `BranchAndBoundScheduleSearch._search`, for already searched branches
+        min_use = sys.maxsize
+        min_pruned_use = sys.maxsize
+        choice = -1
+        for i, in_memory, new_mask in branches:
+            if new_mask is None:
+                min_pruned_use = min(min_pruned_use, in_memory)
+                continue
+            upstream_mem_use, exact = values[new_mask]
+            mem_use = max(upstream_mem_use, in_memory)
+            if exact and mem_use < min_use:
+                min_use = mem_use
+                choice = i
+            else:
+                min_pruned_use = min(min_pruned_use, mem_use)
+        if choice >= 0 and min_use <= min_pruned_use:
+            return (min_use, True), choice
+        return (min(min_use, min_pruned_use), False), None
+
+    def search_subtree(self, subtree, deadline, shared):
+        """
+        Searches a single state in a worker process.
+        :return: A tuple of the search result (memory usage, whether it's exact and the order of execution as tensor
+        indices), whether the search completed, search and memo table statistics and the best order found (peak
+        memory usage and the order as tensor indices, or None)
+        """
+        mask, mask_size, budget, offset, path_peak, path = subtree
+        # The memo table carries over between subtrees, so only report what happens while searching this one
+        self.memo.reset_stats()
+        self._shared = shared
+        self.explored = self.pruned = self._synced = 0
+        self.best_peak = shared[0].value
+        self.best_bits = None
+        self._path = list(path)
+        self._deadline = time.monotonic() + deadline - time.time() if deadline is not None else None
+        self._raise_recursion_limit(len(self.input_bits))
+        try:
+            mem_use, exact = self._search(mask, mask_size, min(budget, self._peak_bound() - offset), offset, path_peak)
+            complete = True
+        except SearchBudgetExhausted:
+            mem_use, exact, complete = self._state_lower_bound(mask, mask_size), False, False
+        self._sync()
+        bits = self._reconstruct_bits(mask) if exact else None
+        return (mem_use, exact, bits, complete, self.explored, self.pruned, self.memo.stats, self.best_peak,
+                self.best_bits)
+
+    def _sync(self):
+        # Publishes the number of explored states, picks up improvements found by other workers and returns the
+        # total number of explored states
+        shared_best_peak, shared_explored = self._shared
+        with shared_explored.get_lock():
+            shared_explored.value += self.explored - self._synced
+            total = shared_explored.value
+        self._synced = self.explored
+        self.best_peak = min(self.best_peak, shared_best_peak.value)
+        return total
+
+    def _check_budget(self):
+        if self._shared is not None and self.explored % 256 == 0:
+            explored = self._sync()
+            if self.max_states is not None and explored > self.max_states:
+                raise SearchBudgetExhausted()
+            if self._target_reached():
+                # Another worker met the target
+                raise SearchStopped()
+        super()._check_budget()
+
+    def _update_best(self, mask, mem_use, offset, path_peak):
+        best_peak = self.best_peak
+        super()._update_best(mask, mem_use, offset, path_peak)
+        if self._shared is not None and self.best_peak < best_peak:
+            shared_best_peak = self._shared[0]
+            with shared_best_peak.get_lock():
+                shared_best_peak.value = min(shared_best_peak.value, self.best_peak)
+
+
+def _needed_tensors(graph):
+    needed = 0
+    for t in graph.outputs:
+        needed |= (1 << t.id) | t.predecessor_mask
+    return {graph.tensors[i] for i in _iter_bits(needed)}
+
+
+def find_cut_points(graph, op_order):
+    """
+    Finds tensors at which the graph can be split into independently schedulable segments. Each cut point dominates
+    the outputs: every operator needed to compute the outputs either contributes to it or depends on it, and it's
+    the only tensor with a producer that has to be kept in memory in between.
+    :param graph: A `TFLiteGraph`
+    :param op_order: A valid order of execution of the operators (e.g. the one in the model file)
+    :return: A list of cut point tensors, ordered from the inputs to the outputs
+    """
+    outputs = set(graph.outputs)
+    needed = _needed_tensors(graph)
+    op_order = [op for op in op_order if any(t in needed for t in op.outputs)]
+    position = {op: k for k, op in enumerate(op_order)}
+
+    # Sweep over tensor lifetimes to find how many tensors are kept in memory after each operator
+    num_operators = len(op_order)
+    live_diff = np.zeros(num_operators + 1, dtype=np.int64)
+    for k, op in enumerate(op_order):
+        for t in set(op.outputs) & needed:
+            last_used_at = num_operators if t in outputs else max(position[c] for c in t.consumers if c in position)
+            live_diff[k] += 1
+            live_diff[last_used_at] -= 1
+    live_count = np.cumsum(live_diff)
+
+    # Operators that only consume tensors without a producer don't depend on anything scheduled before them, so
+    # there can't be a cut point before the last one of those
+    sources = [k for k, op in enumerate(op_order) if all(t.producer is None for t in op.inputs)]
+    first_cut = sources[-1] if sources else 0
+    return [next(t for t in op.outputs if t in needed) for k, op in enumerate(op_order[:-1])
+            if k >= first_cut and live_count[k] == 1]
+
+
+class SegmentedScheduleSearch:
+    """
+    Splits the graph at its cut points (see `find_cut_points`) and runs `BranchAndBoundScheduleSearch` on each
+    segment, from the inputs towards the outputs. Each segment sees the cut point before it as a terminal, with the
+    peak memory usage found for the previous segment, so stitching the per-segment orders together gives an optimal
+    order for the whole graph. The search effort then grows with the size of the largest segment rather than the
+    size of the graph.
+
+    A time limit or a limit on the number of explored states is shared by all segments. With `jobs` > 1, segments
+    that a serial search can't solve within `PARALLEL_SEARCH_THRESHOLD` states are handed over to a
+    `ParallelScheduleSearch`. Memo table limits apply to each segment (and each worker process) separately.
+
+    With a `target` peak memory usage, each segment stops at the first order that meets it. Once a segment can't
+    meet it, the remaining segments keep their given order, and `lower_bound` (and `bottleneck`, see
+    `BranchAndBoundScheduleSearch`) shows why.
+    """
+
+    PARALLEL_SEARCH_THRESHOLD = 10000
+
+    def __init__(self, graph, initial_orders=(), timeout=None, max_states=None, jobs=1, memo_limit=None,
+                 spill_limit=0, target=None):
+        self.graph = graph
+        self.initial_orders = list(initial_orders)
+        self.timeout = timeout
+        self.max_states = max_states
+        self.jobs = jobs
+        self.memo_limit = memo_limit
+        self.spill_limit = spill_limit
+        self.target = target
+        self.segments = self._split(find_cut_points(graph, graph.operators))
+        self._deadline = None
+
+        self.explored = 0
+        self.pruned = 0
+        self.complete = True
+        self.lower_bound = 0
+        self.infeasible = False
+        self.bottleneck = None
+        self.memo_stats = MemoStats(0, 0, 0, 0, 0)
+
+    @property
+    def stats(self):
+        return SearchStats(self.explored, self.pruned, self.complete, self.lower_bound, self.memo_stats)
+
+    def _split(self, cut_points):
+        # Returns a list of (terminal tensor or None, `TFLiteGraph` of the segment, the initial orders restricted to
+        # the segment). Model inputs that are read in a later segment are outputs of the earlier ones, as they stay in
+        # memory until then.
+        needed = _needed_tensors(self.graph)
+        parts = [(None, [])]
+        cut_points = set(cut_points)
+        for op in self.graph.operators:
+            if not any(t in needed for t in op.outputs):
+                continue
+            parts[-1][1].append(op)
+            cut = next((t for t in op.outputs if t in cut_points), None)
+            if cut is not None:
+                parts.append((cut, []))
+
+        # Each initial order is split into segments in a single pass
+        segment_index = {op: k for k, (_, operators) in enumerate(parts) for op in operators}
+        initial_orders = [[[] for _ in self.initial_orders] for _ in parts]
+        for j, order in enumerate(self.initial_orders):
+            for op in order:
+                k = segment_index.get(op)
+                if k is not None:
+                    initial_orders[k][j].append(op)
+
+        segments = []
+        outputs = self.graph.outputs
+        carried = [t for t in outputs if t.producer is None]
+        for (terminal, operators), orders in zip(reversed(parts), reversed(initial_orders)):
+            segments.append(self._segment(terminal, operators, outputs) + (orders,))
+            carried = list(dict.fromkeys(carried + [i for op in operators for i in op.inputs
+                                                    if i.producer is None and i.size]))
+            outputs = [terminal] + carried
+        return segments[::-1]
+
+    def _segment(self, terminal, operators, outputs):
+        tensors = ([terminal] if terminal is not None else []) + [t for op in operators for t in op.outputs]
+        # The columns describe the whole graph, so segments go without
+        return terminal, self.graph._replace(tensors=tensors, operators=operators, inputs=[], outputs=outputs,
+                                             columns=None)
+
+    def solve(self):
+        """
+        Runs the search until it completes or runs out of budget.
+        :return: A tuple of the best found peak memory usage and the list of operators in the order of execution
+        """
+        self._deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        pool = SearchPool(self.jobs) if self.jobs > 1 else None
+        op_order = []
+        peak = carried_size = 0
+        try:
+            for terminal, segment, initial_orders in self.segments:
+                terminals = None
+                if terminal is not None:
+                    initial_orders = [[terminal.producer] + order for order in initial_orders]
+                    # Model inputs carried over from the previous segment are part of this one's working set
+                    terminals = {terminal: peak - carried_size}
+
+                search = self._solve_segment(segment, initial_orders, terminals, pool)
+                peak, segment_order = search.best_peak, search.best_order
+                carried_size = search.free_output_size
+                op_order += segment_order[1:] if terminal is not None else segment_order
+
+                # Lower bounds of later segments assume the exact peak memory usage of the earlier ones, unless the
+                # earlier ones meet the target and this one can't
+                infeasible = self.target is not None and search.lower_bound > self.target and not self.infeasible
+                if self.complete or infeasible:
+                    self.lower_bound = max(self.lower_bound, search.lower_bound)
+                self.complete = self.complete and search.complete
+                if infeasible:
+                    self.infeasible = True
+                    self.bottleneck = search.bottleneck
+        finally:
+            if pool is not None:
+                pool.executor.shutdown()
+
+        if self.complete:
+            self.lower_bound = peak
+        return peak, op_order
+
+    def _remaining_time(self):
+        return max(self._deadline - time.monotonic(), 0) if self._deadline is not None else None
+
+    def _remaining_states(self):
+        return max(self.max_states - self.explored, 0) if self.max_states is not None else None
+
+    def _solve_segment(self, segment, initial_orders, terminals, pool):
+        max_states = self._remaining_states()
+        if pool is not None and (max_states is None or max_states > self.PARALLEL_SEARCH_THRESHOLD):
+            max_states = self.PARALLEL_SEARCH_THRESHOLD
+        if self.infeasible:
+            # The target can't be met anyway, so there's no point in searching
+            max_states = 0
+        search = BranchAndBoundScheduleSearch(segment, initial_orders, self._remaining_time(), max_states, terminals,
+                                              self.memo_limit, self.spill_limit, self.target)
+        search.solve()
+        self.explored += search.explored
+        self.pruned += search.pruned
+        self.memo_stats = add_memo_stats(self.memo_stats, search.memo_stats)
+
+        if search.complete or pool is None or self._remaining_states() == 0 or self._remaining_time() == 0 \
+                or self.infeasible or (self.target is not None and (search.best_peak <= self.target
+                                                                    or search.lower_bound > self.target)):
+            return search
+
+        # Continue in parallel, starting from the best order found so far
+        search = ParallelScheduleSearch(segment, pool, initial_orders + [search.best_order], self._remaining_time(),
+                                        self._remaining_states(), terminals, self.memo_limit, self.spill_limit,
+                                        self.target)
+        search.solve()
+        self.explored += search.explored
+        self.pruned += search.pruned
+        self.memo_stats = add_memo_stats(self.memo_stats, search.memo_stats)
+        return search
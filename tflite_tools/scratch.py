@@ -0,0 +1,88 @@
+from collections import namedtuple
+
+from .tflite.BuiltinOperator import BuiltinOperator
+from .tflite.Padding import Padding
+from .tflite.TensorType import TensorType
+
+
+# Key of the scratch buffer of an operator in arena plans (next to tensor ids)
+ScratchBuffer = namedtuple("ScratchBuffer", ["operator_id"])
+
+# Functions estimating the size (in bytes) of the scratch buffers that a kernel allocates while it runs, keyed by
+# `BuiltinOperator` code. Each takes a `TFLiteOperator` (with its builtin options) and returns a size.
+SCRATCH_SIZE_MODELS = {}
+
+
+def register_scratch_size(opcode):
+    """
+    Decorator that registers a function as the scratch size model of an operator, replacing the current one. Use it
+    to describe the kernels of a different runtime, or custom kernels.
+    """
+    def register(model):
+        SCRATCH_SIZE_MODELS[opcode] = model
+        return model
+    return register
+
+
+def scratch_size(op):
+    """
+    Returns the size of the scratch buffers of an operator, according to `SCRATCH_SIZE_MODELS`.
+    """
+    model = SCRATCH_SIZE_MODELS.get(op.opcode)
+    return int(model(op)) if model is not None else 0
+
+
+def scratch_buffers(op_order):
+    """
+    Returns the scratch buffers of operators executed in a given order, which only live while their operator runs.
+    :param op_order: Operators in the order of execution
+    :return: A dict mapping `ScratchBuffer` keys to (size, first step, last step) tuples
+    """
+    return {ScratchBuffer(op.id): (op.scratch_size, step, step) for step, op in enumerate(op_order) if op.scratch_size}
+
+
+# The built-in models follow the CMSIS-NN kernels used by TensorFlow Lite Micro on Arm Cortex-M for quantized
+# tensors; the reference float kernels don't allocate scratch memory.
+
+def _is_quantized(t):
+    return t.type not in (TensorType.FLOAT32, TensorType.FLOAT16)
+
+
+@register_scratch_size(BuiltinOperator.CONV_2D)
+def _conv_2d(op):
+    # im2col buffer of two columns of 16-bit values; 1x1 convolutions without strides or padding don't need one
+    if not _is_quantized(op.inputs[0]):
+        return 0
+    _, filter_h, filter_w, in_channels = op.inputs[1].shape
+    o = op.options
+    pointwise = filter_h == filter_w == 1 and in_channels % 4 == 0
+    if pointwise and (o is None or (o.StrideW() == o.StrideH() == 1 and o.Padding() == Padding.VALID)):
+        return 0
+    return 2 * 2 * in_channels * filter_h * filter_w
+
+
+@register_scratch_size(BuiltinOperator.DEPTHWISE_CONV_2D)
+def _depthwise_conv_2d(op):
+    # The optimised kernel (depth multiplier 1) buffers one 16-bit filter window of the input
+    if not _is_quantized(op.inputs[0]) or (op.options is not None and op.options.DepthMultiplier() != 1):
+        return 0
+    _, filter_h, filter_w, channels = op.inputs[1].shape
+    return 2 * channels * filter_h * filter_w
+
+
+@register_scratch_size(BuiltinOperator.AVERAGE_POOL_2D)
+def _average_pool_2d(op):
+    # 32-bit sums for each channel
+    return 4 * op.inputs[0].shape[-1] if _is_quantized(op.inputs[0]) else 0
+
+
+@register_scratch_size(BuiltinOperator.FULLY_CONNECTED)
+def _fully_connected(op):
+    # 32-bit accumulators for each output unit
+    return 4 * op.inputs[1].shape[0] if _is_quantized(op.inputs[0]) else 0
+
+
+@register_scratch_size(BuiltinOperator.SOFTMAX)
+def _softmax(op):
+    # Lookup table of 32-bit exponentials of the 256 possible differences between 8-bit inputs
+    return 256 * 4 if _is_quantized(op.inputs[0]) else 0
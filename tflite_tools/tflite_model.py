@@ -1,14 +1,25 @@
-import sys
 import csv
+import importlib
+import mmap
+import os
 from collections import namedtuple
-import functools
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 from .tflite import Model
 from .tflite.BuiltinOperator import BuiltinOperator
+from .tflite.BuiltinOptions import BuiltinOptions
 from .tflite.TensorType import TensorType
-from flatbuffers.number_types import UOffsetTFlags
-import tensorflow.lite as tf_lite
+from .schedule_search import BitmaskScheduleSearch, SegmentedScheduleSearch, transitive_closure
+from .arena_planner import ArenaOrderSearch, plan_arena
+from .aliasing import alias_graph, concat_inputs, expand_order, peak_memory_usage, share_buffers
+from .scratch import scratch_buffers, scratch_size
+from .recompute import operator_macs, recompute, recompute_candidates
+from .tiling import chain_parts, tile, tile_chains
+from .tradeoffs import TradeOff, pareto_front, plot_tradeoffs, write_tradeoffs_csv
+from .c_export import write_c_plan
+from .model_rewriter import decode_model, encode_model
+from flatbuffers.number_types import Int32Flags, UOffsetTFlags
 import numpy as np
 from tqdm import tqdm
 from prettytable import PrettyTable
@@ -17,77 +28,304 @@ from prettytable import PrettyTable
 def cluster_weights(weights, n_clusters):
     from sklearn import cluster
     kmeans = cluster.KMeans(n_clusters=n_clusters).fit(weights.reshape((-1, 1)))
-    return kmeans.labels_.reshape(weights.shape), np.around(kmeans.cluster_centers_).astype(np.int32)
-
-
-# Flatbuffers provide a per-byte view on data, so we need to cast the underlying buffer to the correct datatype
+    centroids = kmeans.cluster_centers_
+    if not np.issubdtype(weights.dtype, np.inexact):
+        centroids = np.around(centroids)
+    return kmeans.labels_.reshape(weights.shape), centroids.astype(weights.dtype)
+
+
+# Tensor types that are newer than the bundled schema
+INT8 = 9
+FLOAT64 = 10
+COMPLEX128 = 11
+UINT64 = 12
+UINT32 = 15
+UINT16 = 16
+
+# Element types of tensors, as stored in flatbuffer buffers (little-endian). Strings are left out: a string tensor is
+# a table of offsets followed by the characters, so its buffer is only ever viewed as bytes.
+TENSOR_DTYPES = {
+    TensorType.FLOAT32: np.dtype("<f4"),
+    TensorType.FLOAT16: np.dtype("<f2"),
+    TensorType.INT32: np.dtype("<i4"),
+    TensorType.UINT8: np.dtype(np.uint8),
+    TensorType.INT64: np.dtype("<i8"),
+    TensorType.BOOL: np.dtype(np.bool_),
+    TensorType.INT16: np.dtype("<i2"),
+    TensorType.COMPLEX64: np.dtype("<c8"),
+    INT8: np.dtype(np.int8),
+    FLOAT64: np.dtype("<f8"),
+    COMPLEX128: np.dtype("<c16"),
+    UINT64: np.dtype("<u8"),
+    UINT32: np.dtype("<u4"),
+    UINT16: np.dtype("<u2"),
+}
+
+
+# Flatbuffers provide a per-byte view on data, so we need to cast the underlying buffer to the correct datatype. The
+# result is a view of the model (writable unless the model is `bytes`), not a copy.
 def get_buffer_as_numpy(tensor, buffer):
-    if tensor.Type() == TensorType.UINT8:
-        arr = buffer.DataAsNumpy()
-    elif tensor.Type() == TensorType.INT16:
-        arr = np.frombuffer(buffer.DataAsNumpy(), dtype=np.dtype(np.int16).newbyteorder("<"))
-    elif tensor.Type() == TensorType.INT32:
-        arr = np.frombuffer(buffer.DataAsNumpy(), dtype=np.dtype(np.int32).newbyteorder("<"))
-    elif tensor.Type() == TensorType.INT64:
-        arr = np.frombuffer(buffer.DataAsNumpy(), dtype=np.dtype(np.int64).newbyteorder("<"))
-    else:
-        raise NotImplementedError()
-    return arr.reshape(tensor.ShapeAsNumpy())
+    data = buffer.DataAsNumpy() if buffer.DataLength() else np.empty(0, dtype=np.uint8)
+    if tensor.Type() == TensorType.STRING:
+        return data
+    if tensor.Type() not in TENSOR_DTYPES:
+        raise NotImplementedError(f"Tensor type {tensor.Type()} is not supported")
+    return data.view(TENSOR_DTYPES[tensor.Type()]).reshape(tensor.ShapeAsNumpy() if tensor.ShapeLength() else ())
+
+
+# Builtin codes of control flow operators that are newer than the bundled schema (codes below 127 are read the same
+# way)
+IF = 118
+WHILE = 119
+
+# Number of leading subgraph index fields in the builtin options of operators that run other subgraphs: the subgraph
+# of a CALL, both branches of an IF and the condition and the body of a WHILE
+CALL_OPERATORS = {BuiltinOperator.CALL: 1, IF: 2, WHILE: 2}
+
+
+def get_builtin_options(op):
+    # Returns the builtin options of a flatbuffer operator as an instance of their table class (e.g. `Conv2DOptions`),
+    # or None if there are none or they're newer than the bundled schema
+    table = op.BuiltinOptions()
+    if table is None or op.BuiltinOptionsType() == BuiltinOptions.NONE:
+        return None
+    name = next((k for k, v in vars(BuiltinOptions).items() if v == op.BuiltinOptionsType()), None)
+    if name is None:
+        return None
+    options = getattr(importlib.import_module(f".tflite.{name}", __package__), name)()
+    options.Init(table.Bytes, table.Pos)
+    return options
+
+
+def get_called_subgraphs(op, opcode):
+    # Returns the indices of the subgraphs that a flatbuffer operator runs (see `CALL_OPERATORS`). The options are
+    # read as a raw table, as not all of them are in the bundled schema.
+    table = op.BuiltinOptions()
+    if opcode not in CALL_OPERATORS or table is None:
+        return []
+    subgraphs = []
+    for field in range(CALL_OPERATORS[opcode]):
+        o = table.Offset(4 + 2 * field)
+        subgraphs.append(table.Get(Int32Flags, table.Pos + o) if o != 0 else 0)
+    return subgraphs
+
+
+def get_quantization(tensor):
+    # Returns the scales and zero points of a flatbuffer tensor as tuples, or None if it's not quantized
+    q = tensor.Quantization()
+    if q is None or q.ScaleLength() == 0:
+        return None
+    return tuple(q.ScaleAsNumpy().tolist()), tuple(q.ZeroPointAsNumpy().tolist()) if q.ZeroPointLength() else ()
 
 
 def get_buffer_element_size(t):
-    sizes = {
-        TensorType.UINT8: 1,
-        TensorType.INT16: 2,
-        TensorType.INT32: 4,
-        TensorType.INT64: 8,
-        TensorType.FLOAT32: 4,
-        TensorType.FLOAT16: 2,
-    }
-    return sizes[t]
+    # The length of strings is only known at run time; each one is counted as a single byte
+    if t == TensorType.STRING:
+        return 1
+    return TENSOR_DTYPES[t].itemsize
 
 
 class TFLiteTensor:
+    """
+    A tensor of a `TFLiteGraph`. Its size is worked out once, when the tensor is created: pass `size` explicitly to
+    take it from `TFLiteGraphColumns` instead.
+    """
+
+    __slots__ = ("id", "shape", "name", "is_constant", "producer", "consumers", "predecessor_mask", "type", "size",
+                 "quantization")
+
     def __init__(self, id=None, shape=None, name=None, is_constant=False, producer=None,
-                 consumers=None, predecessors=None, type=None):
+                 consumers=None, predecessor_mask=0, type=None, size=None, quantization=None):
         self.id = id
         self.shape = shape
         self.name = name
         self.is_constant = is_constant
         self.producer = producer
         self.consumers = consumers if consumers is not None else []
-        self.predecessors = predecessors
+        # Bitset of the ids of all tensors this tensor (transitively) depends on
+        self.predecessor_mask = predecessor_mask
         self.type = type
-
-    @property
-    def size(self):
-        return 0 if self.is_constant else np.prod(self.shape) * get_buffer_element_size(self.type)
+        if size is None and shape is not None:
+            size = 0 if is_constant else int(np.prod(shape, dtype=np.int64)) * get_buffer_element_size(type)
+        self.size = size
+        # Scales and zero points, see `get_quantization`
+        self.quantization = quantization
 
     def __hash__(self):
         return hash(self.id)
 
 
 class TFLiteOperator:
-    def __init__(self, id=None, output=None, inputs=None):
+    __slots__ = ("id", "outputs", "inputs", "opcode", "options", "scratch_size", "in_place_inputs", "called_subgraphs")
+
+    def __init__(self, id=None, outputs=None, inputs=None, opcode=None, options=None, scratch_size=0,
+                 in_place_inputs=None, called_subgraphs=None):
         self.id = id
-        self.output = output
+        self.outputs = outputs if outputs is not None else []
         self.inputs = inputs if inputs is not None else []
+        # `BuiltinOperator` code and builtin options (see `get_builtin_options`)
+        self.opcode = opcode
+        self.options = options
+        # Size of the scratch buffers that the kernel allocates while it runs (see `scratch.scratch_size`), plus the
+        # memory of the subgraphs it runs
+        self.scratch_size = scratch_size
+        # Inputs that the output can be written over if they're not needed afterwards (see `aliasing.alias_graph`)
+        self.in_place_inputs = in_place_inputs if in_place_inputs is not None else []
+        # Indices of the subgraphs the operator runs (see `CALL_OPERATORS`)
+        self.called_subgraphs = called_subgraphs if called_subgraphs is not None else []
+
+    @property
+    def output(self):
+        # The output of a single-output operator (the first one of operators with several, e.g. SPLIT), or None
+        return self.outputs[0] if self.outputs else None
+
+    @property
+    def name(self):
+        # Names of the outputs, for reporting
+        return ", ".join(t.name for t in self.outputs)
 
     def __hash__(self):
         return hash(self.id)
 
 
-TFLiteGraph = namedtuple("TFLiteGraph", ["tensors", "operators", "inputs", "outputs"])
+# Per-tensor arrays, indexed by tensor id: size in RAM, type, id of the producing operator (-1 if none) and the ids
+# of consuming operators in CSR form (`consumers[consumer_offsets[i]:consumer_offsets[i + 1]]`). Per operator, in
+# CSR form too: the ids of its output tensors (`outputs[output_offsets[k]:output_offsets[k + 1]]`).
+TFLiteGraphColumns = namedtuple("TFLiteGraphColumns", ["sizes", "types", "producers", "consumer_offsets", "consumers",
+                                                       "output_offsets", "outputs"])
+
+
+def build_graph_columns(shapes, types, op_inputs, op_outputs, graph_inputs):
+    """
+    Builds the columnar form of a graph.
+    :param shapes: Shape of each tensor
+    :param types: `TensorType` of each tensor
+    :param op_inputs: Input tensor ids of each operator
+    :param op_outputs: Output tensor ids of each operator
+    :param graph_inputs: Ids of the graph inputs
+    :return: A `TFLiteGraphColumns`
+    """
+    num_tensors = len(shapes)
+    types = np.array(types, dtype=np.int32)
+    outputs = np.concatenate([np.asarray(o, dtype=np.int64) for o in op_outputs] or [np.zeros(0, dtype=np.int64)])
+    output_offsets = np.zeros(len(op_outputs) + 1, dtype=np.int64)
+    np.cumsum([len(o) for o in op_outputs], out=output_offsets[1:])
+
+    producers = np.full(num_tensors, -1, dtype=np.int64)
+    producers[outputs] = np.repeat(np.arange(len(op_outputs), dtype=np.int64), np.diff(output_offsets))
+
+    # Tensors without a producer that aren't graph inputs are weights, which don't need to be kept in RAM
+    is_constant = producers < 0
+    is_constant[np.asarray(graph_inputs, dtype=np.int64)] = False
+    element_sizes = np.array([get_buffer_element_size(t) for t in types.tolist()], dtype=np.int64)
+    num_elements = np.array([np.prod(s, dtype=np.int64) for s in shapes], dtype=np.int64)
+    sizes = np.where(is_constant, 0, num_elements * element_sizes)
+
+    consumed = np.concatenate([np.asarray(i, dtype=np.int64) for i in op_inputs] or [np.zeros(0, dtype=np.int64)])
+    consuming_ops = np.repeat(np.arange(len(op_inputs), dtype=np.int64), [len(i) for i in op_inputs])
+    by_tensor = np.argsort(consumed, kind="stable")
+    consumer_offsets = np.zeros(num_tensors + 1, dtype=np.int64)
+    np.cumsum(np.bincount(consumed, minlength=num_tensors), out=consumer_offsets[1:])
+
+    return TFLiteGraphColumns(sizes, types, producers, consumer_offsets, consuming_ops[by_tensor], output_offsets,
+                              outputs)
+
+
+def renumber_operators(columns, new_ids):
+    """
+    Updates the columnar form of a graph after operators have been reordered.
+    :param columns: A `TFLiteGraphColumns`
+    :param new_ids: New id of each operator, indexed by its old id
+    :return: A `TFLiteGraphColumns`
+    """
+    new_ids = np.asarray(new_ids, dtype=np.int64)
+    old_ids = np.argsort(new_ids)
+    counts = np.diff(columns.output_offsets)[old_ids]
+    output_offsets = np.zeros_like(columns.output_offsets)
+    np.cumsum(counts, out=output_offsets[1:])
+    # Position of each output in the old CSR array: the start of its operator's run, plus its index in the run
+    positions = np.repeat(columns.output_offsets[:-1][old_ids] - output_offsets[:-1], counts) \
+        + np.arange(output_offsets[-1], dtype=np.int64)
+    producers = np.where(columns.producers >= 0, new_ids[columns.producers], -1)
+    return columns._replace(producers=producers, consumers=new_ids[columns.consumers], output_offsets=output_offsets,
+                            outputs=columns.outputs[positions])
+
+
+# The tensor and buffer lifetimes of the analysis (and so the execution schedule and the arena plan) are read from
+# `columns`. Graphs derived for the schedule search (see `aliasing.alias_graph` and `SegmentedScheduleSearch`) have no
+# columns; the search reads tensor sizes from the views once, into arrays of its own.
+TFLiteGraph = namedtuple("TFLiteGraph", ["tensors", "operators", "inputs", "outputs", "columns"])
+TFLiteGraph.__new__.__defaults__ = (None,)
+
+
+def _in_memory(model_bytes):
+    # Memory-mapped models (see `TFLiteModel.load_from_file`) can't be sent to worker processes, so they're read into
+    # memory first
+    return bytearray(model_bytes) if isinstance(model_bytes, mmap.mmap) else model_bytes
+
+
+def _evaluate_tradeoff(model_bytes, aliasing, scratch, subgraph, search, search_options, arena_strategy):
+    # Runs in a worker process of `TFLiteModel.explore_tradeoffs`. Returns the model (in the best operator order found
+    # if `search` is set, else as it is), its peak memory usage, its arena size and its number of MACs.
+    model = TFLiteModel(model_bytes, aliasing, scratch, subgraph)
+    if search:
+        _, op_order = model.peak_mem_usage(**search_options)
+        model._apply_order(op_order)
+    else:
+        model._build_graph()
+    peak = peak_memory_usage(model._buffer_lifetimes()[0])
+    arena_size = model.plan_arena(arena_strategy).arena_size
+    return model.model_bytes, peak, arena_size, sum(operator_macs(op) for op in model.model_graph.operators)
+
+
+def _search_subgraph(model_bytes, aliasing, scratch, subgraph, search_options):
+    # Runs in a worker process of `TFLiteModel._optimize_subgraphs`. Returns the peak memory usage of the best order of
+    # the operators of a subgraph, and their ids in that order.
+    model = TFLiteModel(model_bytes, aliasing, scratch, subgraph)
+    peak, op_order = model.peak_mem_usage(**search_options)
+    return peak, [op.id for op in op_order]
+
+
+class RamBudgetInfeasible(Exception):
+    """
+    Raised when no operator order fits the model in a RAM budget. `lower_bound` is the peak memory usage that every
+    order needs; `bottleneck` is the name of a tensor whose producer needs more than the budget on its own, or None.
+    """
+
+    def __init__(self, ram_budget, lower_bound, bottleneck=None):
+        message = f"No operator order fits in the RAM budget of {ram_budget:,} B: every order needs at least " \
+                  f"{lower_bound:,} B"
+        if bottleneck is not None:
+            message += f" (the operator computing '{bottleneck}' needs more than the budget on its own)"
+        super().__init__(message + ".")
+        self.ram_budget = ram_budget
+        self.lower_bound = lower_bound
+        self.bottleneck = bottleneck
 
 
 class TFLiteModel:
-    def __init__(self, model_bytes):
+    def __init__(self, model_bytes, aliasing=True, scratch=True, subgraph=0):
         self.model_bytes = model_bytes
+        # File that `model_bytes` is mapped from, see `load_from_file`
+        self.mapped_path = None
+        # Whether aliasing and in-place operators share memory between their inputs and outputs
+        self.aliasing = aliasing
+        # Whether kernel scratch buffers are accounted for (see `scratch.scratch_size`)
+        self.scratch = scratch
         self.model_graph = None
         self.peak_usage = None
+        self.search_stats = None
+        self.schedule_info = None
+        self.arena_plans = {}
+        # Index of the analysed subgraph; the others are analysed by the models in `_subgraph_models` (see
+        # `subgraph_model`), which share theirs with this one
+        self.subgraph = subgraph
+        self._subgraph_models = {subgraph: self}
+        self._building_graph = False
 
     @classmethod
-    def create_from_protobuf(cls, protobuf_file, inputs, outputs, input_shapes):
+    def create_from_protobuf(cls, protobuf_file, inputs, outputs, input_shapes, aliasing=True, scratch=True):
+        import tensorflow.lite as tf_lite
         converter = tf_lite.TFLiteConverter.from_frozen_graph(protobuf_file, input_arrays=inputs,
                                                               output_arrays=outputs, input_shapes=input_shapes)
         from tensorflow.lite.python import lite_constants
@@ -96,14 +334,23 @@ class TFLiteModel:
         # converter.optimizations = [tf_lite.Optimize.DEFAULT]
         input_arrays = converter.get_input_arrays()
         converter.quantized_input_stats = {input_arrays[0]: (0, 1)}  # mean, std_dev
-        return cls(bytearray(converter.convert()))
+        return cls(bytearray(converter.convert()), aliasing, scratch)
 
     @classmethod
-    def load_from_file(cls, model_path):
+    def load_from_file(cls, model_path, aliasing=True, scratch=True):
+        # The file is mapped copy-on-write instead of being read, so analysing the model only reads its flatbuffer
+        # tables: weights stay on disk until they're used, and changes to the model (reordering operators, clustering
+        # weights) copy the pages they write to without touching the file
         with open(model_path, 'rb') as f:
-            return cls(bytearray(f.read()))
+            model = cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY), aliasing, scratch)
+        model.mapped_path = model_path
+        return model
 
     def write_to_file(self, output_path):
+        if isinstance(self.model_bytes, mmap.mmap) and os.path.exists(output_path) \
+                and os.path.samefile(output_path, self.mapped_path):
+            # Opening the file that the model is mapped from truncates it, so the model is read into memory first
+            self.model_bytes = bytearray(self.model_bytes)
         with open(output_path, "wb") as f:
             f.write(self.model_bytes)
 
@@ -112,134 +359,220 @@ class TFLiteModel:
         weights = self._discover_tflite_weights()
         for b_index, weight in weights:
             assignments, centroids = cluster_weights(weight, weight_clusters)
-            self._overwrite_flatbuffers_buffer(b_index, np.squeeze(centroids[assignments], axis=-1))
+            # `weight` is a view of the buffer, so this overwrites the weights in the model
+            weight[...] = np.squeeze(centroids[assignments], axis=-1)
+
+    def decode(self):
+        """
+        Decodes the model into an editable tree of flatbuffer tables, for changes that can't be made in place (adding
+        or removing operators, tensors or buffers, resizing buffers, reshaping tensors, ...). See
+        `model_rewriter.decode_model`.
+        :return: The `Model` table, to be written back with `rewrite`
+        """
+        return decode_model(self.model_bytes)
+
+    def rewrite(self, model):
+        """
+        Replaces the model with one serialized from a tree of flatbuffer tables (see `decode`), and forgets its
+        analysis.
+        :param model: The `Model` table
+        """
+        self.model_bytes = encode_model(model)
+        self._reset_analysis()
 
-    def _overwrite_flatbuffers_buffer(self, buffer_idx, new_contents):
+    def constant_buffers(self):
+        """
+        Iterates over the contents of the constant tensors of all subgraphs, as views of the model's buffers with the
+        type and shape of their tensor (see `get_buffer_as_numpy`): writing to them changes the model. Buffers that
+        several tensors share are only visited once.
+        :return: An iterator of (buffer index, tensor name, ndarray) tuples
+        """
         model = Model.Model.GetRootAsModel(self.model_bytes, 0)
-        orig_buffer = model.Buffers(buffer_idx)
-        # NB. Update this to directly manipulate `serialized_model` if this view becomes unwriteable
-        orig_buffer.DataAsNumpy()[:] = new_contents.astype(np.uint8).flatten()
+        seen = set()
+        for s in range(model.SubgraphsLength()):
+            subgraph = model.Subgraphs(s)
+            for i in range(subgraph.TensorsLength()):
+                tensor = subgraph.Tensors(i)
+                buffer_idx = tensor.Buffer()
+                if buffer_idx in seen:
+                    continue
+                buffer = model.Buffers(buffer_idx)
+                if buffer is None or not buffer.DataLength():
+                    continue
+                seen.add(buffer_idx)
+                yield buffer_idx, tensor.Name().decode("ascii"), get_buffer_as_numpy(tensor, buffer)
 
     def _discover_tflite_weights(self):
         model = Model.Model.GetRootAsModel(self.model_bytes, 0)
-        subgraph = model.Subgraphs(0)
 
-        weights = []
-        for o in range(subgraph.OperatorsLength()):
-            op = subgraph.Operators(o)
-            opcode = model.OperatorCodes(op.OpcodeIndex()).BuiltinCode()
-            inputs = op.InputsAsNumpy()
+        weights = {}
+        for s in range(model.SubgraphsLength()):
+            subgraph = model.Subgraphs(s)
+            for o in range(subgraph.OperatorsLength()):
+                op = subgraph.Operators(o)
+                opcode = model.OperatorCodes(op.OpcodeIndex()).BuiltinCode()
+                inputs = op.InputsAsNumpy()
+
+                parametrised_opcodes = [BuiltinOperator.CONV_2D, BuiltinOperator.FULLY_CONNECTED,
+                                        BuiltinOperator.DEPTHWISE_CONV_2D]
+                if opcode not in parametrised_opcodes:
+                    continue
 
-            parametrised_opcodes = [BuiltinOperator.CONV_2D, BuiltinOperator.FULLY_CONNECTED, BuiltinOperator.DEPTHWISE_CONV_2D]
-            if opcode not in parametrised_opcodes:
-                continue
+                weight_tensor = subgraph.Tensors(inputs[1])
+                buffer_idx = weight_tensor.Buffer()
+                buffer = model.Buffers(buffer_idx)
+                # Return a buffer index and contents as an ndarray; subgraphs can share weights
+                weights[buffer_idx] = get_buffer_as_numpy(weight_tensor, buffer)
 
-            weight_tensor = subgraph.Tensors(inputs[1])
-            buffer_idx = weight_tensor.Buffer()
-            buffer = model.Buffers(buffer_idx)
-            # Return a buffer index and contents as an ndarray
-            weights.append((buffer_idx, get_buffer_as_numpy(weight_tensor, buffer)))
+        return list(weights.items())
 
-        return weights
+    def subgraph_model(self, index):
+        """
+        Returns a `TFLiteModel` that analyses another subgraph of the model. It shares the model bytes with this one, so
+        reordering its operators reorders them in this model too.
+        :param index: Index of the subgraph in the model
+        """
+        model = self._subgraph_models.get(index)
+        if model is None or model.model_bytes is not self.model_bytes:
+            model = TFLiteModel(self.model_bytes, self.aliasing, self.scratch, index)
+            model._subgraph_models = self._subgraph_models
+            self._subgraph_models[index] = model
+        return model
+
+    def _called_subgraph_size(self, op):
+        # Memory that the subgraphs an operator runs need (one at a time), in their current operator order
+        size = 0
+        for index in op.called_subgraphs:
+            callee = self.subgraph_model(index)
+            if callee._building_graph:
+                raise ValueError(f"Subgraph {index} runs itself")
+            size = max(size, peak_memory_usage(callee._buffer_lifetimes()[0]))
+        return size
+
+    def _reset_analysis(self):
+        # Forgets everything worked out from the model bytes, e.g. after the subgraphs that this one runs have changed
+        self.model_graph = None
+        self.peak_usage = None
+        self.schedule_info = None
+        self.arena_plans = {}
 
     def _build_graph(self):
         model = Model.Model.GetRootAsModel(self.model_bytes, 0)
-        subgraph = model.Subgraphs(0)
-
-        tensors = []
-        operators = []
+        subgraph = model.Subgraphs(self.subgraph)
 
+        shapes, names, types, quantization = [], [], [], []
         for i in range(subgraph.TensorsLength()):
             t = subgraph.Tensors(i)
-            tensors.append(TFLiteTensor(id=i, shape=t.ShapeAsNumpy(), name=t.Name().decode("ascii"),
-                                        producer=None, consumers=[], type=t.Type()))
+            shapes.append(t.ShapeAsNumpy())
+            names.append(t.Name().decode("ascii"))
+            types.append(t.Type())
+            quantization.append(get_quantization(t))
 
+        op_inputs, op_outputs, opcodes, options, calls = [], [], [], [], []
         for i in range(subgraph.OperatorsLength()):
             op = subgraph.Operators(i)
-            assert op.OutputsLength() <= 1
-            has_output = op.OutputsLength() == 1
-            inputs = [tensors[j] for j in op.InputsAsNumpy()]
+            opcodes.append(model.OperatorCodes(op.OpcodeIndex()).BuiltinCode())
+            options.append(get_builtin_options(op))
+            calls.append(get_called_subgraphs(op, opcodes[-1]))
+            inputs = op.InputsAsNumpy()
             assert len(inputs) > 0
-
-            tflite_op = TFLiteOperator(id=i, output=tensors[op.Outputs(0)] if has_output else None, inputs=inputs)
-            tflite_op.output.producer = tflite_op
-            for t in inputs:
-                t.consumers.append(tflite_op)
-            operators.append(tflite_op)
-
-        inputs = [tensors[j] for j in subgraph.InputsAsNumpy()]
+            # Optional inputs and outputs that are left out have id -1
+            op_inputs.append(inputs[inputs >= 0])
+            op_outputs.append([o for o in (op.Outputs(j) for j in range(op.OutputsLength())) if o >= 0])
+
+        graph_inputs = subgraph.InputsAsNumpy()
+        columns = build_graph_columns(shapes, types, op_inputs, op_outputs, graph_inputs)
+
+        # Thin per-tensor and per-operator views over the columns
+        sizes, producers = columns.sizes.tolist(), columns.producers.tolist()
+        input_ids = set(graph_inputs.tolist())
+        tensors = [TFLiteTensor(id=i, shape=shapes[i], name=names[i], type=types[i], size=sizes[i],
+                                is_constant=producers[i] < 0 and i not in input_ids, quantization=quantization[i])
+                   for i in range(len(shapes))]
+        operators = [TFLiteOperator(id=i, outputs=[tensors[o] for o in outputs], inputs=[tensors[j] for j in inputs],
+                                    opcode=opcodes[i], options=options[i], called_subgraphs=calls[i])
+                     for i, (inputs, outputs) in enumerate(zip(op_inputs, op_outputs))]
+        self._building_graph = True
+        try:
+            for op in operators:
+                for t in op.outputs:
+                    t.producer = op
+                if self.scratch:
+                    op.scratch_size = scratch_size(op)
+                # The subgraphs an operator runs are nested in the working set of this one while it runs
+                op.scratch_size += self._called_subgraph_size(op)
+        finally:
+            self._building_graph = False
+        offsets, consumers = columns.consumer_offsets.tolist(), columns.consumers.tolist()
+        for i, t in enumerate(tensors):
+            t.consumers = [operators[k] for k in consumers[offsets[i]:offsets[i + 1]]]
+
+        inputs = [tensors[j] for j in graph_inputs]
         outputs = [tensors[j] for j in subgraph.OutputsAsNumpy()]
 
-        for t in tensors:
-            t.is_constant = (t.producer is None) and (t not in inputs)
-
-        # Can turn into an iterative function if this ever causes performance / stack overflow issues
-        def _compute_predecessors(tensor):
-            if tensor.predecessors is not None:
-                return tensor.predecessors
-
-            if tensor.producer is None:
-                tensor.predecessors = set()
-            else:
-                op_inputs = tensor.producer.inputs
-                tensor.predecessors = set(op_inputs)
-                for i in op_inputs:
-                    tensor.predecessors |= _compute_predecessors(i)
-            return tensor.predecessors
-
-        for o in outputs:
-            _compute_predecessors(o)  # Will recursively compute predecessors for all nodes leading up to output nodes
-
-        self.model_graph = TFLiteGraph(tensors, operators, inputs, outputs)
+        direct_masks = [sum(1 << i.id for i in set(t.producer.inputs)) if t.producer is not None else 0
+                        for t in tensors]
+        for t, mask in zip(tensors, transitive_closure(direct_masks)):
+            t.predecessor_mask = mask
 
-    @staticmethod
-    def _cum_tensor_sizes(tensors):
-        return sum(t.size for t in tensors)
-
-    def peak_mem_usage(self):
-        if self.peak_usage is not None:
-            return self.peak_usage
+        self.model_graph = TFLiteGraph(tensors, operators, inputs, outputs, columns)
 
+    def peak_mem_usage(self, timeout=None, max_states=None, jobs=1, cache=None, memo_limit=None, spill_limit=0,
+                       ram_budget=None):
+        """
+        Finds the operator order with the smallest peak memory usage, or with `ram_budget`, the first one found (trying
+        the order in the model file first) whose peak memory usage is within the budget.
+        :param timeout: Stop the search after this many seconds and return the best order found so far
+        :param max_states: Stop the search after exploring this many states and return the best order found so far
+        :param jobs: Number of worker processes to search with
+        :param cache: A `ScheduleCache` to look up and store optimal operator orders in, or None
+        :param memo_limit: Approximate limit on the memory used by the search's memo table, in bytes (per process)
+        :param spill_limit: Size of an on-disk table for entries evicted from the memo table, in bytes (per process)
+        :param ram_budget: Peak memory usage to stop the search at, in bytes; raises `RamBudgetInfeasible` if the
+        search proves that no order meets it
+        :return: A tuple of peak memory usage and the list of operators in the order of execution
+        """
         if not self.model_graph:
             self._build_graph()
         g = self.model_graph
+        search_graph = alias_graph(g) if self.aliasing else g
+
+        if ram_budget is not None:
+            # The order in the model file is kept whenever it meets the budget, even if a better one is known
+            peak = BitmaskScheduleSearch(search_graph).evaluate_order(search_graph.operators)[0]
+            if peak <= ram_budget:
+                self.search_stats = None
+                return peak, list(g.operators)
+
+        cache_options = {"aliasing": self.aliasing, "scratch": [op.scratch_size for op in g.operators]}
+        if self.peak_usage is None and cache is not None:
+            self.peak_usage = cache.load(g, cache_options)
+            if self.peak_usage is not None:
+                self.search_stats = None
+        if self.peak_usage is not None:
+            # Known to be optimal
+            if ram_budget is not None and self.peak_usage[0] > ram_budget:
+                raise RamBudgetInfeasible(ram_budget, self.peak_usage[0])
+            return self.peak_usage
 
-        # Can turn into an iterative function if this ever causes performance / stack overflow issues
-        @functools.lru_cache(maxsize=None)
-        def mem(tensors):
-            # Computes the peak memory usage of a runtime system that computes all tensors in a set `tensors`.
-            constants = [t for t in tensors if t.producer is None]
-            if constants:
-                upstream_mem_use, op_order = mem(frozenset(t for t in tensors if t.producer is not None))
-                return TFLiteModel._cum_tensor_sizes(constants) + upstream_mem_use, op_order
-            if not tensors:
-                return 0, []
-
-            min_use = sys.maxsize  # A reasonably large integer
-            op_order = []
-            # For each of tensors in our working set, we try to unapply the operator that produced it
-            for t in tensors:
-                rest = tensors - {t}
-                # We constrain the search to never consider evaluating an operator (`t.producer`) more than once ---
-                # so we prevent cases where we consider unapplying `t.producer` but it's actually necessary for other
-                # tensors in the working set.
-                if any(t in r.predecessors for r in rest):
-                    continue
-                inputs = frozenset(t.producer.inputs)
-                new_set = rest | inputs
-                upstream_mem_use, operators = mem(new_set)
-
-                tensors_in_memory = new_set | {t}
-                mem_use = max(upstream_mem_use, TFLiteModel._cum_tensor_sizes(tensors_in_memory))
-                if mem_use < min_use:
-                    min_use = mem_use
-                    op_order = operators + [t.producer]
-            return min_use, op_order
-
-        self.peak_usage = mem(frozenset(g.outputs))
-        return self.peak_usage
+        # The operator order in the model file serves as the initial upper bound for the search
+        search = SegmentedScheduleSearch(search_graph, initial_orders=[search_graph.operators], timeout=timeout,
+                                         max_states=max_states, jobs=jobs, memo_limit=memo_limit,
+                                         spill_limit=spill_limit, target=ram_budget)
+        peak, op_order = search.solve()
+        result = peak, expand_order(g, op_order) if self.aliasing else op_order
+        self.search_stats = search.stats
+        if search.infeasible:
+            bottleneck = search.bottleneck.name if search.bottleneck is not None else None
+            raise RamBudgetInfeasible(ram_budget, search.lower_bound, bottleneck)
+        if search.complete:
+            self.peak_usage = result
+            if cache is not None:
+                cache.store(g, *result, cache_options)
+        return result
 
     def evaluate(self, test_data):
+        import tensorflow.lite as tf_lite
         interpreter = tf_lite.Interpreter(model_content=bytes(self.model_bytes))
         interpreter.allocate_tensors()
         input_info = interpreter.get_input_details()[0]
@@ -260,24 +593,107 @@ class TFLiteModel:
             total += 1
         print(f"{correct} classified correctly out of {total} ({correct / total * 100:.2f}%)")
 
-    def _execution_schedule_info(self):
+    def _tensor_lifetimes(self):
+        # Returns arrays of the first and the last step (operator id) at which each tensor is in memory; graph outputs
+        # that aren't consumed by any operator stay in memory until the end (step `len(operators)`), other unused
+        # outputs (e.g. of a SPLIT) only while their producer runs
         if not self.model_graph:
             self._build_graph()
         g = self.model_graph
 
-        # Compute tensor lifetimes
         num_operators = len(g.operators)
-        first_used_at = {t: t.producer.id if t.producer is not None else 0 for t in g.tensors}
-        last_used_at = {t: max(op.id for op in t.consumers) if t.consumers else num_operators for t in g.tensors}
+        columns = g.columns
+        first_used_at = np.maximum(columns.producers, 0)
+        last_used_at = np.where(columns.producers >= 0, columns.producers, num_operators)
+        last_used_at[[t.id for t in g.outputs]] = num_operators
+        offsets = columns.consumer_offsets
+        consumed = offsets[1:] > offsets[:-1]
+        if consumed.any():
+            last_used_at[consumed] = np.maximum.reduceat(columns.consumers, offsets[:-1][consumed])
+        return first_used_at, last_used_at
+
+    def _buffer_lifetimes(self, concat=True):
+        # Returns a dict mapping buffer ids to (size, first step, last step) tuples for the current operator order,
+        # and a dict mapping ids of tensors in RAM (and `ScratchBuffer` keys) to (buffer id, offset in the buffer)
+        # tuples. Without aliasing, every tensor has a buffer of its own.
+        first_used_at, last_used_at = self._tensor_lifetimes()
+        g = self.model_graph
+        # Weights (tensors without a producer that aren't graph inputs) aren't in RAM
+        in_ram = g.columns.producers >= 0
+        in_ram[[t.id for t in g.inputs]] = True
+        ids = np.flatnonzero(in_ram & (first_used_at <= last_used_at))
+        buffers = {i: (size, first, last) for i, size, first, last in zip(
+            ids.tolist(), g.columns.sizes[ids].tolist(), first_used_at[ids].tolist(), last_used_at[ids].tolist())}
+        owners = {i: (i, 0) for i in buffers}
+        if self.aliasing:
+            buffers, owners = share_buffers(g, g.operators, buffers, concat)
+        scratch = scratch_buffers(g.operators)
+        buffers.update(scratch)
+        owners.update((key, (key, 0)) for key in scratch)
+        return buffers, owners
+
+    def _execution_schedule_info(self):
+        if self.schedule_info is not None:
+            return self.schedule_info
+        first_used_at, last_used_at = self._tensor_lifetimes()
+        g = self.model_graph
+        num_operators = len(g.operators)
+
+        # Memory use at each step is a cumulative sum over a difference array of buffer lifetimes
+        buffers, _ = self._buffer_lifetimes()
+        sizes, firsts, lasts = np.array(list(buffers.values()), dtype=np.int64).reshape((-1, 3)).T
+        mem_diff = np.zeros(num_operators + 2, dtype=np.int64)
+        np.add.at(mem_diff, firsts, sizes)
+        np.add.at(mem_diff, lasts + 1, -sizes)
+        mem_use = np.cumsum(mem_diff)[:num_operators].tolist()
+
+        # Sweep over operators, keeping track of the tensors that are alive at each step
+        starts = [[] for _ in range(num_operators + 1)]
+        ends = [[] for _ in range(num_operators + 1)]
+        for t, first, last in zip(g.tensors, first_used_at.tolist(), last_used_at.tolist()):
+            if first <= last:
+                starts[first].append(t)
+                ends[min(last, num_operators)].append(t)
 
         schedule = []
+        tensors = set()
         for op in g.operators:
-            tensors = {t for t in g.tensors if first_used_at[t] <= op.id <= last_used_at[t]}
-            mem_use = TFLiteModel._cum_tensor_sizes(tensors)
-            schedule.append((op, tensors, mem_use))
+            tensors.update(starts[op.id])
+            schedule.append((op, set(tensors), mem_use[op.id]))
+            tensors.difference_update(ends[op.id])
 
+        self.schedule_info = schedule
         return schedule
 
+    def plan_arena(self, strategy="best", alignment=16):
+        """
+        Assigns an offset in a single memory arena to every tensor that needs to be in RAM, following the current
+        operator order.
+        :param strategy: Arena planning strategy, see `arena_planner.plan_arena`
+        :param alignment: Offsets are aligned to this many bytes
+        :return: An `ArenaPlan` with offsets keyed by tensor id (and `ScratchBuffer` keys for scratch buffers)
+        """
+        key = (strategy, alignment)
+        if key not in self.arena_plans:
+            buffers, owners = self._buffer_lifetimes()
+            last_step = len(self.model_graph.operators) - 1
+            buffers = {b: (size, first, min(last, last_step)) for b, (size, first, last) in buffers.items()}
+            plan = plan_arena(buffers, strategy, alignment)
+            # Tensors sharing a buffer share its offset
+            self.arena_plans[key] = plan._replace(offsets={i: plan.offsets[b] + offset
+                                                           for i, (b, offset) in owners.items()})
+        return self.arena_plans[key]
+
+    def write_c_plan(self, output_path, arena_strategy="best"):
+        """
+        Writes the current operator order and the arena plan as a C header for static-allocation runtimes.
+        :param output_path: Output file (.h)
+        :param arena_strategy: Arena planning strategy, see `arena_planner.plan_arena`
+        """
+        if not self.model_graph:
+            self._build_graph()
+        write_c_plan(output_path, self.model_graph, self.plan_arena(arena_strategy))
+
     def _shorten_long_name(self, name, max_characters=80):
         assert max_characters >= 4
         if len(name) > max_characters:
@@ -288,9 +704,10 @@ class TFLiteModel:
         else:
             return name
 
-    def _print_execution_schedule(self):
+    def _print_execution_schedule(self, arena_plan):
         x = PrettyTable()
-        x.field_names = ["Operator (output name)", "Tensors in memory (IDs)", "Memory use (B)"]
+        x.field_names = ["Operator (output name)", "Tensors in memory (IDs)", "Scratch (B)", "Memory use (B)"]
+        x.align["Scratch (B)"] = "r"
         x.align["Memory use (B)"] = "r"
 
         schedule = self._execution_schedule_info()
@@ -298,36 +715,45 @@ class TFLiteModel:
         for item in schedule:
             op, working_set, mem_use = item
             peak_mem_use = max(peak_mem_use, mem_use)
-            name = self._shorten_long_name(op.output.name)
-            x.add_row([name, f"[{', '.join(str(t.id) for t in working_set if t.size != 0)}]", f"{mem_use:,}"])
+            name = self._shorten_long_name(op.name)
+            x.add_row([name, f"[{', '.join(str(t.id) for t in working_set if t.size != 0)}]", f"{op.scratch_size:,}",
+                       f"{mem_use:,}"])
 
         print("Operator execution schedule:")
         print(x)
         print(f"Current peak memory usage: {peak_mem_use:,} B")
+        print(f"Arena size: {arena_plan.arena_size:,} B (planned with {arena_plan.strategy}, "
+              f"{arena_plan.arena_size - peak_mem_use:,} B above the peak memory usage)")
         print()
 
     def _output_execution_schedule_to_csv(self, csv_file):
         with open(csv_file, 'w', newline='') as f:
             w = csv.writer(f)
-            w.writerow(["Operator", "Working set", "Memory use"])
+            w.writerow(["Operator", "Working set", "Scratch", "Memory use"])
 
             schedule = self._execution_schedule_info()
             for item in schedule:
                 op, working_set, mem_use = item
-                w.writerow([op.output.name, ' '.join(str(t.id) for t in working_set if t.size != 0), mem_use])
+                w.writerow([op.name, ' '.join(str(t.id) for t in working_set if t.size != 0), op.scratch_size,
+                            mem_use])
 
-    def _print_tensor_details(self):
+    def _print_tensor_details(self, arena_plan):
         if not self.model_graph:
             self._build_graph()
 
         x = PrettyTable()
-        x.field_names = ["Id", "Tensor", "Shape", "Size in RAM (B)"]
+        x.field_names = ["Id", "Tensor", "Shape", "Size in RAM (B)", "Arena offset (B)", "Shares memory with (Id)"]
         x.align["Id"] = "r"
         x.align["Size in RAM (B)"] = "r"
+        x.align["Arena offset (B)"] = "r"
 
+        _, owners = self._buffer_lifetimes()
         for t in self.model_graph.tensors:
             if t.size != 0:
-                x.add_row([t.id, self._shorten_long_name(t.name), tuple(t.shape), f"{t.size:,}"])
+                buffer, offset = owners.get(t.id, (t.id, 0))
+                shared = "" if buffer == t.id else f"{buffer} (+{offset:,} B)" if offset else buffer
+                x.add_row([t.id, self._shorten_long_name(t.name), tuple(t.shape), f"{t.size:,}",
+                           f"{arena_plan.offsets[t.id]:,}", shared])
 
         print("Tensor information (weights excluded):")
         print(x)
@@ -343,28 +769,35 @@ class TFLiteModel:
         labels = []
         input_sizes = []
         output_sizes = []
+        scratch_sizes = []
         other_sizes = []
 
         schedule = self._execution_schedule_info()
+        buffers, owners = self._buffer_lifetimes()
         peak_mem_use = 0
 
         for item in schedule:
             op, working_set, mem_use = item
 
-            input_size = TFLiteModel._cum_tensor_sizes(op.inputs)
-            output_size = op.output.size
-            other_size = TFLiteModel._cum_tensor_sizes(t for t in working_set if t not in op.inputs and t != op.output)
+            # Tensors that share a buffer are counted once, as part of the operator's inputs if any of them is one
+            input_buffers = {owners[t.id][0] for t in op.inputs if t.id in owners}
+            output_buffers = {owners[t.id][0] for t in op.outputs if t.id in owners} - input_buffers
+            input_size = sum(buffers[b][0] for b in input_buffers)
+            output_size = sum(buffers[b][0] for b in output_buffers)
+            other_size = mem_use - input_size - output_size - op.scratch_size
 
-            assert input_size + output_size + other_size == mem_use
+            assert other_size >= 0
             peak_mem_use = max(peak_mem_use, mem_use)
 
-            labels.append(op.output.name)
+            labels.append(op.name)
             input_sizes.append(input_size)
             output_sizes.append(output_size)
+            scratch_sizes.append(op.scratch_size)
             other_sizes.append(other_size)
 
         input_sizes = np.array(input_sizes) / 1024
         output_sizes = np.array(output_sizes) / 1024
+        scratch_sizes = np.array(scratch_sizes) / 1024
         other_sizes = np.array(other_sizes) / 1024
         peak_mem_use /= 1024
 
@@ -375,7 +808,9 @@ class TFLiteModel:
 
         ax.bar(x, input_sizes, color="#D95319", label="Operator inputs")
         ax.bar(x, output_sizes, bottom=input_sizes, color="#EDB120", label="Operator outputs")
-        ax.bar(x, other_sizes, bottom=(input_sizes + output_sizes), color="#0072BD", label="Other tensors")
+        ax.bar(x, scratch_sizes, bottom=(input_sizes + output_sizes), color="#7E2F8E", label="Scratch buffers")
+        ax.bar(x, other_sizes, bottom=(input_sizes + output_sizes + scratch_sizes), color="#0072BD",
+               label="Other tensors")
 
         ax.set_xticks(x)
         ax.set_xlabel('Operators')
@@ -386,48 +821,467 @@ class TFLiteModel:
 
         plt.savefig(plot_file, bbox_inches='tight', dpi=300)
 
-    def _output_tensor_details_to_csv(self, csv_file):
+    def _output_tensor_details_to_csv(self, csv_file, arena_plan):
         if not self.model_graph:
             self._build_graph()
 
         with open(csv_file, 'w', newline='') as f:
             w = csv.writer(f)
-            w.writerow(["Id", "Name", "Shape", "Size"])
+            w.writerow(["Id", "Name", "Shape", "Size", "Arena offset", "Buffer", "Buffer offset"])
 
+            _, owners = self._buffer_lifetimes()
             for t in self.model_graph.tensors:
                 if t.size != 0:
-                    w.writerow([t.id, t.name, ' '.join(str(i) for i in t.shape), t.size])
+                    w.writerow([t.id, t.name, ' '.join(str(i) for i in t.shape), t.size, arena_plan.offsets[t.id],
+                                *owners.get(t.id, (t.id, 0))])
 
-    def print_model_analysis(self):
-        self._print_tensor_details()
-        self._print_execution_schedule()
+    def _print_concatenations(self):
+        concats = [op for op in self.model_graph.operators if op.opcode == BuiltinOperator.CONCATENATION]
+        if not concats or not self.aliasing:
+            return
+
+        x = PrettyTable()
+        x.field_names = ["Operator (output name)", "Inputs", "Zero-copy", "Memory saved at the operator (B)"]
+        x.align["Memory saved at the operator (B)"] = "r"
+
+        buffers, owners = self._buffer_lifetimes()
+        for op in concats:
+            output_buffer = owners[op.output.id][0]
+            zero_copy = all(t.id in owners and owners[t.id][0] == output_buffer for t in op.inputs)
+            status = "yes" if zero_copy else "no" if concat_inputs(op) is not None else "no (not eligible)"
+            saved = sum(t.size for t in op.inputs) if zero_copy else 0
+            x.add_row([self._shorten_long_name(op.output.name), len(op.inputs), status, f"{saved:,}"])
+
+        # Concatenations are only placed where that doesn't raise the peak (see `aliasing.share_buffers`)
+        peak_saved = max(peak_memory_usage(self._buffer_lifetimes(concat=False)[0]) - peak_memory_usage(buffers), 0)
+        print("Concatenations (zero-copy ones have their inputs computed directly into the output):")
+        print(x)
+        print(f"Zero-copy concatenation lowers the peak memory usage by {peak_saved:,} B")
+        print()
 
-    def output_model_analysis_to_csv(self, output_folder):
+    def _analysed_models(self):
+        # The main subgraph is analysed along with all the others
+        if self.subgraph != 0:
+            return [self]
+        num_subgraphs = Model.Model.GetRootAsModel(self.model_bytes, 0).SubgraphsLength()
+        return [self] + [self.subgraph_model(i) for i in range(1, num_subgraphs)]
+
+    def _subgraph_name(self):
+        name = Model.Model.GetRootAsModel(self.model_bytes, 0).Subgraphs(self.subgraph).Name()
+        return f"Subgraph {self.subgraph}" + (f" ({name.decode('ascii')})" if name else "")
+
+    def print_model_analysis(self, arena_strategy="best"):
+        models = self._analysed_models()
+        for model in models:
+            if len(models) > 1:
+                print(f"{model._subgraph_name()}:")
+            arena_plan = model.plan_arena(arena_strategy)
+            model._print_tensor_details(arena_plan)
+            model._print_execution_schedule(arena_plan)
+            model._print_concatenations()
+
+    def output_model_analysis_to_csv(self, output_folder, arena_strategy="best"):
         output_folder = Path(output_folder)
         assert output_folder.is_dir()
-        self._output_tensor_details_to_csv(output_folder / "tensor_details.csv")
-        self._output_execution_schedule_to_csv(output_folder / "execution_schedule_info.csv")
-
-    def optimize_memory(self):
-        _, op_order = self.peak_mem_usage()
-        num_operators = len(self.model_graph.operators)
-        correctly_ordered = all(i == op_order[i].id for i in range(num_operators))
-        if correctly_ordered:
-            print("The model already has optimal operator order.")
+        for model in self._analysed_models():
+            # Files of the main subgraph keep their names
+            prefix = f"subgraph{model.subgraph}_" if model.subgraph != 0 else ""
+            model._output_tensor_details_to_csv(output_folder / f"{prefix}tensor_details.csv",
+                                                model.plan_arena(arena_strategy))
+            model._output_execution_schedule_to_csv(output_folder / f"{prefix}execution_schedule_info.csv")
+
+    def optimize_memory(self, timeout=None, max_states=None, jobs=1, cache=None, memo_limit=None, spill_limit=0,
+                        objective="peak", arena_strategy="best", ram_budget=None):
+        """
+        Reorders operators in the model to minimise memory usage, or with `ram_budget`, to fit it in the budget while
+        keeping as much of the original order as the search allows (see `peak_mem_usage`). Other subgraphs of the model
+        are reordered to minimise their peak memory usage first, as the main subgraph's depends on those it runs.
+        :param timeout: Time limit (in seconds) for each of the searches
+        :param max_states: Limit on the number of explored states for the operator order search
+        :param jobs: Number of worker processes to search with, or to optimize independent subgraphs with
+        :param cache: A `ScheduleCache` to look up and store optimal operator orders in, or None
+        :param memo_limit: Approximate limit on the memory used by the search's memo table, in bytes (per process)
+        :param spill_limit: Size of an on-disk table for entries evicted from the memo table, in bytes (per process)
+        :param objective: "peak" to minimise peak memory usage, or "arena" to minimise the size of the memory arena
+        planned with `arena_strategy`, starting from the order with the smallest peak memory usage
+        :param ram_budget: Peak memory usage to fit in, in bytes; raises `RamBudgetInfeasible` if the search proves
+        that no order does
+        """
+        if self.subgraph == 0:
+            self._optimize_subgraphs(timeout=timeout, max_states=max_states, jobs=jobs, cache=cache,
+                                     memo_limit=memo_limit, spill_limit=spill_limit)
+        peak_mem_use, op_order = self.peak_mem_usage(timeout=timeout, max_states=max_states, jobs=jobs, cache=cache,
+                                                     memo_limit=memo_limit, spill_limit=spill_limit,
+                                                     ram_budget=ram_budget)
+        stats = self.search_stats
+        kept = all(i == op.id for i, op in enumerate(op_order))
+        if stats is None and ram_budget is not None and kept:
+            print(f"The operator order of the model meets the RAM budget of {ram_budget:,} B: {peak_mem_use:,} B peak "
+                  f"memory usage.")
+        elif stats is None:
+            print("Using the cached optimal operator order.")
+        else:
+            print(f"Search explored {stats.explored:,} states and pruned {stats.pruned:,}.")
+            memo = stats.memo
+            print(f"Memo table: {memo.hits:,} hits, {memo.misses:,} misses, {memo.evictions:,} evictions "
+                  f"({memo.spilled:,} spilled to disk), up to {memo.resident_bytes:,} B resident.")
+            if ram_budget is not None and peak_mem_use <= ram_budget:
+                print(f"Found an operator order within the RAM budget of {ram_budget:,} B: {peak_mem_use:,} B peak "
+                      f"memory usage.")
+            elif not stats.complete:
+                if ram_budget is not None:
+                    print(f"Warning: no operator order within the RAM budget of {ram_budget:,} B was found, and none "
+                          f"was proven impossible either.")
+                gap = peak_mem_use - stats.lower_bound
+                print(f"Search budget exhausted, using the best operator order found so far: {peak_mem_use:,} B "
+                      f"peak memory usage, at most {gap:,} B ({gap / peak_mem_use * 100:.1f}%) above the lower "
+                      f"bound of {stats.lower_bound:,} B.")
+
+        if objective == "arena":
+            g = self.model_graph
+            lower_bound = stats.lower_bound if stats is not None else peak_mem_use
+            if self.aliasing and any(concat_inputs(op) is not None for op in g.operators):
+                # The peak memory search doesn't place inputs of concatenations in their output, so its lower bound
+                # doesn't hold for the arena
+                lower_bound = 0
+            search = ArenaOrderSearch(g, [op_order, g.operators], strategy=arena_strategy, lower_bound=lower_bound,
+                                      timeout=timeout, aliasing=self.aliasing)
+            arena_plan, op_order = search.solve()
+            result = (f"Arena search evaluated {search.steps:,} operator orders"
+                      f"{'' if search.complete else ' before running out of budget'}: {arena_plan.arena_size:,} B "
+                      f"arena (planned with {arena_plan.strategy})")
+            if lower_bound:
+                result += f", {arena_plan.arena_size - lower_bound:,} B above the lower bound of {lower_bound:,} B"
+            print(result + ".")
+
+        if all(i == op.id for i, op in enumerate(op_order)):
+            print("The model already has optimal operator order." if ram_budget is None else
+                  "The operator order of the model is kept.")
             return
+        self._apply_order(op_order)
 
-        # Proceed reordering the operators by changing the indirection table
+    def _apply_order(self, op_order):
+        # Reorders the operators in the model by changing the indirection table
+        num_operators = len(self.model_graph.operators)
         model = Model.Model.GetRootAsModel(self.model_bytes, 0)
-        subgraph = model.Subgraphs(0)
+        subgraph = model.Subgraphs(self.subgraph)
         indirection_table_offset = UOffsetTFlags.py_type(subgraph._tab.Offset(10))
         indirection_table = subgraph._tab.GetVectorAsNumpy(UOffsetTFlags, indirection_table_offset)
         old_indirection_table = indirection_table.copy()
 
+        new_ids = np.empty(num_operators, dtype=np.int64)
         for i in range(num_operators):
             # Operator #op_id should go into position i
             op_id = op_order[i].id
             indirection_table[i] = old_indirection_table[op_id] + 4 * (op_id - i)
             op_order[i].id = i
+            new_ids[op_id] = i
 
         # Patch up model_graph instead of rebuilding it
         self.model_graph.operators.sort(key=lambda op: op.id)
+        self.model_graph = self.model_graph._replace(columns=renumber_operators(self.model_graph.columns, new_ids))
+        self.schedule_info = None
+        self.arena_plans = {}
+
+    def _optimize_subgraphs(self, jobs=1, **search_options):
+        # Reorders the operators of every other subgraph to minimise its peak memory usage. Subgraphs are optimized
+        # after those they run, which are nested in their working set; the ones that don't depend on each other run
+        # in parallel, with `jobs` worker processes.
+        num_subgraphs = Model.Model.GetRootAsModel(self.model_bytes, 0).SubgraphsLength()
+        models = {i: self.subgraph_model(i) for i in range(num_subgraphs) if i != self.subgraph}
+        if not models:
+            return
+
+        depths = {}
+
+        def depth(i):
+            # Length of the longest chain of calls from a subgraph
+            if i not in depths:
+                model = self.subgraph_model(i)
+                if not model.model_graph:
+                    model._build_graph()
+                callees = {j for op in model.model_graph.operators for j in op.called_subgraphs}
+                depths[i] = max((depth(j) + 1 for j in callees if j != self.subgraph), default=0)
+            return depths[i]
+
+        levels = {}
+        for i in models:
+            levels.setdefault(depth(i), []).append(i)
+
+        x = PrettyTable()
+        x.field_names = ["Subgraph", "Operators", "Peak memory use before (B)", "Peak memory use after (B)"]
+        x.align["Peak memory use before (B)"] = "r"
+        x.align["Peak memory use after (B)"] = "r"
+        for d in sorted(levels):
+            level = levels[d]
+            if jobs > 1 and len(level) > 1:
+                options = dict(search_options, jobs=1)
+                model_bytes = _in_memory(self.model_bytes)
+                with ProcessPoolExecutor(min(jobs, len(level))) as executor:
+                    results = list(executor.map(_search_subgraph, *zip(*[
+                        (model_bytes, self.aliasing, self.scratch, i, options) for i in level])))
+            else:
+                options = dict(search_options, jobs=jobs)
+                results = [_search_subgraph(self.model_bytes, self.aliasing, self.scratch, i, options) for i in level]
+
+            for i, (peak, op_ids) in zip(level, results):
+                model = models[i]
+                # Subgraphs optimized so far may have changed the memory that this one runs
+                model._reset_analysis()
+                model._build_graph()
+                before = peak_memory_usage(model._buffer_lifetimes()[0])
+                if op_ids != list(range(len(op_ids))):
+                    model._apply_order([model.model_graph.operators[k] for k in op_ids])
+                x.add_row([model._subgraph_name(), len(op_ids), f"{before:,}", f"{peak:,}"])
+            # Callers of the optimized subgraphs need to be analysed again
+            for i in models:
+                if depths[i] > d:
+                    models[i]._reset_analysis()
+        self._reset_analysis()
+
+        print("Other subgraphs (each optimized after the subgraphs it runs):")
+        print(x)
+
+    def recompute_operators(self, timeout=None, max_states=None, jobs=1, memo_limit=None, spill_limit=0,
+                            max_operator_macs=None, max_extra_macs=None):
+        """
+        Rewrites the model so that cheap operators (see `recompute.RECOMPUTE_OPERATORS`) run again for the later
+        readers of their output, where that lowers peak memory usage: the output can then be freed after its earlier
+        readers. Recomputations are added greedily, picking the one with the lowest peak memory usage (of the best
+        operator order) in each round, until none helps. Operator order isn't changed, see `optimize_memory`.
+        :param timeout: Time limit (in seconds) for each operator order search
+        :param max_states: Limit on the number of explored states for each operator order search
+        :param jobs: Number of worker processes to search with
+        :param memo_limit: Approximate limit on the memory used by the search's memo table, in bytes (per process)
+        :param spill_limit: Size of an on-disk table for entries evicted from the memo table, in bytes (per process)
+        :param max_operator_macs: Only recompute operators with at most this many multiply-accumulates
+        :param max_extra_macs: Limit on the total number of multiply-accumulates added to the model
+        :return: A list of (tensor name, number of readers of the copy, extra MACs, bytes saved) tuples, one for each
+        recomputation
+        """
+        search_options = dict(timeout=timeout, max_states=max_states, jobs=jobs, memo_limit=memo_limit,
+                              spill_limit=spill_limit)
+        peak, op_order = self.peak_mem_usage(**search_options)
+        initial_peak = peak
+        total_macs = sum(operator_macs(op) for op in self.model_graph.operators)
+        extra_macs = 0
+
+        applied = []
+        while True:
+            best = None
+            g = self.model_graph
+            for candidate in recompute_candidates(g, op_order, max_operator_macs):
+                macs = operator_macs(g.tensors[candidate.tensor].producer)
+                if max_extra_macs is not None and extra_macs + macs > max_extra_macs:
+                    continue
+                model = TFLiteModel(recompute(self.model_bytes, g, candidate, self.subgraph), self.aliasing,
+                                    self.scratch, self.subgraph)
+                candidate_peak, candidate_order = model.peak_mem_usage(**search_options)
+                if candidate_peak < peak and (best is None or (candidate_peak, macs) < best[:2]):
+                    best = candidate_peak, macs, candidate, model, candidate_order
+            if best is None:
+                break
+
+            candidate_peak, macs, candidate, model, op_order = best
+            applied.append((g.tensors[candidate.tensor].name, len(candidate.consumers), macs, peak - candidate_peak))
+            peak = candidate_peak
+            extra_macs += macs
+            self.model_bytes, self.model_graph = model.model_bytes, model.model_graph
+            self.peak_usage, self.search_stats = model.peak_usage, model.search_stats
+            self.schedule_info = None
+            self.arena_plans = {}
+
+        if not applied:
+            print("No recomputation lowers the peak memory usage.")
+            return applied
+
+        x = PrettyTable()
+        x.field_names = ["Recomputed tensor", "Readers of the copy", "Extra MACs", "Peak memory saved (B)"]
+        x.align["Extra MACs"] = "r"
+        x.align["Peak memory saved (B)"] = "r"
+        for name, readers, macs, saved in applied:
+            x.add_row([self._shorten_long_name(name), readers, f"{macs:,}", f"{saved:,}"])
+        print("Recomputed operators:")
+        print(x)
+        print(f"Recomputation lowers the peak memory usage from {initial_peak:,} B to {peak:,} B at the cost of "
+              f"{extra_macs:,} extra MACs ({extra_macs / max(total_macs, 1) * 100:.1f}% of the model's "
+              f"{total_macs:,}).")
+        print()
+        return applied
+
+    def tile_operators(self, ram_budget=None, max_tiles=8, timeout=None, max_states=None, jobs=1, memo_limit=None,
+                       spill_limit=0):
+        """
+        Rewrites the model so that chains of convolutions and pooling operators (see `tiling.tile_chains`) run in
+        horizontal tiles, where that lowers peak memory usage: only one tile of each tensor inside a chain is in memory
+        at a time. In each round, every part of every chain is tried with 2, 3, ... tiles, up to the first tile count
+        that meets the RAM budget; the tiling that meets it with the fewest extra multiply-accumulates is applied, or
+        the one with the lowest peak memory usage if none does. Rounds go on until the budget is met or no tiling
+        helps.
+        The model is rewritten in the best operator order found for it before tiling, with the tiles running one after
+        the other where their chain ran, and tilings are compared by the peak memory usage of that order: the order
+        search branches at every tile, so searching the tiled models would take too long.
+        :param ram_budget: Peak memory usage (in bytes) to aim for, or None to lower it as far as possible
+        :param max_tiles: Largest number of tiles to split a chain into
+        :param timeout: Time limit (in seconds) for the operator order search
+        :param max_states: Limit on the number of explored states for the operator order search
+        :param jobs: Number of worker processes to search with
+        :param memo_limit: Approximate limit on the memory used by the search's memo table, in bytes (per process)
+        :param spill_limit: Size of an on-disk table for entries evicted from the memo table, in bytes (per process)
+        :return: A list of (first tiled tensor name, last tiled tensor name, number of tiles, extra MACs, bytes saved)
+        tuples, one for each tiled chain
+        """
+        peak, op_order = self.peak_mem_usage(timeout=timeout, max_states=max_states, jobs=jobs, memo_limit=memo_limit,
+                                             spill_limit=spill_limit)
+        initial_peak = peak
+        total_macs = sum(operator_macs(op) for op in self.model_graph.operators)
+        budget = ram_budget if ram_budget is not None else 0
+        # Tensors computed by tiles, which aren't tiled again
+        tiled = set()
+
+        applied = []
+        while peak > budget:
+            best = None
+            g = self.model_graph
+            macs = sum(operator_macs(op) for op in g.operators)
+            for part in chain_parts(tile_chains(g, exclude=tiled)):
+                for num_tiles in range(2, min(max_tiles, part[-1].output.shape[1]) + 1):
+                    model = TFLiteModel(tile(self.model_bytes, g, part, num_tiles, op_order, self.subgraph),
+                                        self.aliasing, self.scratch, self.subgraph)
+                    candidate_peak = peak_memory_usage(model._buffer_lifetimes()[0])
+                    extra_macs = sum(operator_macs(op) for op in model.model_graph.operators) - macs
+                    # Any tiling that meets the budget beats those that don't; then fewer MACs are better
+                    key = (max(candidate_peak, budget), extra_macs, candidate_peak)
+                    if candidate_peak < peak and (best is None or key < best[0]):
+                        best = key, candidate_peak, part, num_tiles, extra_macs, model
+                    if candidate_peak <= budget:
+                        break
+            if best is None:
+                break
+
+            _, candidate_peak, part, num_tiles, extra_macs, model = best
+            applied.append((part[0].output.name, part[-1].output.name, num_tiles, extra_macs, peak - candidate_peak))
+            tiled |= set(range(len(g.tensors), len(model.model_graph.tensors)))
+            peak = candidate_peak
+            self.model_bytes, self.model_graph = model.model_bytes, model.model_graph
+            self.peak_usage, self.search_stats = None, None
+            self.schedule_info = None
+            self.arena_plans = {}
+            op_order = self.model_graph.operators
+
+        if not applied:
+            print("No tiling lowers the peak memory usage.")
+            return applied
+
+        x = PrettyTable()
+        x.field_names = ["Tiled operators (first output)", "Last output", "Tiles", "Extra MACs",
+                         "Peak memory saved (B)"]
+        x.align["Extra MACs"] = "r"
+        x.align["Peak memory saved (B)"] = "r"
+        for first, last, num_tiles, macs, saved in applied:
+            x.add_row([self._shorten_long_name(first, 40), self._shorten_long_name(last, 40), num_tiles, f"{macs:,}",
+                       f"{saved:,}"])
+        extra_macs = sum(macs for _, _, _, macs, _ in applied)
+        print("Tiled operators:")
+        print(x)
+        print(f"Tiling lowers the peak memory usage from {initial_peak:,} B to {peak:,} B at the cost of "
+              f"{extra_macs:,} extra MACs ({extra_macs / max(total_macs, 1) * 100:.1f}% of the model's "
+              f"{total_macs:,}).")
+        if ram_budget is not None and peak > ram_budget:
+            print(f"The peak memory usage is still {peak - ram_budget:,} B above the RAM budget of {ram_budget:,} B.")
+        print()
+        return applied
+
+    def explore_tradeoffs(self, rounds=2, max_tiles=8, max_operator_macs=None, arena_strategy="best", timeout=None,
+                          max_states=None, jobs=None, memo_limit=None, spill_limit=0):
+        """
+        Explores the trade-off between memory, compute and model size of the memory-reducing transformations: operator
+        reordering (see `optimize_memory`), recomputation (see `recompute_operators`) and tiling (see
+        `tile_operators`). Starting from the model as it is and from its best operator order, each round applies every
+        single recomputation and tiling to each model that joined the Pareto front in the previous round. The model
+        itself isn't changed.
+        Models are evaluated in parallel, each with a search for its best operator order, except for tiled models,
+        which keep the order they're written in (see `tile_operators`).
+        :param rounds: Number of rounds of transformations
+        :param max_tiles: Largest number of tiles to split a chain into
+        :param max_operator_macs: Only recompute operators with at most this many multiply-accumulates
+        :param arena_strategy: Arena planning strategy, see `arena_planner.plan_arena`
+        :param timeout: Time limit (in seconds) for each operator order search
+        :param max_states: Limit on the number of explored states for each operator order search
+        :param jobs: Number of worker processes to evaluate models with (default: one per CPU core)
+        :param memo_limit: Approximate limit on the memory used by the search's memo table, in bytes (per process)
+        :param spill_limit: Size of an on-disk table for entries evicted from the memo table, in bytes (per process)
+        :return: A tuple of the Pareto front and all explored models, as lists of `tradeoffs.TradeOff`s
+        """
+        search_options = dict(timeout=timeout, max_states=max_states, jobs=1, memo_limit=memo_limit,
+                              spill_limit=spill_limit)
+        if not self.model_graph:
+            self._build_graph()
+        base_macs = sum(operator_macs(op) for op in self.model_graph.operators)
+
+        # Models to evaluate, as (transformations, model bytes, whether to search for the best operator order,
+        # ids of tensors computed by tiles) tuples
+        model_bytes = _in_memory(self.model_bytes)
+        candidates = [((), model_bytes, False, frozenset()), (("reorder",), model_bytes, True, frozenset())]
+        points = []
+        front = []
+        with ProcessPoolExecutor(jobs or os.cpu_count()) as executor:
+            for r in range(rounds + 1):
+                futures = [executor.submit(_evaluate_tradeoff, model_bytes, self.aliasing, self.scratch, self.subgraph,
+                                           search, search_options, arena_strategy)
+                           for _, model_bytes, search, _ in candidates]
+                evaluated = {}
+                for (transformations, _, search, tiled), future in zip(candidates, tqdm(futures, desc=f"Round {r}")):
+                    model_bytes, peak, arena_size, macs = future.result()
+                    point = TradeOff(transformations, peak, arena_size, macs - base_macs, len(model_bytes))
+                    points.append(point)
+                    evaluated[point] = model_bytes, search, tiled
+                front = pareto_front(points)
+                if r == rounds:
+                    break
+
+                candidates = []
+                for point in front:
+                    if point not in evaluated:
+                        continue
+                    model_bytes, search, tiled = evaluated[point]
+                    model = TFLiteModel(model_bytes, self.aliasing, self.scratch, self.subgraph)
+                    model._build_graph()
+                    g = model.model_graph
+                    for c in recompute_candidates(g, g.operators, max_operator_macs):
+                        name = f"recompute {g.tensors[c.tensor].name} for {len(c.consumers)} readers"
+                        candidates.append((point.transformations + (name,),
+                                           recompute(model_bytes, g, c, self.subgraph), search, tiled))
+                    for part in chain_parts(tile_chains(g, exclude=tiled)):
+                        for num_tiles in range(2, min(max_tiles, part[-1].output.shape[1]) + 1):
+                            tiled_bytes = tile(model_bytes, g, part, num_tiles, subgraph=self.subgraph)
+                            tiled_graph = Model.Model.GetRootAsModel(tiled_bytes, 0).Subgraphs(self.subgraph)
+                            num_tensors = tiled_graph.TensorsLength()
+                            name = f"tile {part[0].output.name} to {part[-1].output.name} in {num_tiles}"
+                            candidates.append((point.transformations + (name,), tiled_bytes, False,
+                                               tiled | set(range(len(g.tensors), num_tensors))))
+                if not candidates:
+                    break
+
+        x = PrettyTable()
+        x.field_names = ["Transformations", "Peak memory use (B)", "Arena size (B)", "Extra MACs", "Model size (B)"]
+        for field in x.field_names[1:]:
+            x.align[field] = "r"
+        for p in front:
+            x.add_row([self._shorten_long_name(", ".join(p.transformations) or "none"), f"{p.peak:,}",
+                       f"{p.arena_size:,}", f"{p.extra_macs:,}", f"{p.model_size:,}"])
+        print(f"Pareto front of {len(points):,} explored models:")
+        print(x)
+        print()
+        return front, points
+
+    def write_tradeoffs(self, plot_file, front, points):
+        """
+        Plots the models explored by `explore_tradeoffs` and writes the Pareto front as CSV next to the plot (with the
+        same name and a .csv suffix).
+        :param plot_file: Output file of the plot
+        :param front: The Pareto front
+        :param points: All explored models
+        """
+        write_tradeoffs_csv(Path(plot_file).with_suffix(".csv"), front)
+        plot_tradeoffs(plot_file, points, front)
@@ -0,0 +1,179 @@
+from collections import namedtuple
+
+import numpy as np
+
+from .model_rewriter import Table, add_constant, add_operator, add_tensor, decode_model, encode_model
+from .tflite.BuiltinOperator import BuiltinOperator
+from .tflite.BuiltinOptions import BuiltinOptions
+from .tflite.Padding import Padding
+
+
+# Windowed operators (on NHWC tensors) that can compute any range of output rows from a range of input rows
+TILE_OPERATORS = {
+    BuiltinOperator.CONV_2D, BuiltinOperator.DEPTHWISE_CONV_2D, BuiltinOperator.AVERAGE_POOL_2D,
+    BuiltinOperator.MAX_POOL_2D,
+}
+
+_POOL_OPERATORS = {BuiltinOperator.AVERAGE_POOL_2D, BuiltinOperator.MAX_POOL_2D}
+
+# Extent (filter size, including dilation), stride and implicit padding of a window along one spatial axis
+Window = namedtuple("Window", ["size", "stride", "pad_before", "pad_after"])
+
+
+def window(op, axis):
+    """
+    Returns the `Window` of a windowed operator along the height (axis 1) or the width (axis 2).
+    """
+    o = op.options
+    height = axis == 1
+    if op.opcode in _POOL_OPERATORS:
+        size, dilation = o.FilterHeight() if height else o.FilterWidth(), 1
+    else:
+        # Weights are (output channels, height, width, input channels), or (1, height, width, channels)
+        size, dilation = op.inputs[1].shape[axis], o.DilationHFactor() if height else o.DilationWFactor()
+    stride = o.StrideH() if height else o.StrideW()
+    size = (size - 1) * dilation + 1
+    padding = 0
+    if o.Padding() == Padding.SAME:
+        padding = max((op.output.shape[axis] - 1) * stride + size - op.inputs[0].shape[axis], 0)
+    return Window(size, stride, padding // 2, padding - padding // 2)
+
+
+def _is_tileable(op):
+    if op.opcode not in TILE_OPERATORS or op.options is None or op.output is None:
+        return False
+    x, y = op.inputs[0], op.output
+    if len(x.shape) != 4 or len(y.shape) != 4 or x.shape[0] != 1 or x.is_constant:
+        return False
+    # Padding a tile explicitly would let padded values into pooling windows
+    return op.opcode not in _POOL_OPERATORS or all(sum(window(op, axis)[2:]) == 0 for axis in (1, 2))
+
+
+def tile_chains(graph, exclude=()):
+    """
+    Finds the chains of operators that can run in tiles: sequences of convolutions and pooling operators (see
+    `TILE_OPERATORS`) in which each operator is the only reader of the output of the previous one.
+    :param graph: A `TFLiteGraph`
+    :param exclude: Ids of tensors whose producers are left out of the chains (e.g. operators that are tiles already)
+    :return: A list of chains (lists of operators, first to last) of at least two operators
+    """
+    outputs = set(graph.outputs)
+    tileable = {op for op in graph.operators if _is_tileable(op) and op.output.id not in exclude}
+
+    def successor(op):
+        y = op.output
+        if y in outputs or len(y.consumers) != 1:
+            return None
+        c = y.consumers[0]
+        return c if c in tileable and c.inputs[0] is y and y not in c.inputs[1:] else None
+
+    chains = []
+    for op in graph.operators:
+        producer = op.inputs[0].producer
+        if op not in tileable or (producer in tileable and successor(producer) is op):
+            continue
+        chain = [op]
+        while successor(chain[-1]) is not None:
+            chain.append(successor(chain[-1]))
+        if len(chain) > 1:
+            chains.append(chain)
+    return chains
+
+
+def chain_parts(chains):
+    """
+    Lists the parts of chains (see `tile_chains`) that can run in tiles: all runs of at least two consecutive operators.
+    """
+    return [chain[first:last] for chain in chains for first in range(len(chain) - 1)
+            for last in range(first + 2, len(chain) + 1)]
+
+
+def tile_rows(chain, rows):
+    """
+    Works out which input rows each operator of a chain needs to compute a range of output rows of the last one.
+    Tiles overlap by the halo of the windows; rows outside of the input are implicit padding.
+    :param chain: A chain of operators (see `tile_chains`)
+    :param rows: First and last (exclusive) output row of the last operator
+    :return: A list of (first row, last row (exclusive), padding before, padding after) tuples, one for the input of
+    each operator of the chain
+    """
+    ranges = []
+    for op in reversed(chain):
+        w = window(op, 1)
+        start = rows[0] * w.stride - w.pad_before
+        end = (rows[1] - 1) * w.stride - w.pad_before + w.size
+        height = op.inputs[0].shape[1]
+        ranges.append((max(start, 0), min(end, height), max(-start, 0), max(end - height, 0)))
+        rows = ranges[-1][:2]
+    return ranges[::-1]
+
+
+def tile(model_bytes, graph, chain, num_tiles, op_order=None, subgraph=0):
+    """
+    Rewrites a model so that a chain of operators runs in horizontal tiles: each tile slices the rows it needs out of
+    the input of the chain (with a halo of the rows that neighbouring tiles need too), pads them explicitly where the
+    operators would pad implicitly and runs them through the chain; a concatenation joins the rows of the output.
+    Only one tile of each intermediate tensor is in memory at a time, at the cost of computing the halos more than once.
+    :param model_bytes: The model
+    :param graph: The `TFLiteGraph` of the model, with operator ids matching the model's operator order
+    :param chain: A chain of operators (see `tile_chains`)
+    :param num_tiles: Number of tiles, at most the height of the output of the chain
+    :param op_order: Operators of the model in the order of execution, or None to keep the order of the model
+    :param subgraph: Index of the subgraph that `graph` describes
+    :return: The rewritten model as a bytearray
+    """
+    model = decode_model(model_bytes)
+    s = model.subgraphs[subgraph]
+    x, y = chain[0].inputs[0], chain[-1].output
+    # Tiles are padded explicitly, so operators with SAME padding run with VALID padding instead
+    options = [s.operators[op.id].builtin_options for op in chain]
+    options = [o.copy(padding=Padding.VALID) if o.padding == Padding.SAME else o for o in options]
+    strides = add_constant(model, s, f"{y.name}/tile_strides", [1, 1, 1, 1])
+
+    ops, tiles = [], []
+    height = y.shape[1]
+    for k in range(num_tiles):
+        rows = (k * height // num_tiles, (k + 1) * height // num_tiles)
+        ranges = tile_rows(chain, rows)
+        start, end = ranges[0][:2]
+        t = add_tensor(s, x.id, f"{y.name}/tile{k}/input", [x.shape[0], end - start, x.shape[2], x.shape[3]])
+        begin = add_constant(model, s, f"{y.name}/tile{k}/begin", [0, start, 0, 0])
+        end = add_constant(model, s, f"{y.name}/tile{k}/end", [x.shape[0], end, x.shape[2], x.shape[3]])
+        ops.append(add_operator(model, s, BuiltinOperator.STRIDED_SLICE, [x.id, begin, end, strides], [t],
+                                BuiltinOptions.StridedSliceOptions, Table("StridedSliceOptions")))
+
+        # Each operator computes the rows that the next one reads
+        out_rows = [r[:2] for r in ranges[1:]] + [rows]
+        for op, op_options, (start, end, pad_top, pad_bottom), (first, last) in zip(chain, options, ranges, out_rows):
+            w = window(op, 2)
+            i = op.inputs[0]
+            if pad_top or pad_bottom or w.pad_before or w.pad_after:
+                shape = [i.shape[0], end - start + pad_top + pad_bottom, i.shape[2] + w.pad_before + w.pad_after,
+                         i.shape[3]]
+                padded = add_tensor(s, i.id, f"{op.output.name}/tile{k}/padded", shape)
+                paddings = add_constant(model, s, f"{op.output.name}/tile{k}/paddings",
+                                        [[0, 0], [pad_top, pad_bottom], [w.pad_before, w.pad_after], [0, 0]])
+                ops.append(add_operator(model, s, BuiltinOperator.PAD, [t, paddings], [padded],
+                                        BuiltinOptions.PadOptions, Table("PadOptions")))
+                t = padded
+            o = op.output
+            out = add_tensor(s, o.id, f"{o.name}/tile{k}", [o.shape[0], last - first, o.shape[2], o.shape[3]])
+            original = s.operators[op.id]
+            s.operators.append(original.copy(inputs=np.array([t] + original.inputs[1:].tolist(), dtype=np.int32),
+                                             outputs=np.array([out], dtype=np.int32), builtin_options=op_options))
+            ops.append(len(s.operators) - 1)
+            t = out
+        tiles.append(t)
+    ops.append(add_operator(model, s, BuiltinOperator.CONCATENATION, tiles, [y.id],
+                            BuiltinOptions.ConcatenationOptions, Table("ConcatenationOptions", axis=1)))
+
+    # The tiles run where the last operator of the chain did; the input of the chain is computed before its first
+    tiled = {op.id for op in chain}
+    new_order = []
+    for op in op_order if op_order is not None else graph.operators:
+        if op is chain[-1]:
+            new_order += ops
+        elif op.id not in tiled:
+            new_order.append(op.id)
+    s.operators = [s.operators[i] for i in new_order]
+    return encode_model(model)
@@ -0,0 +1,67 @@
+import csv
+from collections import namedtuple
+
+import numpy as np
+
+
+# A model produced by a sequence of memory-reducing transformations (descriptions, in the order they were applied),
+# with its peak memory usage, the size of its planned memory arena, the multiply-accumulates it adds to the original
+# model and the size of the model file, all in bytes except for MACs
+TradeOff = namedtuple("TradeOff", ["transformations", "peak", "arena_size", "extra_macs", "model_size"])
+
+
+def _costs(point):
+    return point.arena_size, point.extra_macs, point.model_size
+
+
+def pareto_front(points):
+    """
+    Returns the points that no other point beats on arena size, extra MACs or model size without being worse on
+    another. Of points with the same costs, only the first one is kept.
+    :param points: A list of `TradeOff`s
+    :return: A list of `TradeOff`s, by increasing arena size
+    """
+    front = []
+    # Any point that dominates another one sorts before it
+    for p in sorted(points, key=_costs):
+        if not any(all(a <= b for a, b in zip(_costs(q), _costs(p))) for q in front):
+            front.append(p)
+    return front
+
+
+def write_tradeoffs_csv(csv_file, points):
+    """
+    Writes `TradeOff`s to a CSV file, one per row.
+    """
+    with open(csv_file, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(["Transformations", "Peak memory use", "Arena size", "Extra MACs", "Model size"])
+        for p in points:
+            w.writerow(["; ".join(p.transformations) or "none", p.peak, p.arena_size, p.extra_macs, p.model_size])
+
+
+def plot_tradeoffs(plot_file, points, front):
+    """
+    Plots the arena size against the extra MACs of explored models, highlighting the Pareto front (coloured by
+    model size).
+    :param plot_file: Output file
+    :param points: All explored `TradeOff`s
+    :param front: The Pareto front, see `pareto_front`
+    """
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(10, 6))
+    ax = fig.gca()
+    ax.scatter([p.extra_macs for p in points], np.array([p.arena_size for p in points]) / 1024, color="#BFBFBF",
+               label="Explored models")
+    markers = ax.scatter([p.extra_macs for p in front], np.array([p.arena_size for p in front]) / 1024,
+                         c=np.array([p.model_size for p in front]) / 1024, cmap="viridis", zorder=3,
+                         label="Pareto optimal models")
+    fig.colorbar(markers, ax=ax, label="Model size (KB)")
+
+    ax.set_xlabel("Extra MACs")
+    ax.set_ylabel("Arena size (KB)")
+    ax.legend()
+
+    plt.savefig(plot_file, bbox_inches='tight', dpi=300)
+    plt.close(fig)